@@ -12,12 +12,14 @@ Contributors: salvadordura@gmail.com
 
 from cfg import cfg
 import batch_utils
+import batch_store
 import json
 import matplotlib.pyplot as plt
 from pprint import pprint
 import os
 import numpy as np
 from copy import deepcopy
+from collections import OrderedDict
 from scipy.signal import argrelmax
 
 recstep      = 0.1    # ms/sample
@@ -27,6 +29,7 @@ stable       = 50     # ms required for trace to stabilize
 syntime      = 200    # time in ms when glutamate is released (synapse time)
 spikewidth   = 3.0
 batchdatadir = "batch_data"
+expdatafile  = "srdjan_20171017/B_73_004.xlsx"
 
 
 ###############################################################################
@@ -265,6 +268,50 @@ def meas_trace_first_interspike(trace, time=None, recstep=recstep, syntime=synti
     return interspike
 
 
+def meas_trace_features(trace, time=None, recstep=recstep, syntime=syntime, stable=stable, spikesyntime=None):
+    """Returns an OrderedDict of the plateau and spike features of a trace
+    (those compared in plot_plat_comps).  spikesyntime is the stimulus time
+    used for time_to_spike (default: syntime)."""
+
+    if spikesyntime is None:
+        spikesyntime = syntime
+
+    features = OrderedDict()
+    features['plat_amp'] = meas_trace_plat_amp(trace, time=time, recstep=recstep, syntime=syntime, stable=stable)[0]
+    features['plat_dur'] = meas_trace_plat_dur(trace, time=time, recstep=recstep, syntime=syntime, stable=stable)[0]
+    features['num_spikes'] = meas_trace_num_spikes(trace, time=time, recstep=recstep)
+    features['spike_freq'] = meas_trace_spike_freq(trace, time=time, recstep=recstep)
+    features['time_to_spike'] = meas_trace_time_to_spike(trace, time=time, recstep=recstep, syntime=spikesyntime)
+    features['first_interspike'] = meas_trace_first_interspike(trace, time=time, recstep=recstep)
+    return features
+
+
+def get_exp_data_path():
+    """Returns the path to eee/data, searching up from the current directory."""
+
+    curpath = os.getcwd()
+    while os.path.split(curpath)[1] != "eee":
+        oldpath = curpath
+        curpath = os.path.split(curpath)[0]
+        if oldpath == curpath:
+            raise Exception("Couldn't find data directory. Try running from within eee/sim file tree.")
+    return os.path.join(curpath, "data")
+
+
+def get_exp_features(expfile=expdatafile):
+    """Returns a list with the features (see meas_trace_features) of each
+    trace (column) of an experimental data file in eee/data."""
+
+    expdata = batch_utils.import_excel(os.path.join(get_exp_data_path(), expfile))
+    time = np.array(expdata.index.tolist())
+
+    expfeatures = []
+    for column in np.arange(0, len(expdata.columns)):
+        cur_data = np.array(expdata.iloc[:,column].tolist())
+        expfeatures.append(meas_trace_features(cur_data, time=time, recstep=0.2, stable=0.0, spikesyntime=100.0))
+    return expfeatures
+
+
 def meas_batch_plat_amp(params, data, cellID=0, platthresh=platthresh, stable=stable, syntime=syntime, recstep=recstep, showwork=False):
     """Measures plateau amplitude for a Netpyne batch"""
 
@@ -770,6 +817,43 @@ def get_traces(params, data, cellID=0, trace="V_soma", tracename=None, stable=No
 
 
 
+def get_store_traces(batchname, cellID=0, trace="V_soma", tracename=None, stable=None, batchdatadir=batchdatadir):
+    """Gets the traces of a batch from its binary store (see batch_store.pack_batch)
+    without reading them: yarray is a memory-mapped view, so a whole batch
+    costs neither parse time nor memory until the traces are used.  Missing
+    grid points are NaN.  For use with plot_relation(), like get_traces()."""
+
+    saveFolder = os.path.join(batchdatadir, batchname)
+    traces = batch_store.trace_array(saveFolder, batchname)
+    cellLabel = "cell_" + str(cellID)
+    if cellLabel not in traces['cells'] or trace not in traces['traces']:
+        raise Exception("Trace " + trace + " not found in " + cellLabel)
+
+    store = batch_store.load_store(saveFolder, batchname)
+    netCells = batch_store.store_output(store, store['meta']['simLabels'][0], vars=['net'])['net']['cells']
+    cellType = str(netCells[cellID]['tags']['cellType'])
+
+    if tracename is None:
+        tracename = trace
+
+    yarray = traces['yarray'][..., traces['cells'].index(cellLabel), traces['traces'].index(trace), :]
+    time = recstep * np.arange(0, yarray.shape[-1], 1)
+    if stable is not None:
+        stable = int(stable / recstep)
+        yarray = yarray[..., stable:]
+        time = time[stable:]
+
+    output = {}
+    output['yarray'] = yarray
+    output['xvector'] = time
+    output['params'] = traces['params']
+    output['autoylabel'] = tracename
+    output['autoxlabel'] = "Time (ms)"
+    output['autotitle'] = "Traces from " + cellLabel + " (" + cellType + ")"
+    output['legendlabel'] = tracename
+    return output
+
+
 def get_bapamp_distance(params, data, cellID=0, section="Bdend1", stimtime=200):
     """Gets the bAP amplitude versus distance along dendrite relation for each 
     batch for the chosen section. For use with plot_relation()."""
@@ -828,8 +912,59 @@ def get_bapamp_distance(params, data, cellID=0, section="Bdend1", stimtime=200):
 # This is the place to add new plotting routines.
 ###############################################################################
 
+def get_samples(params):
+    """Returns the sampled param labels and a (samples, params) array of their
+    values for a sampled batch (see batch_utils.make_sampled_batch)."""
+
+    samples = params[0]['samples']
+    labels = samples.keys()
+    values = np.array([samples[label] for label in labels]).T
+    return labels, values
+
+
+def plot_samples(meas, params, title=None, measlabel=None, param_labels=None, legend_label=None, fig=None, figsize=None):
+    """Plots the measure of a sampled batch against each sampled parameter."""
+
+    labels, values = get_samples(params)
+    measvals = np.array(meas['values'])
+    if param_labels is None:
+        param_labels = [label if type(label) != list else label[0] + " " + label[1] for label in labels]
+    ylabel = meas['label'] if measlabel is None else measlabel
+
+    numcols = min(len(labels), 3)
+    numrows = int(np.ceil(len(labels) / float(numcols)))
+    if fig is None:
+        if figsize is None:
+            figsize = (4 * numcols, 3.5 * numrows)
+        figure, axes = plt.subplots(numrows, numcols, figsize=figsize, sharey=True, squeeze=False)
+        axes = axes.flatten()
+    else:
+        figure = fig
+        axes = figure.axes
+
+    sampling = params[0]['sampling']
+    for index, label in enumerate(labels):
+        ax = axes[index]
+        ax.plot(values[:, index], measvals, 'o', alpha=0.6, label=legend_label)
+        if label in sampling['log']:
+            ax.set_xscale('log')
+        ax.set_xlabel(param_labels[index])
+        if index % numcols == 0:
+            ax.set_ylabel(ylabel)
+    if legend_label is not None:
+        axes[0].legend(loc="best")
+    if title is None:
+        title = ylabel + " (" + sampling['method'] + ", " + str(len(measvals)) + " samples)"
+    figure.suptitle(title)
+
+    return figure
+
+
 def plot_measure(meas, params, title=None, measlabel=None, param_labels=None, legend_label=None, swapaxes=False, fig=None, figsize=(6, 4.5)):
     """Plots the measure against the parameter values."""
+
+    if 'samples' in params[0]:
+        return plot_samples(meas, params, title=title, measlabel=measlabel, param_labels=param_labels, legend_label=legend_label, fig=fig)
     
     measvals = meas['values']
     measautolabel = meas['label']
@@ -1820,51 +1955,19 @@ def plot_plat_comps(batchname, cellIDs=None, expdata=False, platthresh=platthres
             if "glutAmp" in param['label']:
                 sim_glutAmps = param['values']
 
-        # Find path to data directory
-        curpath = os.getcwd()
-        while os.path.split(curpath)[1] != "eee":
-            oldpath = curpath
-            curpath = os.path.split(curpath)[0]
-            if oldpath == curpath:
-                raise Exception("Couldn't find data directory. Try running from within eee/sim file tree.")
-        datapath = os.path.join(curpath, "data")
-        expdata = batch_utils.import_excel(os.path.join(datapath, "srdjan_20171017/B_73_004.xlsx"))
+        expfeatures = get_exp_features()
 
         expparam1 = {}
         expparam1['label'] = 'glutAmp'
-        expparam1['values'] = np.linspace(min(sim_glutAmps), max(sim_glutAmps), 10).round(2)
+        expparam1['values'] = np.linspace(min(sim_glutAmps), max(sim_glutAmps), len(expfeatures)).round(2)
         expdata_params = [expparam1]
 
-        time = np.array(expdata.index.tolist())
-
-        platamps = []
-        platdurs = []
-        numspikes = []
-        spikefreqs = []
-        timetospikes = []
-        interspikes = []
-
-        for column in np.arange(0, len(expdata.columns)):
-            
-            cur_data = np.array(expdata.iloc[:,column].tolist())
-            
-            platamp, platvolt = meas_trace_plat_amp(cur_data, time=time, recstep=0.2, stable=0.0)
-            platamps.append(platamp)
-
-            platdur, plattimes = meas_trace_plat_dur(cur_data, time=time, recstep=0.2, stable=0.0)
-            platdurs.append(platdur)
-
-            numspike = meas_trace_num_spikes(cur_data, time=time, recstep=0.2, showwork=False)
-            numspikes.append(numspike)
-
-            spikefreq = meas_trace_spike_freq(cur_data, time=time, recstep=0.2)
-            spikefreqs.append(spikefreq)
-
-            time_to_spike = meas_trace_time_to_spike(cur_data, time=time, recstep=0.2, syntime=100.0, showwork=False)
-            timetospikes.append(time_to_spike)
-
-            interspike = meas_trace_first_interspike(cur_data, time=time, recstep=0.2, showwork=False)
-            interspikes.append(interspike)
+        platamps = [features['plat_amp'] for features in expfeatures]
+        platdurs = [features['plat_dur'] for features in expfeatures]
+        numspikes = [features['num_spikes'] for features in expfeatures]
+        spikefreqs = [features['spike_freq'] for features in expfeatures]
+        timetospikes = [features['time_to_spike'] for features in expfeatures]
+        interspikes = [features['first_interspike'] for features in expfeatures]
 
         expdata_platamps = {}
         expdata_platamps['label'] = 'Plateau Amplitude (mV)'
@@ -0,0 +1,234 @@
+"""
+batch_dedup.py
+Per-cell result cache.  Each population of a grid point gets a key from its
+effective parameters: the cell rule, population, stimuli and synaptic
+mechanisms that netParams.py builds for it, the run settings of the cfg and
+the model files (batch_utils.model_digest).  A cfg param that netParams.py
+only applies to some cells (or that ends up at the same value) therefore
+leaves the other cells' keys unchanged.  Outputs are split into one file per
+population in batch_cache/cells; a grid point whose every population is
+already there is assembled from them instead of being simulated.
+Used by batch_utils.prepare_cache/update_cache with run_batch(cache='cells').
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import batch_utils
+import batch_store
+
+# cfg keys that affect a cell's results or saved output without going
+# through netParams.py
+cellRunKeys = ['duration', 'dt', 'hParams', 'seeds', 'cvode_active', 'cvode_atol', 'cvode_atolscale',
+               'nthreads', 'earlyStop', 'recordTraces', 'recordCells', 'recordStep', 'recordStim',
+               'createNEURONObj', 'createPyStruct', 'addSynMechs', 'saveCellSecs', 'saveCellConns']
+
+celldir = os.path.join(batch_utils.cachedir, "cells")
+
+
+def matches(conds, tags):
+    """Returns True if a population's tags satisfy netpyne conds (a list value
+    matches any of its items)."""
+
+    for key, value in conds.iteritems():
+        if isinstance(value, (list, tuple)) and not isinstance(tags.get(key), (list, tuple)):
+            if tags.get(key) not in value:
+                return False
+        elif tags.get(key) != value:
+            return False
+    return True
+
+
+def pop_gids(netParams):
+    """Returns an OrderedDict of popLabel: gids, numbered in population order
+    as netpyne does."""
+
+    gids = OrderedDict()
+    start = 0
+    for popLabel, pop in netParams.popParams.iteritems():
+        gids[popLabel] = range(start, start + pop.get('numCells', 1))
+        start += pop.get('numCells', 1)
+    return gids
+
+
+def cell_params(netParams, popLabel):
+    """Returns everything netParams specifies for the cells of a population:
+    its popParams, matching cellParams rules and the stimuli (with their
+    sources and synaptic mechanisms) that target it."""
+
+    pop = netParams.popParams[popLabel]
+    tags = dict(pop, pop=popLabel, popLabel=popLabel)
+    params = OrderedDict()
+    params['pop'] = pop
+    params['cellRules'] = [rule for label, rule in sorted(netParams.cellParams.iteritems())
+                           if matches(rule.get('conds', {}), tags)]
+    stims = []
+    for label, target in sorted(netParams.stimTargetParams.iteritems()):
+        if matches(target.get('conds', {}), tags):
+            stims.append({'target': dict((k, v) for k, v in target.iteritems() if k != 'source'),
+                          'source': netParams.stimSourceParams.get(target['source']),
+                          'synMech': netParams.synMechParams.get(target.get('synMech'))})
+    params['stims'] = stims
+    return params
+
+
+def cell_keys(netParams, cfg, modelKey):
+    """Returns an OrderedDict of popLabel: key of the population's effective
+    parameters.  The key only includes the population's gids if one of its
+    stimuli is noisy (netpyne seeds noise by gid)."""
+
+    runCfg = dict((key, getattr(cfg, key)) for key in cellRunKeys if hasattr(cfg, key))
+    gids = pop_gids(netParams)
+    keys = OrderedDict()
+    for popLabel in netParams.popParams:
+        params = cell_params(netParams, popLabel)
+        if any((stim['source'] or {}).get('noise', 0) for stim in params['stims']):
+            params['gids'] = gids[popLabel]
+        sha = hashlib.sha1(modelKey)
+        sha.update(json.dumps([params, runCfg], sort_keys=True, default=batch_utils.json_default))
+        keys[popLabel] = sha.hexdigest()
+    return keys
+
+
+def split_output(output, gids, keys, source, celldir=celldir):
+    """Stores each population (popLabel: gids) of a simulation output, with
+    traces padded to the full duration (see batch_utils.pad_truncated), under
+    its key."""
+
+    batch_utils.pad_truncated(output)
+    simData = output['simData']
+    simData.pop('earlyStop', None)
+    netData = output.get('net', {})
+    netCells = dict((cell['gid'], cell) for cell in netData.get('cells', []))
+    spikes = zip(simData.get('spkt', []), simData.get('spkid', []))
+
+    for popLabel, popGids in gids.iteritems():
+        filename = batch_utils.cache_path(keys[popLabel], celldir)
+        if os.path.isfile(filename):
+            continue
+        cells = []
+        for gid in popGids:
+            cellLabel = 'cell_' + str(gid)
+            traces = OrderedDict((trace, data[cellLabel]) for trace, data in simData.iteritems()
+                                 if isinstance(data, dict) and cellLabel in data)
+            cells.append({'traces': traces, 'spkt': [t for t, spkid in spikes if int(spkid) == gid],
+                          'net': netCells.get(gid)})
+        piece = {'source': source, 't': simData.get('t'), 'cells': cells,
+                 'pop': netData.get('pops', {}).get(popLabel)}
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename + '.tmp', 'w') as fileObj:
+            json.dump(piece, fileObj, default=batch_utils.json_default)
+        os.rename(filename + '.tmp', filename)
+
+
+def assemble_output(cfg, netParams, keys, celldir=celldir):
+    """Returns a simulation output (as saved by netpyne, with cfg.saveDataInclude)
+    put together from the stored populations, or None if any is missing.
+    output['dedup'] lists the simulation each population came from."""
+
+    filenames = OrderedDict((popLabel, batch_utils.cache_path(key, celldir)) for popLabel, key in keys.iteritems())
+    if not all(os.path.isfile(filename) for filename in filenames.values()):
+        return None
+
+    simData = OrderedDict([('spkt', []), ('spkid', [])])
+    netCells = []
+    netPops = OrderedDict()
+    sources = OrderedDict()
+    gids = pop_gids(netParams)
+    for popLabel, filename in filenames.iteritems():
+        with open(filename, 'r') as fileObj:
+            piece = json.load(fileObj, object_pairs_hook=OrderedDict)
+        sources[popLabel] = piece['source']
+        simData['t'] = piece['t']
+        for gid, cell in zip(gids[popLabel], piece['cells']):
+            for trace, data in cell['traces'].iteritems():
+                simData.setdefault(trace, OrderedDict())['cell_' + str(gid)] = data
+            simData['spkt'].extend(cell['spkt'])
+            simData['spkid'].extend([gid] * len(cell['spkt']))
+            if cell['net'] is not None:
+                netCells.append(dict(cell['net'], gid=gid))
+        if piece['pop'] is not None:
+            netPops[popLabel] = dict(piece['pop'], cellGids=gids[popLabel])
+    order = sorted(range(len(simData['spkt'])), key=lambda i: simData['spkt'][i])
+    simData['spkt'] = [simData['spkt'][i] for i in order]
+    simData['spkid'] = [simData['spkid'][i] for i in order]
+
+    include = getattr(cfg, 'saveDataInclude', ['netParams', 'netCells', 'netPops', 'simConfig', 'simData'])
+    output = OrderedDict()
+    net = OrderedDict()
+    if 'netParams' in include:
+        net['params'] = netParams.__dict__
+    if 'net' in include or 'netCells' in include:
+        net['cells'] = netCells
+    if 'net' in include or 'netPops' in include:
+        net['pops'] = netPops
+    if net:
+        output['net'] = net
+    if 'simConfig' in include:
+        output['simConfig'] = cfg.__dict__
+    if 'simData' in include:
+        output['simData'] = simData
+    output['dedup'] = sources
+    return output
+
+
+def link_cells(b, cachedir=batch_utils.cachedir):
+    """Computes the population keys of every grid point of a netpyne Batch
+    (importing each cell template once, see batch_utils.load_netParams)
+    and assembles the outputs that are missing from saveFolder (and its
+    binary store, see batch_store) but whose populations are all stored.  Returns (simLabel: {'keys': popLabel: key,
+    'gids': popLabel: gids}, number assembled)."""
+
+    celldir = os.path.join(cachedir, "cells")
+    cfg = batch_utils.load_cfg(b.cfgFile)
+    if b.runCfg.get('splitPops'):
+        cfg.pops = list(b.runCfg['splitPops'])
+    modelKey = batch_utils.model_digest(b.netParamsFile)
+    labels, combs = batch_utils.grid_combinations(b.params)
+    stored = batch_store.stored_simLabels(b.saveFolder, b.batchLabel)
+    cellRules = {}
+
+    allKeys = OrderedDict()
+    hits = 0
+    for iComb, pComb in combs:
+        for paramLabel, paramVal in zip(labels, pComb):
+            batch_utils.set_cfg_param(cfg, paramLabel, paramVal)
+        simLabel = batch_utils.get_simLabel(b.batchLabel, iComb)
+        netParams = batch_utils.load_netParams(b.netParamsFile, cfg, cellRules)
+        keys = cell_keys(netParams, cfg, modelKey)
+        allKeys[simLabel] = {'keys': keys, 'gids': pop_gids(netParams)}
+
+        outFile = os.path.join(b.saveFolder, simLabel + '.json')
+        if os.path.isfile(outFile) or simLabel in stored:
+            continue
+        cfg.simLabel = simLabel
+        cfg.saveFolder = b.saveFolder
+        cfg.filename = os.path.join(b.saveFolder, simLabel)
+        output = assemble_output(cfg, netParams, keys, celldir)
+        if output is not None:
+            with open(outFile + '.tmp', 'w') as fileObj:
+                json.dump(output, fileObj, default=batch_utils.json_default)
+            os.rename(outFile + '.tmp', outFile)
+            print("Assembled %s from %s" % (simLabel, ", ".join("%s: %s" % item for item in output['dedup'].iteritems())))
+            hits += 1
+    return allKeys, hits
+
+
+def store_cells(b, allKeys, cachedir=batch_utils.cachedir):
+    """Splits the new outputs of a netpyne Batch into the per-cell store
+    (allKeys from link_cells)."""
+
+    celldir = os.path.join(cachedir, "cells")
+    for simLabel, layout in allKeys.iteritems():
+        outFile = os.path.join(b.saveFolder, simLabel + '.json')
+        if not os.path.isfile(outFile):
+            continue
+        if all(os.path.isfile(batch_utils.cache_path(key, celldir)) for key in layout['keys'].values()):
+            continue
+        with open(outFile, 'r') as fileObj:
+            output = json.load(fileObj, object_pairs_hook=OrderedDict)
+        if 'simData' in output and 'dedup' not in output:
+            split_output(output, layout['gids'], layout['keys'], simLabel, celldir)
@@ -0,0 +1,263 @@
+"""
+batch_fields.py
+Selective, lazy loading of batch outputs.  A field is a top-level output key
+or a dotted path of keys into it, e.g. 'simData.V_soma.cell_1' (a tuple of
+keys for keys that contain dots).  read_fields parses only the requested
+fields of a json output, streaming it with ijson when that is installed
+(pip install ijson); without it the file is parsed whole, once per output
+(see json_fetcher).  lazy_output returns an output holding those fields in
+which everything else is read from the file (or binary store) when first
+used.
+decode_outputs reads many outputs (in worker processes), telling files that
+are missing from files that can't be decoded.
+Used by batch_utils.readBatchData.
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+from decimal import Decimal
+import errno
+import json
+import batch_utils
+
+# ijson events that start a value
+valueEvents = ['start_map', 'start_array', 'null', 'boolean', 'integer', 'double', 'number', 'string']
+
+# fields needed to pad the traces of a simulation that stopped early
+padFields = [('simData', 'earlyStop'), ('simConfig', 'recordStep')]
+
+
+def field_path(field):
+    """Returns the path (tuple of keys) of a field."""
+    if isinstance(field, (tuple, list)):
+        return tuple(field)
+    return tuple(field.split('.'))
+
+
+def get_field(output, path):
+    """Returns the field at path of an output (KeyError if it has none)."""
+    value = output
+    for key in path:
+        if not isinstance(value, dict):
+            raise KeyError('.'.join(path))
+        value = value[key]
+    return value
+
+
+def set_field(output, path, value):
+    """Sets the field at path of an output, adding the dicts on the way."""
+    for key in path[:-1]:
+        output = output.setdefault(key, OrderedDict())
+    output[path[-1]] = value
+
+
+def next_value(events, first):
+    """Returns the value that starts with the ijson event first, reading the
+    rest of it from events."""
+
+    prefix, event, value = first
+    if event == 'start_map':
+        obj = OrderedDict()
+        for prefix, event, value in events:
+            if event == 'end_map':
+                return obj
+            obj[value] = next_value(events, next(events))
+    elif event == 'start_array':
+        obj = []
+        for item in events:
+            if item[1] == 'end_array':
+                return obj
+            obj.append(next_value(events, item))
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def outer_paths(paths):
+    """Returns paths without those inside another one (which come with it)."""
+    return [path for path in paths if not any(path[:len(other)] == other and path != other for other in paths)]
+
+
+def select_fields(output, paths=None):
+    """Returns an OrderedDict of the fields at paths of a decoded output (the
+    output itself if paths is None), leaving out those it doesn't have."""
+
+    if paths is None:
+        return output
+    fields = OrderedDict()
+    for path in outer_paths(paths):
+        try:
+            set_field(fields, path, get_field(output, path))
+        except KeyError:
+            pass
+    return fields
+
+
+def read_fields(filename, paths=None):
+    """Returns an OrderedDict of the fields at paths of a json output (all of
+    it if paths is None).  Fields that aren't in the output are left out.
+    With ijson, the file is only read up to the last field requested."""
+
+    with open(filename, 'r') as fileObj:
+        if paths is None:
+            return json.load(fileObj, object_pairs_hook=OrderedDict)
+        try:
+            import ijson
+        except ImportError:
+            return select_fields(json.load(fileObj, object_pairs_hook=OrderedDict), paths)
+
+        paths = outer_paths(paths)
+        fields = OrderedDict()
+        targets = dict(('.'.join(path), path) for path in paths)
+        events = ijson.parse(fileObj)
+        for item in events:
+            prefix, event, value = item
+            if prefix in targets and event in valueEvents:
+                set_field(fields, targets.pop(prefix), next_value(events, item))
+                if not targets:
+                    break
+        return fields
+
+
+def json_fetcher(filename):
+    """Returns fetch(paths=None), which reads the fields at paths (all if
+    None) of a json output, with early-stopped traces padded (see
+    batch_utils.pad_truncated).  Without ijson, the file is parsed whole on
+    the first fetch and later fetches take their fields from that."""
+
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+    document = []
+
+    def fetch(paths=None):
+        if ijson is None:
+            if not document:
+                document.append(batch_utils.pad_truncated(read_fields(filename)))
+            return select_fields(document[0], paths)
+        if paths is not None and any(path[0] == 'simData' for path in paths):
+            paths = list(paths) + padFields
+        return batch_utils.pad_truncated(read_fields(filename, paths))
+    fetch.source = filename
+    return fetch
+
+
+def store_fetcher(store, simLabel):
+    """Returns fetch(paths=None), which reads the fields at paths (all if
+    None) of a simulation in a binary store (see batch_store.store_output)."""
+
+    import batch_store
+
+    def fetch(paths=None):
+        vars = None if paths is None else set(path[0] for path in paths)
+        return batch_store.store_output(store, simLabel, vars)
+    fetch.source = simLabel
+    return fetch
+
+
+class LazyField(OrderedDict):
+    """An output, or a dict within one, whose keys that haven't been read yet
+    are fetched when first used (see lazy_output).  Iterating over it, and
+    'in', only see what has been read so far.  A key that can't be read is
+    reported (with its read_status) and missing."""
+
+    def __init__(self, fetch=None, path=()):
+        OrderedDict.__init__(self)
+        self.fetch = fetch
+        self.path = path
+
+    def __missing__(self, key):
+        if self.fetch is None:
+            raise KeyError(key)
+        path = self.path + (key,)
+        try:
+            fields = self.fetch([path])
+        except Exception as error:
+            status, result = read_status(error)
+            print('Could not read %s of %s: %s' % ('.'.join(path), getattr(self.fetch, 'source', 'output'), result or status))
+            raise KeyError(key)
+        value = get_field(fields, path)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def lazy_output(fetch, fields=None, values=None):
+    """Returns a LazyField output holding the fields (list of paths, read
+    with one fetch unless their values are given; none if None) of a
+    simulation, from which any other field is fetched when it is first
+    used."""
+
+    output = LazyField(fetch)
+    if not fields:
+        return output
+    if values is None:
+        values = fetch(fields)
+    for path in fields:
+        try:
+            value = get_field(values, path)
+        except KeyError:
+            continue
+        container = output
+        for depth, key in enumerate(path[:-1]):
+            if not dict.__contains__(container, key):
+                container[key] = LazyField(fetch, path[:depth + 1])
+            container = dict.__getitem__(container, key)
+        container[path[-1]] = value
+    return output
+
+
+def decode_error(error):
+    """Returns a one-line description of an exception."""
+    lines = str(error).strip().splitlines() or ['']
+    return '%s: %s' % (type(error).__name__, lines[0])
+
+
+def read_status(error):
+    """Returns the decode_output status and result for an exception raised
+    reading an output: 'missing' if there is no file, else 'error' with its
+    decode_error."""
+    if isinstance(error, IOError) and error.errno == errno.ENOENT:
+        return 'missing', None
+    return 'error', decode_error(error)
+
+
+def decode_output(job):
+    """Reads the fields (all if None) of a json output, as json_fetcher does;
+    job is (key, filename, fields).  Returns (key, status, result): 'done'
+    with the fields read, 'missing' if there is no file, or 'error' with the
+    decode_error."""
+
+    key, filename, fields = job
+    try:
+        return key, 'done', json_fetcher(filename)(fields)
+    except Exception as error:
+        status, result = read_status(error)
+        return key, status, result
+
+
+def decode_outputs(jobs, processes=None):
+    """Reads json outputs (decode_output jobs) in processes worker processes
+    (default: one per core; 1 reads them in this process), yielding each
+    decode_output result as soon as it is ready, in no particular order."""
+
+    if not jobs:
+        return
+    if processes == 1:
+        for job in jobs:
+            yield decode_output(job)
+        return
+    import multiprocessing
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(decode_output, jobs, chunksize=max(1, len(jobs) // (4 * processes))):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
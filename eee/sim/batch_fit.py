@@ -0,0 +1,226 @@
+"""
+batch_fit.py
+Fits cfg parameters to the plateau and spike features of experimental
+recordings (batch_analysis.get_exp_features) with an asynchronous
+steady-state evolution strategy: candidates are sampled from a covariance
+estimated from the best members so far, and a new candidate is started as
+soon as any candidate finishes, so local workers never wait for a whole
+generation.  Each candidate runs one simulation per stimulus level matched
+to the experimental traces.
+
+Usage (from a batch directory):
+    ranges = OrderedDict([('NMDABetaScale', [3.5, 56.0]), ('dendKScale', [0.25, 4.0])])
+    fitCfg = {'stimValues': list(np.linspace(0.5, 5.0, 10)), 'evaluations': 300, 'log': ranges.keys()}
+    best = batch_fit.run_fit("fit_B73", ranges, "cfg.py", "netParams.py", fitCfg=fitCfg, runCfg={'cores': 16})
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import multiprocessing
+import json
+import os
+import shutil
+import numpy as np
+import batch_utils
+import batch_analysis
+
+fitDefaults = {
+    'expFile'     : batch_analysis.expdatafile,  # in eee/data
+    'stimParam'   : 'glutAmp',  # cfg param matched to the experimental traces
+    'stimValues'  : None,       # stimParam value for each experimental trace (required)
+    'weights'     : OrderedDict([('plat_amp', 1.0), ('plat_dur', 1.0), ('num_spikes', 1.0),
+                                 ('spike_freq', 1.0), ('time_to_spike', 1.0), ('first_interspike', 1.0)]),
+    'cellID'      : 0,
+    'evaluations' : 200,        # total candidates
+    'popSize'     : 20,         # members kept; the first popSize candidates are a Latin hypercube
+    'elite'       : 0.5,        # fraction of the population used for the sampling distribution
+    'sigmaMin'    : 0.01,       # minimum sampling std (in units of each param's range)
+    'log'         : [],         # params searched in log space
+    'seed'        : 0,
+    'keepOutput'  : True,       # keep the simulation json files
+}
+
+
+def fit_state(numDims, popSize, elite, sigmaMin, seed):
+    """Returns the population and sampling settings of an asynchronous fit.
+    Points are in normalized [0, 1] coordinates of the param ranges."""
+
+    return {'numDims': numDims, 'popSize': popSize, 'elite': elite, 'sigmaMin': sigmaMin,
+            'randomState': np.random.RandomState(seed),
+            'initial': list(batch_utils.lhs_points(popSize, numDims, seed=seed)),
+            'population': []}  # (score, point), best first
+
+
+def ask(state):
+    """Returns a new point to evaluate: from the initial Latin hypercube, then
+    from a normal distribution fitted to the weighted elite of the population."""
+
+    if state['initial']:
+        return state['initial'].pop(0)
+    population = state['population']
+    if not population:
+        return state['randomState'].uniform(size=state['numDims'])
+
+    numElite = max(2, int(np.ceil(state['elite'] * len(population))))
+    elite = np.array([point for score, point in population[:numElite]])
+    weights = np.log(numElite + 0.5) - np.log(np.arange(1, len(elite) + 1))
+    weights /= weights.sum()
+    mean = np.dot(weights, elite)
+    centered = elite - mean
+    cov = np.dot(centered.T * weights, centered) + (state['sigmaMin'] ** 2) * np.eye(state['numDims'])
+    point = state['randomState'].multivariate_normal(mean, cov)
+
+    # reflect into [0, 1]
+    point = np.abs(point) % 2.0
+    return np.where(point > 1.0, 2.0 - point, point)
+
+
+def tell(state, point, score):
+    """Adds an evaluated point to the population, keeping the best popSize."""
+
+    population = state['population']
+    population.append((score, np.array(point)))
+    population.sort(key=lambda member: member[0])
+    del population[state['popSize']:]
+
+
+def to_values(point, ranges, log):
+    """Converts a normalized point to an OrderedDict of param values."""
+
+    values = OrderedDict()
+    for dim, (label, (lo, hi)) in enumerate(ranges.iteritems()):
+        if label in log:
+            values[label] = float(np.exp(np.log(lo) + point[dim] * (np.log(hi) - np.log(lo))))
+        else:
+            values[label] = float(lo + point[dim] * (hi - lo))
+    return values
+
+
+def sim_features(jobName, cellID=0):
+    """Returns the features (batch_analysis.meas_trace_features) of a
+    simulation output's somatic voltage trace."""
+
+    with open(jobName + '.json', 'r') as fileObj:
+        output = json.load(fileObj)
+    batch_utils.pad_truncated(output)
+    simConfig = output['simConfig']
+    vsoma = np.array(output['simData']['V_soma']['cell_' + str(cellID)])
+    return batch_analysis.meas_trace_features(vsoma, recstep=simConfig['recordStep'], syntime=simConfig['synTime'])
+
+
+def feature_scales(expFeatures, weights):
+    """Returns the error scale of each feature: its spread across the
+    experimental traces (or 1 if it doesn't vary)."""
+
+    scales = {}
+    for feature in weights:
+        spread = np.std([features[feature] for features in expFeatures])
+        scales[feature] = spread if spread > 0 else 1.0
+    return scales
+
+
+def score_features(simFeatures, expFeatures, weights, scales):
+    """Returns the weighted mean squared scaled error between simulated and
+    experimental features over all stimulus levels."""
+
+    errors = []
+    for simLevel, expLevel in zip(simFeatures, expFeatures):
+        for feature, weight in weights.iteritems():
+            errors.append(weight * ((simLevel[feature] - expLevel[feature]) / scales[feature]) ** 2)
+    return float(np.sum(errors) / sum(weights.values()) / len(expFeatures))
+
+
+def run_fit(label, ranges, cfgFile, netParamsFile, batchdatadir="batch_data", fitCfg=None, runCfg=None):
+    """Fits the params in ranges (label: [min, max]) to the experimental
+    features.  Candidates run as local processes (runCfg 'cores', 'timeout',
+    'script', 'nrnCommand' as in batch_utils.run_pool).  Every evaluated
+    candidate is appended to saveFolder/label_fit.jsonl.  Returns the best
+    (score, param values)."""
+
+    fitCfg = dict(fitDefaults, **(fitCfg or {}))
+    runCfg = dict(runCfg or {})
+    weights = OrderedDict(fitCfg['weights'])
+
+    expFeatures = batch_analysis.get_exp_features(fitCfg['expFile'])
+    stimValues = fitCfg['stimValues']
+    if stimValues is None or len(stimValues) != len(expFeatures):
+        raise Exception("batch_fit.run_fit: fitCfg['stimValues'] needs one value per experimental trace (%d)." % (len(expFeatures)))
+    scales = feature_scales(expFeatures, weights)
+
+    saveFolder = os.path.join(batchdatadir, label)
+    if not os.path.isdir(saveFolder):
+        os.makedirs(saveFolder)
+    netParamsSavePath = os.path.join(saveFolder, label + '_netParams.py')
+    shutil.copyfile(netParamsFile, netParamsSavePath)
+    resultsFile = os.path.join(saveFolder, label + '_fit.jsonl')
+
+    cfg = batch_utils.load_cfg(cfgFile)
+    cfg.checkErrors = False
+    state = fit_state(len(ranges), fitCfg['popSize'], fitCfg['elite'], fitCfg['sigmaMin'], fitCfg['seed'])
+    cores = runCfg.get('cores') or multiprocessing.cpu_count()
+    inFlight = int(np.ceil(float(cores) / len(stimValues))) + 1
+
+    candidates = {}
+    best = [(np.inf, None)]
+
+    def submit():
+        candidateID = len(candidates)
+        point = ask(state)
+        values = to_values(point, ranges, fitCfg['log'])
+        jobs = []
+        for level, stimValue in enumerate(stimValues):
+            for paramLabel, paramVal in values.iteritems():
+                batch_utils.set_cfg_param(cfg, paramLabel, paramVal)
+            batch_utils.set_cfg_param(cfg, fitCfg['stimParam'], stimValue)
+            simLabel = batch_utils.get_simLabel(label, (candidateID, level))
+            jobName = os.path.join(saveFolder, simLabel)
+            cfg.simLabel = simLabel
+            cfg.saveFolder = saveFolder
+            cfg.save(jobName + '_cfg.json')
+            jobs.append({'simLabel': simLabel, 'jobName': jobName, 'cfgFile': jobName + '_cfg.json',
+                         'netParamsFile': netParamsSavePath, 'candidate': candidateID, 'level': level})
+        candidates[candidateID] = {'point': point, 'values': values, 'remaining': len(jobs),
+                                   'features': [None] * len(stimValues), 'failed': False}
+        return jobs
+
+    def on_done(job, status):
+        candidate = candidates[job['candidate']]
+        candidate['remaining'] -= 1
+        if status == 'done':
+            try:
+                candidate['features'][job['level']] = sim_features(job['jobName'], fitCfg['cellID'])
+            except (IOError, ValueError, KeyError):
+                candidate['failed'] = True
+            if not fitCfg['keepOutput'] and os.path.isfile(job['jobName'] + '.json'):
+                os.remove(job['jobName'] + '.json')
+        else:
+            candidate['failed'] = True
+        if candidate['remaining'] > 0:
+            return []
+
+        if candidate['failed']:
+            score = np.inf
+        else:
+            score = score_features(candidate['features'], expFeatures, weights, scales)
+        tell(state, candidate['point'], score)
+        if score < best[0][0]:
+            best[0] = (score, candidate['values'])
+        with open(resultsFile, 'a') as fileObj:
+            fileObj.write(json.dumps({'candidate': job['candidate'], 'score': score if np.isfinite(score) else None,
+                                      'values': candidate['values'], 'features': candidate['features']},
+                                     default=batch_utils.json_default) + '\n')
+        print("Candidate %d: score %.4g (best %.4g)" % (job['candidate'], score, best[0][0]))
+
+        if len(candidates) < fitCfg['evaluations']:
+            return submit()
+        return []
+
+    jobs = []
+    for i in range(min(inFlight, fitCfg['evaluations'])):
+        jobs.extend(submit())
+    print("Fitting %d params to %s: %d evaluations of %d simulations on %d cores" % (len(ranges),
+          fitCfg['expFile'], fitCfg['evaluations'], len(stimValues), cores))
+    batch_utils.run_jobs(jobs, cores=cores, timeout=runCfg.get('timeout'),
+                         script=runCfg.get('script', 'batch_init.py'),
+                         nrnCommand=runCfg.get('nrnCommand', 'nrniv'), callback=on_done)
+    return best[0]
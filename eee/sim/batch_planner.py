@@ -0,0 +1,255 @@
+"""
+batch_planner.py
+Predicts the wall time, memory and disk footprint of a proposed set of
+batches (a my_batches.py batches dict) before launching it, and how many
+workers are worth using.  Each job is described by the model netParams.py
+builds for it: compartments, mechanism instances (compartments x inserted
+mechanisms), synapses, time steps (duration/dt) and recorded trace samples.
+The cost model is fitted to the metrics of past runs (batch_telemetry);
+without any, rough defaults are used.
+Usage (from a batch directory): python <eee/sim>/batch_planner.py [batchLabel ...]
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import multiprocessing
+import os
+import sys
+import numpy as np
+import batch_utils
+import batch_telemetry
+
+# model: target: (feature names, coefficients).  Features are products of the
+# job description; 'one' is the intercept.
+costFeatures = OrderedDict([
+    ('runSim', ['one', 'compartmentSteps', 'mechanismSteps', 'synapseSteps']),  # s
+    ('other',  ['one', 'compartments', 'traceSamples']),                        # s, all other phases
+    ('memory', ['one', 'compartments', 'traceSamples']),                        # MB peak RSS
+    ('disk',   ['one', 'compartments', 'traceSamples']),                        # MB output
+])
+
+# rough defaults for an uncalibrated model
+defaultModel = OrderedDict([
+    ('runSim', [0.5, 2e-7, 1e-7, 1e-7]),
+    ('other',  [5.0, 1e-3, 1e-6]),
+    ('memory', [150.0, 0.02, 3e-5]),
+    ('disk',   [0.1, 1e-3, 2e-5]),
+])
+
+
+def netParams_features(netParams, cfg, pops=None):
+    """Returns the description (see module doc) of a simulation of the given
+    populations (default: all) of a built netParams, without instantiating
+    any cells."""
+
+    pops = pops or netParams.popParams.keys()
+    steps = cfg.duration / cfg.dt
+    features = OrderedDict([('cells', 0), ('compartments', 0), ('mechanisms', 0), ('synapses', 0)])
+    for popLabel in pops:
+        pop = netParams.popParams[popLabel]
+        numCells = pop.get('numCells', 1)
+        features['cells'] += numCells
+        for cellParams in netParams.cellParams.itervalues():
+            if all(pop.get(k) == v for k, v in cellParams.get('conds', {}).iteritems()):
+                for sec in cellParams['secs'].itervalues():
+                    nseg = sec.get('geom', {}).get('nseg', 1)
+                    features['compartments'] += numCells * nseg
+                    features['mechanisms'] += numCells * nseg * len(sec.get('mechs', {}))
+        for target in netParams.stimTargetParams.itervalues():
+            conds = target.get('conds', {})
+            targetPops = conds.get('pop', conds.get('popLabel'))
+            if targetPops == popLabel or (isinstance(targetPops, list) and popLabel in targetPops):
+                synMechs = target.get('synMech', [])
+                numSynMechs = len(synMechs) if isinstance(synMechs, list) else 1
+                features['synapses'] += numCells * target.get('synsPerConn', 1) * numSynMechs
+
+    features['steps'] = steps
+    features['traceSamples'] = features['cells'] * len(cfg.recordTraces) * cfg.duration / cfg.recordStep
+    return features
+
+
+def design_row(features, names):
+    """Returns the feature values named in costFeatures for a job or metrics
+    record."""
+
+    steps = features['steps']
+    values = {'one': 1.0, 'compartments': features['compartments'], 'traceSamples': features['traceSamples'],
+              'compartmentSteps': features['compartments'] * steps, 'mechanismSteps': features['mechanisms'] * steps,
+              'synapseSteps': features['synapses'] * steps}
+    return [values[name] for name in names]
+
+
+def fit_nonneg(X, y):
+    """Least squares fit of y ~ X with non-negative coefficients: the most
+    negative coefficient's column is dropped until none is left."""
+
+    coefs = np.zeros(X.shape[1])
+    active = range(X.shape[1])
+    while active:
+        solution = np.linalg.lstsq(X[:, active], y, rcond=None)[0]
+        if np.all(solution >= 0):
+            coefs[active] = solution
+            break
+        del active[int(np.argmin(solution))]
+    return coefs
+
+
+def calibrate(batchLabels=None, batchdatadir=batch_telemetry.batchdatadir, show=True):
+    """Returns a cost model ({'model': target: coefficients, 'records': n})
+    fitted to the metrics of past batches (default: all in batchdatadir).
+    Records from before the size fields were added, and (for runSim) CVODE
+    or multithreaded runs, are left out.  Targets with too few records keep
+    their defaultModel coefficients."""
+
+    if batchLabels is None:
+        batchLabels = sorted(label for label in os.listdir(batchdatadir)
+                             if os.path.isfile(batch_telemetry.metrics_file(os.path.join(batchdatadir, label))))
+    records = [record for batchLabel in batchLabels for record in batch_telemetry.load_metrics(batchLabel, batchdatadir)
+               if 'mechanisms' in record]
+
+    model = OrderedDict((target, list(coefs)) for target, coefs in defaultModel.iteritems())
+    for target, names in costFeatures.iteritems():
+        rows, values = [], []
+        for record in records:
+            phases = record['phases']
+            features = dict(record, steps=record['duration'] / record['dt'])
+            if target == 'runSim':
+                if 'runSim' not in phases or record['cvode_active'] or record['nthreads'] != 1:
+                    continue
+                value = phases['runSim']['wall']
+            elif target == 'other':
+                value = sum(phase['wall'] for label, phase in phases.iteritems() if label != 'runSim')
+            elif target == 'memory':
+                value = max(phase['peakRSS'] for phase in phases.itervalues())
+            else:
+                value = record['outputBytes'] / 1e6
+            rows.append(design_row(features, names))
+            values.append(value)
+        if len(rows) > len(names):
+            model[target] = list(fit_nonneg(np.array(rows, dtype=float), np.array(values, dtype=float)))
+
+    if show:
+        print("Cost model from %d metrics records%s" % (len(records), "" if records else " (defaults)"))
+    return {'model': model, 'records': len(records)}
+
+
+def predict(model, features):
+    """Returns an OrderedDict of predicted 'wall' (s), 'memory' (MB) and
+    'disk' (MB) for a job description."""
+
+    prediction = OrderedDict()
+    values = dict((target, float(np.dot(design_row(features, names), model['model'][target])))
+                  for target, names in costFeatures.iteritems())
+    prediction['wall'] = values['runSim'] + values['other']
+    prediction['memory'] = values['memory']
+    prediction['disk'] = values['disk']
+    return prediction
+
+
+def makespan(walls, workers):
+    """Returns the finish time of jobs run longest first on workers workers."""
+    loads = np.zeros(workers)
+    for wall in sorted(walls, reverse=True):
+        loads[np.argmin(loads)] += wall
+    return loads.max() if len(walls) else 0.0
+
+
+def physical_memory():
+    """Returns the physical memory of this machine in MB (None if unknown)."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e6
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def batch_jobs(batch, runCfg=None, batchdatadir=batch_utils.batchdatadir):
+    """Returns a list of (simLabel, features, done) for the jobs of a
+    my_batches.py batch dict, building its netParams for every grid point
+    (with the cell rules imported once per batch).
+    Adaptive batches are planned as their initial grid."""
+
+    b = batch_utils.batch_object(batch, runCfg=runCfg, batchdatadir=batchdatadir)
+    cfg = batch_utils.load_cfg(b.cfgFile)
+    cfg.checkErrors = False
+    splitPops = b.runCfg.get('splitPops')
+    labels, combs = batch_utils.grid_combinations(b.params)
+    stored = batch_utils.stored_done(b)
+    cellRules = {}
+    jobs = []
+    for iComb, pComb in combs:
+        for paramLabel, paramVal in zip(labels, pComb):
+            batch_utils.set_cfg_param(cfg, paramLabel, paramVal)
+        simLabel = batch_utils.get_simLabel(b.batchLabel, iComb)
+        done = os.path.isfile(os.path.join(b.saveFolder, simLabel + '.json')) or simLabel in stored
+        if splitPops:
+            cfg.pops = list(splitPops)
+        netParams = batch_utils.load_netParams(b.netParamsFile, cfg, cellRules)
+        if splitPops:
+            for pop in splitPops:
+                jobs.append((simLabel + '_' + pop, netParams_features(netParams, cfg, [pop]), done))
+        else:
+            jobs.append((simLabel, netParams_features(netParams, cfg), done))
+    return jobs
+
+
+def plan(batches, runCfg=None, batchdatadir=batch_utils.batchdatadir, model=None, cores=None, memory=None, show=True):
+    """Predicts the cost of running batches (a list of my_batches.py batch
+    dicts) and the number of workers worth using: the fewest that finish
+    within 5% of the time all usable workers would take, where usable is
+    limited by cores (default: this machine's), memory (MB, default: 80% of
+    this machine's) over the largest job's peak memory, and the number of
+    jobs.  Grid points with an output already in saveFolder are not counted.
+    Returns an OrderedDict with the per-job predictions and totals."""
+
+    runCfg = dict(runCfg or {})
+    model = model or calibrate(batchdatadir=batchdatadir, show=show)
+    cores = cores or runCfg.get('cores') or multiprocessing.cpu_count()
+    if memory is None and physical_memory():
+        memory = 0.8 * physical_memory()
+
+    jobs = OrderedDict()
+    skipped = 0
+    for batch in batches:
+        for simLabel, features, done in batch_jobs(batch, runCfg, batchdatadir):
+            if done:
+                skipped += 1
+                continue
+            jobs[simLabel] = dict(predict(model, features), compartments=features['compartments'])
+
+    walls = [job['wall'] for job in jobs.itervalues()]
+    maxMemory = max([job['memory'] for job in jobs.itervalues()] or [0.0])
+    usable = max(1, min(cores, len(jobs) or 1, int(memory / maxMemory) if memory and maxMemory else cores))
+    best = makespan(walls, usable)
+    workers = next(w for w in range(1, usable + 1) if makespan(walls, w) <= 1.05 * best)
+
+    result = OrderedDict()
+    result['jobs'] = jobs
+    result['skipped'] = skipped
+    result['cpuTime'] = sum(walls)
+    result['disk'] = sum(job['disk'] for job in jobs.itervalues())
+    result['maxMemory'] = maxMemory
+    result['workers'] = workers
+    result['wallTime'] = makespan(walls, workers)
+    result['calibrated'] = model['records'] > 0
+
+    if show:
+        print("%-40s %8s %10s %10s %10s" % ("job", "cmps", "wall(s)", "mem(MB)", "disk(MB)"))
+        for simLabel, job in jobs.iteritems():
+            print("%-40s %8d %10.1f %10.1f %10.2f" % (simLabel, job['compartments'], job['wall'], job['memory'], job['disk']))
+        print
+        print("Jobs to run       : %d (%d already done)" % (len(jobs), skipped))
+        print("Total CPU time    : %.1f min" % (result['cpuTime'] / 60.0))
+        print("Total disk        : %.1f MB" % (result['disk']))
+        print("Max job memory    : %.1f MB" % (maxMemory))
+        print("Workers           : %d of %d usable (wall time %.1f min)" % (workers, usable, result['wallTime'] / 60.0))
+        if not result['calibrated']:
+            print("(uncalibrated: run some batches to collect metrics)")
+    return result
+
+
+if __name__ == '__main__':
+
+    sys.path.insert(0, os.getcwd())
+    from my_batches import batches, batchoutputdir, runCfg
+    labels = sys.argv[1:] or batches.keys()
+    plan([batches[label] for label in labels], runCfg=runCfg, batchdatadir=batchoutputdir)
@@ -0,0 +1,260 @@
+"""
+batch_queue.py
+A work queue of batch grid points kept as lock files in saveFolder/queue/,
+so any number of workers on any machine that mounts the batch directory can
+pull grid points from the same batch, and a workstation can join a running
+sweep.  For each grid point (simLabel) the queue holds:
+    simLabel.job      : the job dict (from batch_utils.write_batch_jobs)
+    simLabel.lease    : held by the worker running it; renewed while it runs,
+                        and taken over by another worker once it expires
+    simLabel.attemptN : one per lease taken (N = 1, 2, ...), each created
+                        exclusively so concurrent counts can't collide
+    simLabel.done     : written once its output is in place
+    simLabel.failed   : written when it has used up its attempts
+Outputs are renamed into place when complete (batch_sim.save_data), so a
+grid point that runs twice (e.g. on a lease taken over from a slow worker)
+just replaces its output.  Lease expiry compares file times between hosts,
+so their clocks should agree to well within leaseTime.
+
+Usage (from the batch directory on the shared filesystem):
+    runCfg = {'type': 'queue', 'cores': 8}       # my_batches.py: queue the batch and work on it
+    python <eee/sim>/batch_queue.py batch_data/<label> [cores]   # on another machine: join it
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import errno
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import batch_utils
+
+queueDefaults = {
+    'leaseTime'   : 300.0,  # seconds without renewal before a lease can be taken over
+    'maxAttempts' : 3,      # leases per grid point before it is marked failed
+    'wait'        : True,   # keep polling until no grid point is pending or leased
+    'idlePoll'    : 10.0,   # seconds between polls when there's nothing to claim
+}
+
+
+def queue_dir(saveFolder):
+    """Returns the queue directory of the batch saved in saveFolder."""
+    return os.path.join(saveFolder, 'queue')
+
+
+def worker_id():
+    """Returns a name for this worker process, unique across hosts."""
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def write_atomic(filename, text):
+    """Writes a file under a temporary name and renames it into place."""
+    tmpName = '%s.tmp-%s' % (filename, worker_id())
+    with open(tmpName, 'w') as fileObj:
+        fileObj.write(text)
+    os.rename(tmpName, filename)
+
+
+def remove(filename):
+    """Removes a file if it exists."""
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def enqueue(b):
+    """Writes the job files (batch_utils.write_batch_jobs) of a netpyne Batch
+    and queues them.  Queued grid points lose any done, failed or attempts
+    record, so enqueueing a batch again reruns what it lists.  Returns the
+    list of jobs."""
+
+    jobs = batch_utils.write_batch_jobs(b)
+    queueDir = queue_dir(b.saveFolder)
+    if not os.path.isdir(queueDir):
+        os.makedirs(queueDir)
+    for job in jobs:
+        path = os.path.join(queueDir, job['simLabel'])
+        for filename in [path + '.done', path + '.failed'] + glob.glob(path + '.attempt[0-9]*'):
+            remove(filename)
+        write_atomic(path + '.job', json.dumps(job, default=batch_utils.json_default))
+    print("Queued %d jobs in %s" % (len(jobs), queueDir))
+    return jobs
+
+
+def job_state(queueDir, simLabel, leaseTime=queueDefaults['leaseTime']):
+    """Returns 'done', 'failed', 'leased', 'expired' or 'pending'."""
+
+    path = os.path.join(queueDir, simLabel)
+    if os.path.isfile(path + '.done'):
+        return 'done'
+    if os.path.isfile(path + '.failed'):
+        return 'failed'
+    try:
+        age = time.time() - os.path.getmtime(path + '.lease')
+    except OSError:
+        return 'pending'
+    return 'leased' if age < leaseTime else 'expired'
+
+
+def queue_status(saveFolder, leaseTime=queueDefaults['leaseTime']):
+    """Returns an OrderedDict of simLabel: job_state for a queued batch."""
+
+    queueDir = queue_dir(saveFolder)
+    simLabels = sorted(filename[:-len('.job')] for filename in os.listdir(queueDir) if filename.endswith('.job'))
+    return OrderedDict((simLabel, job_state(queueDir, simLabel, leaseTime)) for simLabel in simLabels)
+
+
+def count_attempt(path):
+    """Records a lease of a grid point as its next .attemptN file, created
+    with O_EXCL so workers counting at the same time can't lose an update,
+    and returns N."""
+
+    attempts = 1
+    while True:
+        try:
+            os.close(os.open('%s.attempt%d' % (path, attempts), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            attempts += 1
+            continue
+        return attempts
+
+
+def claim(queueDir, simLabel, leaseTime=queueDefaults['leaseTime'], maxAttempts=queueDefaults['maxAttempts'], worker=None):
+    """Tries to lease a grid point.  An expired lease is first moved aside by
+    rename, which only one worker can do; if it turns out to have been
+    renewed meanwhile, it is linked back, which fails rather than replace a
+    lease another worker has created since.  Returns True if this worker now
+    holds the lease."""
+
+    worker = worker or worker_id()
+    path = os.path.join(queueDir, simLabel)
+    lease = path + '.lease'
+    state = job_state(queueDir, simLabel, leaseTime)
+    if state in ['done', 'failed', 'leased']:
+        return False
+    if state == 'expired':
+        expired = lease + '.' + worker
+        try:
+            os.rename(lease, expired)
+        except OSError:
+            return False
+        if time.time() - os.path.getmtime(expired) < leaseTime:
+            # renewed since we looked: put it back unless there's a new lease
+            try:
+                os.link(expired, lease)
+            except OSError:
+                pass
+            os.remove(expired)
+            return False
+        os.remove(expired)
+
+    try:
+        fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError:
+        return False
+    try:
+        os.write(fd, json.dumps({'worker': worker, 'time': time.time()}))
+    finally:
+        os.close(fd)
+
+    attempts = count_attempt(path)
+    if attempts > maxAttempts:
+        write_atomic(path + '.failed', json.dumps({'worker': worker, 'time': time.time(), 'attempts': attempts - 1}))
+        remove(lease)
+        print("Job %s failed %d times, giving up" % (simLabel, attempts - 1))
+        return False
+    return True
+
+
+def release(queueDir, simLabel, done):
+    """Gives up a lease, marking the grid point done if its output is in place
+    (otherwise it will be retried)."""
+
+    path = os.path.join(queueDir, simLabel)
+    if done:
+        write_atomic(path + '.done', json.dumps({'worker': worker_id(), 'time': time.time()}))
+    remove(path + '.lease')
+
+
+def renew_leases(queueDir, held, stop, interval):
+    """Touches the leases in held every interval seconds until stop is set."""
+
+    while not stop.wait(interval):
+        for simLabel in list(held):
+            try:
+                os.utime(os.path.join(queueDir, simLabel + '.lease'), None)
+            except OSError:
+                pass
+
+
+def run_worker(saveFolder, cores=None, timeout=None, script='batch_init.py', nrnCommand='nrniv', queueCfg=None):
+    """Leases and runs grid points of a queued batch (see enqueue) as local
+    processes (as batch_utils.run_jobs), cores at a time, until none is left
+    to claim (with queueCfg['wait'], until none is pending or leased anywhere,
+    so grid points of crashed workers are retried).  Returns queue_status."""
+
+    queueCfg = dict(queueDefaults, **(queueCfg or {}))
+    queueDir = queue_dir(saveFolder)
+    cores = cores or multiprocessing.cpu_count()
+    worker = worker_id()
+    held = set()
+    stop = threading.Event()
+    renewer = threading.Thread(target=renew_leases, args=(queueDir, held, stop, queueCfg['leaseTime'] / 3.0))
+    renewer.daemon = True
+    renewer.start()
+
+    def next_jobs(count):
+        jobs = []
+        for simLabel, state in queue_status(saveFolder, queueCfg['leaseTime']).iteritems():
+            if len(jobs) >= count:
+                break
+            if state in ['pending', 'expired'] and claim(queueDir, simLabel, queueCfg['leaseTime'], queueCfg['maxAttempts'], worker):
+                held.add(simLabel)
+                with open(os.path.join(queueDir, simLabel + '.job'), 'r') as fileObj:
+                    jobs.append(json.load(fileObj))
+        return jobs
+
+    def on_done(job, status):
+        done = status == 'done' and batch_utils.job_done(job)
+        release(queueDir, job['simLabel'], done)
+        held.discard(job['simLabel'])
+        return next_jobs(1)
+
+    print("Worker %s joining %s with %d cores" % (worker, queueDir, cores))
+    try:
+        while True:
+            jobs = next_jobs(cores)
+            if jobs:
+                batch_utils.run_jobs(jobs, cores=cores, timeout=timeout, script=script,
+                                     nrnCommand=nrnCommand, callback=on_done)
+                continue
+            states = queue_status(saveFolder, queueCfg['leaseTime']).values()
+            if not queueCfg['wait'] or not any(state in ['pending', 'leased', 'expired'] for state in states):
+                break
+            time.sleep(queueCfg['idlePoll'])
+    finally:
+        stop.set()
+        for simLabel in list(held):
+            release(queueDir, simLabel, False)
+
+    status = queue_status(saveFolder, queueCfg['leaseTime'])
+    counts = OrderedDict((state, status.values().count(state)) for state in ['done', 'failed', 'leased', 'expired', 'pending'])
+    print("Queue %s: %s" % (queueDir, ", ".join("%d %s" % (count, state) for state, count in counts.iteritems())))
+    return status
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    if not args:
+        print("Usage: python batch_queue.py saveFolder [cores]")
+        sys.exit(1)
+    run_worker(args[0], cores=int(args[1]) if len(args) > 1 else None)
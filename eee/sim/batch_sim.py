@@ -0,0 +1,797 @@
+"""
+batch_sim.py
+In-process control of EEE simulations: build the model once, then apply
+runtime parameter changes to the instantiated NEURON objects and run.
+contact: joe.w.graham@gmail.com
+"""
+
+from netpyne import sim
+from collections import OrderedDict
+import multiprocessing
+import os
+import sys
+import imp
+import glob
+import json
+import socket
+import time
+import traceback
+import batch_utils
+import batch_telemetry
+from batch_telemetry import phase
+
+
+###############################################################################
+# Runtime ("hot") parameters
+# --------------------------
+# hotParams maps cfg keys that can be changed on an instantiated model to the
+# updater that pushes the new value to the NEURON objects.  rebuildParams
+# lists keys known to change cell structure or cellParams; they (and any key
+# not in hotParams) require the network to be rebuilt.
+###############################################################################
+
+hotParams = {
+    'glutAmp'           : 'netstims',
+    'glutAmpExSynScale' : 'netstims',
+    'glutAmpDecay'      : 'netstims',
+    'synLocMiddle'      : 'netstims',
+    'synLocRadius'      : 'netstims',
+    'initDelay'         : 'netstims',
+    'synDelay'          : 'netstims',
+    'exSynDelay'        : 'netstims',
+    'NMDAgmax'          : 'synmechs',
+    'ratioAMPANMDA'     : 'synmechs',
+    'NMDAAlphaScale'    : 'synmechs',
+    'NMDABetaScale'     : 'synmechs',
+    'CdurNMDAScale'     : 'synmechs',
+    'e_pas'             : 'epas',
+}
+
+# hot params that only act through the synaptic input, which starts at
+# cfg.synTime, without moving synapses: grid points that differ only in these
+# can share the pre-stimulus part of the run (see run_prestim)
+warmParams = ['glutAmp', 'glutAmpExSynScale', 'glutAmpDecay', 'initDelay', 'synDelay', 'exSynDelay',
+              'NMDAgmax', 'ratioAMPANMDA', 'NMDAAlphaScale', 'NMDABetaScale', 'CdurNMDAScale']
+
+rebuildParams = ['numSyns', 'numExSyns', 'synTime', 'apicalDiam', 'basalDiam',
+                 'dendNaScale', 'dendKScale', 'dendCaScale', 'allNaScale', 'allKScale',
+                 'allCaScale', 'ihScale', 'RaScale', 'RmScale', 'gpasSomaScale',
+                 'dendRaScale', 'dendRmScale', 'duration', 'dt', 'recordTraces']
+
+
+def update_netstims():
+    """Recomputes NetStim synapse locations, weights and delays from sim.cfg
+    and applies them to the existing NetCons and synapses."""
+
+    cfg = sim.cfg
+    for nslabel in [k for k in dir(cfg) if k.startswith('NetStim')]:
+        ns = getattr(cfg, nslabel, None)
+        for cell in sim.net.cells:
+            pop = cell.tags['pop']
+            if pop not in ns['pop']:
+                continue
+            sec = cell.secs[ns['sec']]
+            locs, weights, delays = batch_utils.netstim_syns(cfg, nslabel, sec['hSec'].L)
+
+            for synMech in ns['synMech']:
+                target = sim.net.params.stimTargetParams.get(nslabel + '_' + pop + '_' + synMech)
+                if target is not None:
+                    target['loc'], target['weight'], target['delay'] = list(locs), list(weights), list(delays)
+
+                conns = [conn for conn in cell.conns if conn.get('preLabel') == nslabel and conn['synMech'] == synMech]
+                for conn, loc, weight, delay in zip(conns, locs, weights, delays):
+                    conn['hNetcon'].weight[0] = weight
+                    conn['hNetcon'].delay = delay
+                    conn['weight'] = weight
+                    conn['delay'] = delay
+                    if conn['loc'] != loc:
+                        syn = conn['hNetcon'].syn()
+                        syn.loc(sec['hSec'](loc))
+                        for secSynMech in sec.get('synMechs', []):
+                            if secSynMech['hSyn'] == syn:
+                                secSynMech['loc'] = loc
+                        conn['loc'] = loc
+
+
+def update_synmechs():
+    """Applies the synMechParams computed from sim.cfg to the existing synapses."""
+
+    synMechParams = batch_utils.synmech_params(sim.cfg)
+    for label, params in synMechParams.iteritems():
+        sim.net.params.synMechParams[label] = params
+
+    for cell in sim.net.cells:
+        for sec in cell.secs.itervalues():
+            for synMech in sec.get('synMechs', []):
+                if synMech['label'] in synMechParams:
+                    for paramName, paramVal in synMechParams[synMech['label']].iteritems():
+                        if paramName != 'mod':
+                            setattr(synMech['hSyn'], paramName, paramVal)
+
+
+def update_epas():
+    """Sets the passive reversal potential (and initial voltage) of every
+    section to sim.cfg.e_pas."""
+
+    e_pas = sim.cfg.e_pas
+    for cellParams in sim.net.params.cellParams.itervalues():
+        for secParams in cellParams['secs'].itervalues():
+            secParams['vinit'] = e_pas
+            if 'pas' in secParams['mechs']:
+                secParams['mechs']['pas']['e'] = e_pas
+
+    for cell in sim.net.cells:
+        for sec in cell.secs.itervalues():
+            sec['vinit'] = e_pas
+            if 'pas' in sec['mechs']:
+                sec['mechs']['pas']['e'] = e_pas
+                for seg in sec['hSec']:
+                    seg.pas.e = e_pas
+
+
+updaters = {'netstims': update_netstims,
+            'synmechs': update_synmechs,
+            'epas'    : update_epas}
+
+
+def split_params(labels):
+    """Splits param labels into those that can be applied to a built model
+    (hot) and those that require a rebuild."""
+    hot = [label for label in labels if not isinstance(label, (tuple, list)) and label in hotParams]
+    rebuild = [label for label in labels if label not in hot]
+    return hot, rebuild
+
+
+def apply_params(changes):
+    """Sets (label, value) pairs in sim.cfg and runs the updaters they need.
+    All labels must be hot params."""
+
+    needed = set()
+    for label, value in changes:
+        if label not in hotParams:
+            raise Exception("batch_sim.apply_params: " + str(label) + " requires rebuilding the network.")
+        batch_utils.set_cfg_param(sim.cfg, label, value)
+        needed.add(hotParams[label])
+    for updater in sorted(needed):
+        updaters[updater]()
+
+
+###############################################################################
+# Building and running
+###############################################################################
+
+def build_model(cfg, netParamsFile):
+    """Creates the network described by cfg and netParamsFile, with recording
+    set up, ready to run (the steps of batch_init.py before runSim)."""
+
+    import __main__
+    __main__.cfg = cfg  # netParams.py imports cfg from __main__
+    netParamsModuleName = os.path.basename(netParamsFile).split('.')[0]
+    with phase('loadParams'):
+        netParams = imp.load_source(netParamsModuleName, netParamsFile).netParams
+
+    with phase('initialize'):
+        sim.initialize(simConfig=cfg, netParams=netParams)
+    with phase('createPops'):
+        sim.net.createPops()
+    with phase('createCells'):
+        sim.net.createCells()
+    with phase('connectCells'):
+        sim.net.connectCells()
+    with phase('addStims'):
+        sim.net.addStims()
+    with phase('setupRecording'):
+        sim.setupRecording()
+
+
+# defaults for sim.cfg.earlyStop; None means the batch_analysis value: tol is
+# a quarter of batch_analysis.platthresh, so a stopped trace is well under the
+# half plateau amplitude above which meas_trace_plat_dur counts a sample
+earlyStopDefaults = {'trace': 'V_soma', 'tol': None, 'window': 50.0, 'interval': 10.0, 'stable': None, 'spikethresh': None}
+
+
+def early_stop_monitor(earlyStop):
+    """Returns a function for sim.runSimWithIntervalFunc that ends the run
+    (by setting sim.cfg.duration to the current time) once the earlyStop trace
+    of every cell has stayed within earlyStop['tol'] mV of its pre-stimulus
+    baseline for earlyStop['window'] ms after the last synaptic input.  The
+    baseline is the mean of the trace between earlyStop['stable'] and
+    sim.cfg.synTime with spikes clipped out, as batch_analysis measures it;
+    the baselines are kept in earlyStop['baselines'] (cellLabel: mV)."""
+
+    import numpy as np
+    import batch_analysis
+
+    recstep = sim.cfg.recordStep
+    trace = earlyStop['trace']
+    tol = batch_analysis.platthresh / 4.0 if earlyStop['tol'] is None else earlyStop['tol']
+    window = earlyStop['window']
+    stable = batch_analysis.stable if earlyStop['stable'] is None else earlyStop['stable']
+    spikethresh = batch_analysis.spikethresh if earlyStop['spikethresh'] is None else earlyStop['spikethresh']
+    delays = [conn.get('delay', 0.0) for cell in sim.net.cells for conn in cell.conns]
+    lastInput = sim.cfg.synTime + (max(delays) if delays else 0.0)
+    baselines = earlyStop.setdefault('baselines', {})
+
+    def returned(cellLabel, vtrace):
+        samples = np.array(vtrace)
+        if cellLabel not in baselines:
+            baseline = samples[int(stable / recstep):int(sim.cfg.synTime / recstep)]
+            baseline = batch_analysis.clip_trace_spikes(baseline, recstep=recstep, spikethresh=spikethresh)[0]
+            baselines[cellLabel] = float(np.mean(baseline))
+        last = samples[-int(window / recstep):]
+        return np.all(np.abs(last - baselines[cellLabel]) < tol)
+
+    def check(t):
+        if t < lastInput + window:
+            return
+        cellTraces = sim.simData.get(trace, {})
+        local = all(returned(cellLabel, vtrace) for cellLabel, vtrace in cellTraces.iteritems())
+        if sim.pc.allreduce(1 if local else 0, 3) == 1:  # 3: min over hosts
+            sim.cfg.duration = t
+
+    return check
+
+
+def early_stop_record(earlyStop, tstop, duration):
+    """Returns simData['earlyStop'] for a run that early_stop_monitor stopped
+    at tstop ms of duration: the times, the recorded traces and the
+    monitored trace's baselines, for batch_utils.pad_truncated."""
+    return {'tstop': tstop, 'duration': duration, 'traces': sim.cfg.recordTraces.keys(),
+            'trace': earlyStop['trace'], 'baselines': earlyStop.get('baselines', {})}
+
+
+def setup_cvode():
+    """Turns on CVODE if sim.cfg.cvode_active (otherwise the run is fixed
+    step), with absolute tolerance sim.cfg.cvode_atol (default: 1e-3) scaled
+    per state by sim.cfg.cvode_atolscale (state name: scale, e.g.
+    'NMDAeee.Ron', 'ca_cad'; see benchmark_cvode.py in batch_20180424)."""
+
+    from neuron import h
+
+    if not getattr(sim.cfg, 'cvode_active', False):
+        return
+    h.cvode.active(1)
+    h.cvode.atol(getattr(sim.cfg, 'cvode_atol', 1e-3))
+    for state, scale in getattr(sim.cfg, 'cvode_atolscale', {}).iteritems():
+        h.cvode.atolscale(state, scale)
+
+
+def setup_threads():
+    """Splits the cells over sim.cfg.nthreads threads with NEURON's multisplit
+    (via the ParallelComputeTool load balance), so one simulation uses
+    several cores.  All mechanisms in the model must be THREADSAFE (NEURON
+    stops with "... is not thread safe" otherwise; see benchmark_threads.py
+    in batch_20180424).  Multisplit only works with the fixed step method.
+    The time vector is recorded through a zero-amplitude IClamp in the
+    first cell, as NEURON can't put a record of t in a thread otherwise."""
+
+    from neuron import h
+
+    nthreads = int(getattr(sim.cfg, 'nthreads', 1))
+    if nthreads <= 1 or int(sim.pc.nthread()) == nthreads:
+        return
+    if getattr(sim.cfg, 'cvode_active', False):
+        raise Exception("batch_sim.setup_threads: cfg.nthreads > 1 (multisplit) can't be used with cfg.cvode_active.")
+    h.load_file("parcom.hoc")
+    parallelTool = h.ParallelComputeTool()
+    parallelTool.nthread(nthreads)
+    parallelTool.multisplit(1)
+    sim.cfg.cache_efficient = True  # multisplit needs it; sim.runSim sets it from cfg
+    if 't' in sim.simData and sim.net.cells:
+        sec = list(sim.net.cells[0].secs.values())[0]['hObj']
+        sim.net.cells[0].tRecorder = h.IClamp(sec(0.5))
+        sim.simData['t'].play_remove()
+        sim.simData['t'].record(sim.net.cells[0].tRecorder, h._ref_t, sim.cfg.recordStep)
+    print("Running on %d threads with multisplit" % (int(sim.pc.nthread())))
+
+
+def prestim_time(cfg):
+    """Returns the time the pre-stimulus part of a run ends: the last
+    recording step before cfg.synTime."""
+    return max(0.0, (int(round(cfg.synTime / cfg.recordStep)) - 1) * cfg.recordStep)
+
+
+def recording_vectors():
+    """Returns the trace Vectors of sim.simData (everything recorded with
+    Vector.record, i.e. all but the spike vectors)."""
+
+    vectors = []
+    for key, data in sim.simData.iteritems():
+        if key in ['spkt', 'spkid']:
+            continue
+        if isinstance(data, dict):
+            vectors.extend(value for value in data.itervalues() if hasattr(value, 'hname') and value.hname().startswith('Vector'))
+        elif hasattr(data, 'hname') and data.hname().startswith('Vector'):
+            vectors.append(data)
+    return vectors
+
+
+def run_prestim():
+    """Runs the built model up to prestim_time and saves its state there
+    (h.SaveState), with the traces and spikes recorded so far.  Runs of
+    this build that differ only in warmParams can then continue from it
+    (restore_prestim, then run_sim(warm=True)) instead of starting at 0."""
+
+    import numpy as np
+    from neuron import h
+
+    setup_cvode()
+    setup_threads()
+    duration = sim.cfg.duration
+    sim.cfg.duration = prestim_time(sim.cfg)
+    try:
+        sim.runSim()
+    finally:
+        sim.cfg.duration = duration
+    state = h.SaveState()
+    state.save()
+    return {'t': h.t, 'state': state, 'traces': [(vector, np.array(vector)) for vector in recording_vectors()],
+            'spkt': np.array(sim.simData['spkt']), 'spkid': np.array(sim.simData['spkid'])}
+
+
+def restore_prestim(prestim):
+    """Puts the built model back in a saved state (from run_prestim or
+    load_checkpoint): restores the states and event queue, restarts
+    recording (h.frecord_init) after the saved samples and sets the spikes
+    to the saved ones.  Call before apply_params."""
+
+    from neuron import h
+
+    prestim['state'].restore(0)
+    if h.cvode.active():
+        h.cvode.re_init()
+    h.frecord_init()  # each trace restarts with the sample at prestim['t']
+    for vector, samples in prestim['traces']:
+        vector.insrt(0, h.Vector(samples[:-1]))
+    for key in ['spkt', 'spkid']:
+        sim.simData[key].from_python(prestim[key])
+    for key in ['earlyStop', 'warmStart', 'resumedFrom']:
+        sim.simData.pop(key, None)
+
+
+###############################################################################
+# Checkpoints
+# -----------
+# With sim.cfg.checkpoint set, a run writes its state and recordings to
+# saveFolder/checkpoints/simLabel.* every checkpoint['every'] seconds of wall
+# time, and a rerun of the same simLabel (a retried pool job, a queue job
+# taken over from a dead worker) resumes from the last one.  save_data
+# removes them once the output is in place.  Only for single-process runs.
+###############################################################################
+
+checkpointDefaults = {'every': 300.0, 'interval': 50.0}  # s of wall time between checkpoints, ms between checks
+
+
+def checkpoint_file(cfg):
+    """Returns the checkpoint manifest of a run: a json file naming the
+    state and recordings files of its last checkpoint."""
+    return os.path.join(cfg.saveFolder, 'checkpoints', cfg.simLabel + '.json')
+
+
+def save_checkpoint():
+    """Writes a checkpoint of the running model: its state (h.SaveState, to
+    a file with h.File) and the traces and spikes recorded so far (npz).
+    The manifest is renamed into place last, so an interrupted write leaves
+    the previous checkpoint intact; its files are then removed."""
+
+    import numpy as np
+    from neuron import h
+
+    manifest = checkpoint_file(sim.cfg)
+    if not os.path.isdir(os.path.dirname(manifest)):
+        os.makedirs(os.path.dirname(manifest))
+    base = '%s_%d' % (manifest[:-len('.json')], int(round(h.t / sim.cfg.dt)))
+    state = h.SaveState()
+    state.save()
+    stateFile = h.File()
+    stateFile.wopen(base + '.state')
+    state.fwrite(stateFile)
+    stateFile.close()
+    arrays = dict(('trace_%d' % index, np.array(vector)) for index, vector in enumerate(recording_vectors()))
+    np.savez(base + '.npz', spkt=np.array(sim.simData['spkt']), spkid=np.array(sim.simData['spkid']), **arrays)
+
+    previous = read_checkpoint_manifest(manifest)
+    with open(manifest + '.tmp', 'w') as fileObj:
+        json.dump({'t': h.t, 'state': os.path.basename(base + '.state'), 'recordings': os.path.basename(base + '.npz'),
+                   'traces': len(arrays), 'time': time.time()}, fileObj)
+    os.rename(manifest + '.tmp', manifest)
+    if previous and previous['state'] != os.path.basename(base + '.state'):
+        for key in ['state', 'recordings']:
+            remove_file(os.path.join(os.path.dirname(manifest), previous[key]))
+
+
+def read_checkpoint_manifest(manifest):
+    """Returns the contents of a checkpoint manifest, or None."""
+    try:
+        with open(manifest, 'r') as fileObj:
+            return json.load(fileObj)
+    except (IOError, ValueError):
+        return None
+
+
+def remove_file(filename):
+    """Removes a file if it exists."""
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def load_checkpoint():
+    """Returns the last checkpoint of the run sim.cfg describes, in the
+    form restore_prestim takes, or None if there is none (or it doesn't fit
+    the built model)."""
+
+    import numpy as np
+    from neuron import h
+
+    manifest = checkpoint_file(sim.cfg)
+    contents = read_checkpoint_manifest(manifest)
+    if contents is None:
+        return None
+    folder = os.path.dirname(manifest)
+    vectors = recording_vectors()
+    if contents['traces'] != len(vectors):
+        print("Ignoring checkpoint %s: it has %d traces, the model records %d" % (manifest, contents['traces'], len(vectors)))
+        return None
+    state = h.SaveState()
+    stateFile = h.File()
+    stateFile.ropen(os.path.join(folder, contents['state']))
+    state.fread(stateFile)
+    stateFile.close()
+    recordings = np.load(os.path.join(folder, contents['recordings']))
+    return {'t': contents['t'], 'state': state,
+            'traces': [(vector, recordings['trace_%d' % index]) for index, vector in enumerate(vectors)],
+            'spkt': recordings['spkt'], 'spkid': recordings['spkid']}
+
+
+def clear_checkpoint(cfg):
+    """Removes the checkpoint files of a run."""
+    manifest = checkpoint_file(cfg)
+    contents = read_checkpoint_manifest(manifest)
+    if contents:
+        for key in ['state', 'recordings']:
+            remove_file(os.path.join(os.path.dirname(manifest), contents[key]))
+    remove_file(manifest)
+
+
+def checkpoint_monitor(checkpoint):
+    """Returns a function for continue_run that writes a checkpoint (see
+    save_checkpoint) once checkpoint['every'] seconds have passed since the
+    last one."""
+
+    last = [time.time()]
+
+    def check(t):
+        if time.time() - last[0] >= checkpoint['every'] and t < sim.cfg.duration:
+            save_checkpoint()
+            last[0] = time.time()
+
+    return check
+
+
+def init_run():
+    """Initializes the built model for a run, as sim.runSim does before
+    integrating."""
+
+    from neuron import h
+
+    sim.preRun()
+    h.finitialize(float(sim.cfg.hParams['v_init']))
+
+
+def continue_run(interval=None, func=None):
+    """Runs the model from the current time to sim.cfg.duration without
+    initializing, calling func(t) every interval ms if given (as
+    sim.runSimWithIntervalFunc)."""
+
+    from neuron import h
+
+    h.tstop = sim.cfg.duration
+    sim.timing('start', 'runTime')
+    while round(h.t) < sim.cfg.duration:
+        sim.pc.psolve(min(sim.cfg.duration, h.t + interval) if interval else sim.cfg.duration)
+        if func is not None:
+            func(h.t)
+    sim.timing('stop', 'runTime')
+
+
+def run_sim(warm=False):
+    """Runs the built model, with CVODE if sim.cfg.cvode_active (see
+    setup_cvode) or on sim.cfg.nthreads threads (see setup_threads), and
+    stores the run's wall time in simData['runWallTime'].  With warm=True
+    the run continues from a restored pre-stimulus state (see run_prestim)
+    and simData['warmStart'] records the time it started from.  If
+    sim.cfg.checkpoint is set (and the run is neither warm nor under MPI),
+    checkpoints are written while it runs and it resumes from an earlier
+    one if there is any; simData['resumedFrom'] records the time.
+    sim.cfg.checkpoint options (True uses the defaults):
+        'every'    : s of wall time between checkpoints (default: 300)
+        'interval' : ms of simulated time between checks (default: 50)
+    If sim.cfg.earlyStop is set, the run ends once the soma has returned to
+    baseline (see early_stop_monitor) and simData['earlyStop'] records where
+    the traces were truncated, so batch_utils.readBatchData can pad them to
+    the full duration.
+    sim.cfg.earlyStop options:
+        'trace'    : trace to monitor (default: 'V_soma')
+        'tol'      : max deviation from baseline in mV (default: batch_analysis.platthresh / 4)
+        'window'   : ms the trace must stay within tol (default: 50)
+        'stable'   : ms before the baseline starts (default: batch_analysis.stable)
+        'spikethresh' : spikes clipped from the baseline (default: batch_analysis.spikethresh)
+        'interval' : ms between checks (default: 10)
+    earlyStop = True uses the defaults."""
+
+    from neuron import h
+
+    setup_cvode()
+    setup_threads()
+    start = time.time()
+    earlyStop = getattr(sim.cfg, 'earlyStop', None)
+    checkpoint = getattr(sim.cfg, 'checkpoint', None) if not warm and sim.nhosts == 1 else None
+
+    monitors = []
+    if earlyStop:
+        earlyStop = dict(earlyStopDefaults, **(earlyStop if isinstance(earlyStop, dict) else {}))
+    if checkpoint:
+        checkpoint = dict(checkpointDefaults, **(checkpoint if isinstance(checkpoint, dict) else {}))
+        init_run()
+        saved = load_checkpoint()
+        if saved is not None:
+            restore_prestim(saved)
+            sim.simData['resumedFrom'] = h.t
+            print("Resuming %s from its checkpoint at %.1f ms" % (sim.cfg.simLabel, h.t))
+        monitors.append((checkpoint['interval'], checkpoint_monitor(checkpoint)))
+    if warm:
+        sim.simData['warmStart'] = h.t
+    if earlyStop:
+        monitors.append((earlyStop['interval'], early_stop_monitor(earlyStop)))
+
+    def monitor(t):
+        for interval, func in monitors:
+            func(t)
+
+    duration = sim.cfg.duration
+    try:
+        if warm or checkpoint:
+            continue_run(min(interval for interval, func in monitors) if monitors else None, monitor)
+        elif earlyStop:
+            sim.runSimWithIntervalFunc(earlyStop['interval'], monitor)
+        else:
+            sim.runSim()
+        tstop = sim.cfg.duration
+    finally:
+        sim.cfg.duration = duration
+    sim.simData['runWallTime'] = time.time() - start
+    if tstop < duration:
+        print("Stopped early at %.1f ms of %.1f ms" % (tstop, duration))
+        sim.simData['earlyStop'] = early_stop_record(earlyStop, tstop, duration)
+
+
+def reset_recording():
+    """Clears the spike vectors so the model can be run again (trace vectors
+    are cleared by finitialize)."""
+    for key in ['spkt', 'spkid']:
+        if key in sim.simData:
+            sim.simData[key].resize(0)
+    for key in ['earlyStop', 'warmStart', 'resumedFrom']:
+        sim.simData.pop(key, None)
+
+
+def save_data():
+    """Saves the simulation output like sim.saveData, but under a temporary
+    name that is then renamed into place, so a reader never sees a partial
+    output file and a repeated run of the same grid point (e.g. by two queue
+    workers, see batch_queue) just replaces it.  Removes the run's
+    checkpoint, if any."""
+
+    filename = sim.cfg.filename
+    tmpName = '%s.tmp-%s-%d' % (filename, socket.gethostname(), os.getpid())
+    sim.saveData(filename=tmpName)
+    sim.cfg.filename = filename
+    if sim.rank == 0:
+        for tmpFile in glob.glob(tmpName + '.*'):
+            os.rename(tmpFile, filename + tmpFile[len(tmpName):])
+        if getattr(sim.cfg, 'checkpoint', None):
+            clear_checkpoint(sim.cfg)
+
+
+def run_and_save(simLabel, saveFolder, warm=False):
+    """Runs the built model (see run_sim) and saves its output as
+    saveFolder/simLabel.json and its phase metrics (see batch_telemetry)."""
+
+    sim.cfg.simLabel = simLabel
+    sim.cfg.saveFolder = saveFolder
+    sim.cfg.filename = os.path.join(saveFolder, simLabel)
+    with phase('runSim'):
+        run_sim(warm)
+    with phase('gatherData'):
+        sim.gatherData()
+    with phase('saveData'):
+        save_data()
+    with phase('plotData'):
+        sim.analysis.plotData()
+    batch_telemetry.save(sim)
+
+
+def hot_sweep(changesList, saveFolder=None, simLabel="hot_sweep"):
+    """Reruns the already built model (see build_model or instantiate.py) once
+    for each dict of hot param changes in changesList, without rebuilding.
+    Returns a list of simData dicts; if saveFolder is given, each run is also
+    saved as saveFolder/simLabel_i.json.
+    e.g. hot_sweep([{'glutAmp': amp} for amp in np.linspace(0.0, 2.0, 20)])"""
+
+    from copy import deepcopy
+
+    allSimData = []
+    for index, changes in enumerate(changesList):
+        apply_params(changes.items())
+        reset_recording()
+        if saveFolder is not None:
+            run_and_save(simLabel + "_" + str(index), saveFolder)
+        else:
+            run_sim()
+            sim.gatherData()
+        allSimData.append(deepcopy(sim.allSimData))
+    return allSimData
+
+
+def run_hot(b):
+    """Runs the grid points of a netpyne Batch in this process, on a single
+    model build, applying each grid point's hot params before re-running.
+    All batch params must be hot params.  With b.runCfg['warmStart'] and only
+    warmParams in the batch, the pre-stimulus part is run once and every
+    grid point continues from it (see run_prestim)."""
+
+    labels, combs = batch_utils.grid_combinations(b.params)
+    hotLabels, rebuildLabels = split_params(labels)
+    if rebuildLabels:
+        raise Exception("batch_sim.run_hot: params %s require a rebuild; use runCfg type 'fork' or 'pool'." % (str(rebuildLabels)))
+
+    jobs = batch_utils.write_batch_jobs(b)
+    if not jobs:
+        return
+    print("Running %d jobs in batch %s on one model build" % (len(jobs), b.batchLabel))
+
+    cfg = batch_utils.load_cfg(b.cfgFile)
+    cfg.checkErrors = False
+    if b.runCfg.get('checkpoint'):
+        cfg.checkpoint = b.runCfg['checkpoint']
+    for label, value in zip(labels, jobs[0]['paramValues']):
+        batch_utils.set_cfg_param(cfg, label, value)
+    build_model(cfg, b.netParamsFile)
+    warm = b.runCfg.get('warmStart') and all(label in warmParams for label in labels)
+    if b.runCfg.get('warmStart') and not warm:
+        print("Not warm starting: params %s change the pre-stimulus run" % (str([label for label in labels if label not in warmParams])))
+    if warm:
+        with phase('runPrestim'):
+            prestim = run_prestim()
+
+    current = dict(zip(labels, jobs[0]['paramValues']))
+    for job in jobs:
+        if warm:
+            restore_prestim(prestim)
+        else:
+            reset_recording()
+        values = dict(zip(labels, job['paramValues']))
+        apply_params([(label, values[label]) for label in labels if values[label] != current[label]])
+        current = values
+        run_and_save(job['simLabel'], b.saveFolder, warm)
+        batch_telemetry.reset()  # the model build is counted in the first job only
+
+
+def fork_call(func, *args):
+    """Runs func(*args) in a forked child process and returns its pid.  The
+    child exits with status 0 on success and 1 on error."""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            func(*args)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    return pid
+
+
+def wait_children(children, maxRunning=0):
+    """Waits until at most maxRunning of the children (pid: name) are still
+    running, removing finished ones.  Returns a dict of name: exit status."""
+
+    statuses = {}
+    while len(children) > maxRunning:
+        pid, status = os.wait()
+        if pid in children:
+            statuses[children.pop(pid)] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return statuses
+
+
+def run_forked(b):
+    """Runs the grid points of a netpyne Batch by building the model once per
+    distinct set of rebuild (non-hot) param values, then forking a child per
+    grid point that applies only the hot params that differ and runs.
+    b.runCfg['cores'] limits the simultaneous simulations (default: all
+    cores); with several builds, that many builders run at once (at most)
+    and share the cores.  With b.runCfg['warmStart'], builds are also split by the hot params not
+    in warmParams, and each builder runs the pre-stimulus part once before
+    forking, so its children only simulate from there (see run_prestim).
+    Returns an OrderedDict of simLabel: 'done' or 'failed', as
+    batch_utils.run_jobs does.  Cannot be used under MPI."""
+
+    from neuron import h
+
+    if int(h.ParallelContext().nhost()) > 1:
+        raise Exception("batch_sim.run_forked can't be used under MPI; run with python or nrniv -python.")
+
+    cores = b.runCfg.get('cores') or multiprocessing.cpu_count()
+    labels, combs = batch_utils.grid_combinations(b.params)
+    hotLabels, rebuildLabels = split_params(labels)
+    warm = bool(b.runCfg.get('warmStart'))
+    groupLabels = [label for label in labels if label not in warmParams] if warm else rebuildLabels
+    jobs = batch_utils.write_batch_jobs(b)
+
+    groups = OrderedDict()
+    for job in jobs:
+        values = dict(zip(labels, job['paramValues']))
+        groupKey = repr([values[label] for label in groupLabels])
+        groups.setdefault(groupKey, []).append(job)
+
+    numBuilders = max(1, min(cores, len(groups)))
+    groupCores = max(1, cores // numBuilders)
+    print("Running %d jobs in batch %s: %d model builds, %d cores" % (len(jobs), b.batchLabel, len(groups), cores))
+
+    def run_group(groupJobs):
+        cfg = batch_utils.load_cfg(b.cfgFile)
+        cfg.checkErrors = False
+        if b.runCfg.get('checkpoint'):
+            cfg.checkpoint = b.runCfg['checkpoint']
+        for label, value in zip(labels, groupJobs[0]['paramValues']):
+            batch_utils.set_cfg_param(cfg, label, value)
+        build_model(cfg, b.netParamsFile)
+        built = dict(zip(labels, groupJobs[0]['paramValues']))
+        if warm:
+            with phase('runPrestim'):
+                prestim = run_prestim()
+
+        def run_job(job, first):
+            # the build (and prestim) phases inherited from the builder are counted in its first job only
+            if not first:
+                batch_telemetry.reset()
+            if warm:
+                restore_prestim(prestim)
+            values = dict(zip(labels, job['paramValues']))
+            apply_params([(label, values[label]) for label in hotLabels if values[label] != built[label]])
+            run_and_save(job['simLabel'], b.saveFolder, warm)
+
+        children = {}
+        failed = []
+        for index, job in enumerate(groupJobs):
+            children[fork_call(run_job, job, index == 0)] = job['simLabel']
+            statuses = wait_children(children, maxRunning=groupCores-1)
+            failed.extend([name for name, status in statuses.iteritems() if status != 0])
+        statuses = wait_children(children)
+        failed.extend([name for name, status in statuses.iteritems() if status != 0])
+        if failed:
+            raise Exception("Jobs failed: " + ", ".join(failed))
+
+    builders = {}
+    failedGroups = []
+    for groupKey, groupJobs in groups.iteritems():
+        builders[fork_call(run_group, groupJobs)] = groupKey
+        statuses = wait_children(builders, maxRunning=numBuilders-1)
+        failedGroups.extend([key for key, status in statuses.iteritems() if status != 0])
+    statuses = wait_children(builders)
+    failedGroups.extend([key for key, status in statuses.iteritems() if status != 0])
+    for groupKey in failedGroups:
+        print("Model build or jobs failed for rebuild params: " + groupKey)
+
+    status = OrderedDict((job['simLabel'], 'done' if batch_utils.job_done(job) else 'failed') for job in jobs)
+    failed = [simLabel for simLabel, stat in status.iteritems() if stat != 'done']
+    if failed:
+        print("%d of %d jobs did not complete: %s" % (len(failed), len(status), ", ".join(failed)))
+    return status
@@ -0,0 +1,359 @@
+"""
+batch_store.py
+Binary trace store: the outputs of a batch packed into one uncompressed npz
+file, saveFolder/batchLabel_store.npz, instead of one json file per grid
+point.  Traces are typed arrays and everything else is kept as json:
+    meta           : json (batchLabel, params, simLabels and their grid rows,
+                     traces, cells, dtype)
+    traces         : (grid points, cells, traces, samples) array in
+                     grid_combinations order, NaN where absent
+    present        : (grid points, cells, traces) bool, what was recorded
+    lengths        : samples of each simulation
+    t              : time vector of the longest simulation
+    spkt, spkid    : all spikes, simulation i's from spkoffsets[i] to spkoffsets[i+1]
+    shared         : json of the rest of the first simulation's output (net,
+                     simConfig, netParams, other simData entries)
+    rest_<i>       : json patch turning shared into the rest of simulation i's
+                     output (see make_patch), so the network structure
+                     every grid point repeats is stored once
+batch_utils.readBatchData (and so load_batch and the batch_analysis
+functions) reads grid points from the store when their json file is absent.
+The traces member is memory-mapped (see trace_array), so the traces of a
+whole batch can be used without reading them into memory.
+Used by batch_utils.launch_batch with runCfg['store'].
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+import batch_utils
+
+storeDefaults = {
+    'dtype'    : 'float32',  # trace sample type
+    'keepJson' : False,      # keep the json outputs after packing them
+}
+
+
+def store_file(saveFolder, batchLabel):
+    """Returns the store file of a batch."""
+    return os.path.join(saveFolder, batchLabel + '_store.npz')
+
+
+def is_trace(value):
+    """Returns True if a simData entry is a recorded trace (cellLabel: samples)."""
+    return (isinstance(value, dict) and len(value) > 0 and
+            all(str(cellLabel).startswith('cell_') and isinstance(samples, (list, np.ndarray))
+                for cellLabel, samples in value.iteritems()))
+
+
+def split_output(output, dtype=storeDefaults['dtype']):
+    """Splits a simulation output into trace arrays, the time vector, the
+    spikes and the json of everything else."""
+
+    simData = output.get('simData', {})
+    piece = {'traces': OrderedDict(), 't': np.asarray(simData.get('t', []), dtype=float),
+             'spkt': np.asarray(simData.get('spkt', []), dtype=float),
+             'spkid': np.asarray(simData.get('spkid', []), dtype=float)}
+    rest = OrderedDict((key, value) for key, value in output.iteritems() if key != 'simData')
+    if 'simData' in output:
+        rest['simData'] = OrderedDict()
+        for key, value in simData.iteritems():
+            if key in ['t', 'spkt', 'spkid']:
+                continue
+            if is_trace(value):
+                piece['traces'][key] = OrderedDict((cellLabel, np.asarray(samples, dtype=dtype))
+                                                   for cellLabel, samples in value.iteritems())
+            else:
+                rest['simData'][key] = value
+    piece['rest'] = np.frombuffer(json.dumps(rest, default=batch_utils.json_default), dtype=np.uint8)
+    return piece
+
+
+def make_patch(base, value):
+    """Returns a json patch that turns base into value: None if they are
+    equal, {'~': key: patch, '-': removed keys} for two dicts, otherwise
+    {'=': value}."""
+
+    if isinstance(base, dict) and isinstance(value, dict):
+        changed = OrderedDict()
+        for key, item in value.iteritems():
+            patch = make_patch(base[key], item) if key in base else {'=': item}
+            if patch is not None:
+                changed[key] = patch
+        removed = [key for key in base if key not in value]
+        if not changed and not removed:
+            return None
+        return {'~': changed, '-': removed}
+    if type(base) == type(value) and base == value:
+        return None
+    return {'=': value}
+
+
+def apply_patch(base, patch):
+    """Returns base with a make_patch patch applied.  Parts the patch doesn't
+    change are shared with base, not copied."""
+
+    if patch is None:
+        return base
+    if '=' in patch:
+        return patch['=']
+    removed = set(patch['-'])
+    result = OrderedDict((key, item) for key, item in base.iteritems() if key not in removed)
+    for key, change in patch['~'].iteritems():
+        result[key] = apply_patch(base.get(key), change)
+    return result
+
+
+def write_store(filename, pieces, batch, rows, dtype=storeDefaults['dtype'], batchLabel=None):
+    """Writes a store from an OrderedDict of simLabel: split_output piece,
+    the batch's 'params' (and 'sampling') and the grid row of each piece,
+    under a temporary name that is then renamed into place."""
+
+    simLabels = pieces.keys()
+    traceLabels, cellLabels = [], []
+    for piece in pieces.itervalues():
+        for trace, cells in piece['traces'].iteritems():
+            if trace not in traceLabels:
+                traceLabels.append(trace)
+            cellLabels.extend(cellLabel for cellLabel in cells if cellLabel not in cellLabels)
+    cellLabels.sort(key=lambda cellLabel: int(cellLabel.split('_')[1]))
+    cellIndex = dict((cellLabel, index) for index, cellLabel in enumerate(cellLabels))
+
+    lengths = np.array([max([len(piece['t'])] + [len(samples) for cells in piece['traces'].itervalues()
+                                                 for samples in cells.itervalues()])
+                        for piece in pieces.itervalues()], dtype=int)
+    numSamples = int(lengths.max()) if len(lengths) else 0
+
+    numRows = len(batch_utils.grid_combinations(batch['params'])[1])
+
+    arrays = OrderedDict()
+    meta = {'batchLabel': batchLabel, 'params': batch['params'], 'sampling': batch.get('sampling'),
+            'simLabels': simLabels, 'rows': list(rows), 'traces': traceLabels, 'cells': cellLabels,
+            'dtype': str(np.dtype(dtype))}
+    arrays['meta'] = np.frombuffer(json.dumps(meta, default=batch_utils.json_default), dtype=np.uint8)
+    arrays['lengths'] = lengths
+    arrays['t'] = max([piece['t'] for piece in pieces.itervalues()] or [np.zeros(0)], key=len)
+    samples = np.full((numRows, len(cellLabels), len(traceLabels), numSamples), np.nan, dtype=dtype)
+    present = np.zeros(samples.shape[:3], dtype=bool)
+    for piece, row in zip(pieces.itervalues(), rows):
+        for traceIndex, trace in enumerate(traceLabels):
+            for cellLabel, values in piece['traces'].get(trace, {}).iteritems():
+                samples[row, cellIndex[cellLabel], traceIndex, :len(values)] = values
+                present[row, cellIndex[cellLabel], traceIndex] = True
+    arrays['traces'] = samples
+    arrays['present'] = present
+    arrays['spkt'] = np.concatenate([piece['spkt'] for piece in pieces.itervalues()] or [np.zeros(0)])
+    arrays['spkid'] = np.concatenate([piece['spkid'] for piece in pieces.itervalues()] or [np.zeros(0)])
+    arrays['spkoffsets'] = np.cumsum([0] + [len(piece['spkt']) for piece in pieces.itervalues()])
+    shared = json.loads(pieces.values()[0]['rest'].tostring(), object_pairs_hook=OrderedDict) if pieces else {}
+    arrays['shared'] = np.frombuffer(json.dumps(shared), dtype=np.uint8)
+    for index, piece in enumerate(pieces.itervalues()):
+        patch = make_patch(shared, json.loads(piece['rest'].tostring(), object_pairs_hook=OrderedDict))
+        arrays['rest_%d' % index] = np.frombuffer(json.dumps(patch), dtype=np.uint8)
+
+    tmpName = filename[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmpName, **arrays)
+    os.rename(tmpName, filename)
+
+
+def load_store(saveFolder, batchLabel):
+    """Opens the store of a batch, or returns None if it has none.  Arrays
+    are read on first use (store_array)."""
+
+    filename = store_file(saveFolder, batchLabel)
+    if not os.path.isfile(filename):
+        return None
+    npz = np.load(filename)
+    meta = json.loads(npz['meta'].tostring())
+    return {'file': filename, 'npz': npz, 'meta': meta, 'arrays': {},
+            'index': dict((simLabel, index) for index, simLabel in enumerate(meta['simLabels']))}
+
+
+def memmap_member(filename, name):
+    """Returns a read-only np.memmap of an array stored uncompressed in an npz
+    file (as np.savez writes them), or None if it is compressed."""
+
+    with zipfile.ZipFile(filename) as zipFile:
+        info = zipFile.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(filename, 'rb') as fileObj:
+        fileObj.seek(info.header_offset)
+        header = struct.unpack('<4s5H3I2H', fileObj.read(30))  # zip local file header
+        fileObj.seek(info.header_offset + 30 + header[-2] + header[-1])
+        version = np.lib.format.read_magic(fileObj)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(fileObj)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(fileObj)
+        offset = fileObj.tell()
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran else 'C')
+
+
+def store_array(store, name):
+    """Returns a member array of a store, reading it once (the traces are
+    memory-mapped instead)."""
+    if name not in store['arrays']:
+        array = memmap_member(store['file'], name) if name == 'traces' else None
+        store['arrays'][name] = array if array is not None else store['npz'][name]
+    return store['arrays'][name]
+
+
+def stored_simLabels(saveFolder, batchLabel):
+    """Returns the set of simLabels in the store of a batch."""
+    store = load_store(saveFolder, batchLabel)
+    return set(store['index']) if store is not None else set()
+
+
+def drop_simLabels(saveFolder, batchLabel, simLabels):
+    """Removes simulations (e.g. ones whose cache key has changed, see
+    batch_utils.prepare_cache) from the store of a batch, rewriting it, or
+    removing it if none are left.  Returns the number of simulations left."""
+
+    store = load_store(saveFolder, batchLabel)
+    if store is None:
+        return 0
+    dropped = set(simLabels) & set(store['index'])
+    if not dropped:
+        return len(store['index'])
+
+    pieces = OrderedDict()
+    rows = []
+    for simLabel, row in zip(store['meta']['simLabels'], store['meta']['rows']):
+        if simLabel not in dropped:
+            pieces[simLabel] = split_output(store_output(store, simLabel), store['meta']['dtype'])
+            rows.append(row)
+    if pieces:
+        write_store(store['file'], pieces, store['meta'], rows, store['meta']['dtype'], batchLabel)
+    else:
+        os.remove(store['file'])
+    print("Dropped %d simulations from %s" % (len(dropped), store['file']))
+    return len(pieces)
+
+
+def store_shared(store):
+    """Returns the decoded shared output part of a store, decoding it once."""
+    if 'shared' not in store:
+        store['shared'] = json.loads(store['npz']['shared'].tostring(), object_pairs_hook=OrderedDict)
+    return store['shared']
+
+
+def store_output(store, simLabel, vars=None):
+    """Returns the output of a stored simulation as readBatchData would load
+    it from json, with its traces, time vector and spikes as arrays (views
+    of the store arrays).  vars limits the top-level keys returned; only
+    those are patched from the shared part, and what a simulation doesn't
+    change is shared with the other simulations (treat it as read-only)."""
+
+    index = store['index'][simLabel]
+    rest = json.loads(store_array(store, 'rest_%d' % index).tostring(), object_pairs_hook=OrderedDict)
+    shared = store_shared(store)
+    patch = rest or {'~': {}, '-': []}
+    removed = set(patch['-'])
+    keys = [key for key in shared if key not in removed] + [key for key in patch['~'] if key not in shared]
+    output = OrderedDict((key, apply_patch(shared.get(key), patch['~'].get(key)))
+                         for key in keys if vars is None or key in vars)
+    if 'simData' in output:
+        simData = OrderedDict()
+        length = store_array(store, 'lengths')[index]
+        simData['t'] = store_array(store, 't')[:length]
+        row = store['meta']['rows'][index]
+        for traceIndex, trace in enumerate(store['meta']['traces']):
+            present = store_array(store, 'present')[row, :, traceIndex]
+            samples = store_array(store, 'traces')[row, :, traceIndex]
+            if present.any():
+                simData[trace] = OrderedDict((cellLabel, samples[cell, :length])
+                                             for cell, cellLabel in enumerate(store['meta']['cells']) if present[cell])
+        offsets = store_array(store, 'spkoffsets')
+        simData['spkt'] = store_array(store, 'spkt')[offsets[index]:offsets[index + 1]]
+        simData['spkid'] = store_array(store, 'spkid')[offsets[index]:offsets[index + 1]]
+        simData.update(output['simData'])
+        output['simData'] = simData
+    return output
+
+
+def pack_batch(saveFolder, batchLabel, dtype=storeDefaults['dtype'], keepJson=storeDefaults['keepJson']):
+    """Packs the json outputs of a batch (with early-stopped traces padded,
+    see batch_utils.pad_truncated) into its store, together with the grid
+    points already stored; a json output replaces a stored one.  Unless
+    keepJson, the packed json files are removed.  Returns the number of
+    simulations in the store."""
+
+    with open(os.path.join(saveFolder, batchLabel + '_batch.json'), 'r') as fileObj:
+        b = json.load(fileObj)['batch']
+    labels, combs = batch_utils.grid_combinations(b['params'])
+    store = load_store(saveFolder, batchLabel)
+
+    pieces = OrderedDict()
+    rows = []
+    packed = []
+    for row, (iComb, pComb) in enumerate(combs):
+        simLabel = batch_utils.get_simLabel(batchLabel, iComb)
+        outFile = os.path.join(saveFolder, simLabel + '.json')
+        if os.path.isfile(outFile):
+            with open(outFile, 'r') as fileObj:
+                output = json.load(fileObj, object_pairs_hook=OrderedDict)
+            pieces[simLabel] = split_output(batch_utils.pad_truncated(output), dtype)
+            rows.append(row)
+            packed.append(outFile)
+        elif store is not None and simLabel in store['index']:
+            pieces[simLabel] = split_output(store_output(store, simLabel), dtype)
+            rows.append(row)
+    if not pieces:
+        return 0
+
+    write_store(store_file(saveFolder, batchLabel), pieces, b, rows, dtype, batchLabel)
+    if not keepJson:
+        for outFile in packed:
+            os.remove(outFile)
+    print("Packed %d simulations (%d new) into %s" % (len(pieces), len(packed), store_file(saveFolder, batchLabel)))
+    return len(pieces)
+
+
+def trace_array(saveFolder, batchLabel):
+    """Returns the traces of a stored batch without reading them: an
+    OrderedDict with 'yarray', a read-only np.memmap view of shape
+    (param1, param2, ..., cell, trace, sample) in params order (grouped
+    params share the axis of the first of them; a sampled batch has one
+    'sample' axis), NaN where a grid point or trace is missing; 'present'
+    (the same without the sample axis); the 'params' as readBatchData
+    returns them; the 'cells' and 'traces' labels along those axes; and 't'.
+    yarray[..., cell, trace, :] can be passed to
+    batch_analysis.plot_relation as it is."""
+
+    store = load_store(saveFolder, batchLabel)
+    if store is None:
+        raise IOError("No store for batch %s in %s" % (batchLabel, saveFolder))
+    meta = store['meta']
+
+    params = meta['params']
+    groupParams = [p for p in params if p.get('group', False)]
+    gridShape = ([len(groupParams[0]['values'])] if groupParams else []) + [len(p['values']) for p in params if not p.get('group', False)]
+    order = []
+    nextAxis = 1 if groupParams else 0
+    for p in params:
+        if not p.get('group', False):
+            order.append(nextAxis)
+            nextAxis += 1
+        elif 0 not in order:
+            order.append(0)
+    numAxes = len(gridShape)
+
+    samples = store_array(store, 'traces')
+    present = store_array(store, 'present')
+    traces = OrderedDict()
+    traces['yarray'] = samples.reshape(tuple(gridShape) + samples.shape[1:]).transpose(order + [numAxes, numAxes + 1, numAxes + 2])
+    traces['present'] = present.reshape(tuple(gridShape) + present.shape[1:]).transpose(order + [numAxes, numAxes + 1])
+    if meta.get('sampling'):
+        params = batch_utils.sampled_params({'params': params, 'sampling': meta['sampling']}, {})[0]
+    traces['params'] = params
+    traces['cells'] = meta['cells']
+    traces['traces'] = meta['traces']
+    traces['t'] = store_array(store, 't')
+    return traces
@@ -0,0 +1,287 @@
+"""
+batch_surrogate.py
+Surrogate models (emulators) of the plateau and spike features, trained on
+the stored batches: param values -> plateau amplitude, plateau duration and
+number of spikes, with an uncertainty for every prediction.  A proposed
+sweep can be pre-screened so only the points where the emulator is
+uncertain, or close to a regime boundary (plateau / no plateau, spiking /
+silent), are simulated.  Requires scikit-learn.
+
+Usage (from a batch directory):
+    training = batch_surrogate.collect_training_data(batchdatadir=batchoutputdir)
+    model = batch_surrogate.train(training)
+    batch_surrogate.run_screened("screen_NMDA", params, "cfg.py", "netParams.py", model,
+                                 batchdatadir=batchoutputdir, runCfg={'type': 'pool'})
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import json
+import os
+import pickle
+import numpy as np
+import batch_utils
+import batch_analysis
+
+surrogateFeatures = ['plat_amp', 'plat_dur', 'num_spikes']
+
+# feature: value separating two regimes, used by prescreen
+boundaries = OrderedDict([('plat_amp', batch_analysis.platthresh),  # plateau / no plateau
+                          ('num_spikes', 0.5)])                     # spiking / silent
+
+screenDefaults = {
+    'relStd'        : 0.1,  # simulate if a prediction's std exceeds this fraction of the feature's training std
+    'boundaryWidth' : 2.0,  # simulate if a boundary is within this many stds of a prediction
+    'boundaries'    : boundaries,
+    'extrapolate'   : False,  # allow points outside the training range of an input
+}
+
+
+def cfg_value(simConfig, label):
+    """Returns the value of a (possibly nested) param in a saved simConfig,
+    or None if it isn't there."""
+
+    value = simConfig
+    for key in (label if isinstance(label, (tuple, list)) else [label]):
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
+def batch_inputs(params):
+    """Returns the labels of the params varied in a batch (the sampled params
+    of a sampled batch)."""
+
+    if params and 'samples' in params[0]:
+        return params[0]['samples'].keys()
+    return [p['label'] for p in params]
+
+
+def collect_training_data(batchLabels=None, inputs=None, features=surrogateFeatures, cellID=0, batchdatadir=batch_utils.batchdatadir):
+    """Returns the training data of a surrogate from stored batches: a dict
+    with 'inputs' (param labels), 'features', 'X' (points, inputs) and 'Y'
+    (points, features) arrays, and the 'simLabels' of the points.  Input
+    values are read from each simulation's saved simConfig, so batches that
+    varied different params can be combined.  inputs defaults to every param
+    varied in any of the batches; batchLabels defaults to all batches in
+    batchdatadir."""
+
+    if batchLabels is None:
+        batchLabels = sorted(label for label in os.listdir(batchdatadir)
+                             if os.path.isfile(os.path.join(batchdatadir, label, label + '_batch.json')))
+
+    batches = []
+    for batchLabel in batchLabels:
+        try:
+            params, data = batch_utils.readBatchData(batchdatadir, batchLabel, saveAll=False, vars=['simConfig', 'simData'])
+        except (IOError, ValueError) as e:
+            print("Skipping batch %s: %s" % (batchLabel, e))
+            continue
+        batches.append((batchLabel, params, data))
+
+    if inputs is None:
+        inputs = []
+        for batchLabel, params, data in batches:
+            for label in batch_inputs(params):
+                if label not in inputs:
+                    inputs.append(label)
+
+    X, Y, simLabels = [], [], []
+    for batchLabel, params, data in batches:
+        for iCombStr, datum in sorted(data.iteritems()):
+            simConfig = datum['simConfig']
+            point = [cfg_value(simConfig, label) for label in inputs]
+            vsoma = datum['simData'].get('V_soma', {}).get('cell_' + str(cellID))
+            if vsoma is None or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in point):
+                continue
+            values = batch_analysis.meas_trace_features(np.array(vsoma), recstep=simConfig['recordStep'], syntime=simConfig['synTime'])
+            X.append(point)
+            Y.append([values[feature] for feature in features])
+            simLabels.append(simConfig['simLabel'])
+
+    print("Collected %d points from %d batches" % (len(X), len(batches)))
+    return {'inputs': list(inputs), 'features': list(features), 'X': np.array(X, dtype=float).reshape(-1, len(inputs)),
+            'Y': np.array(Y, dtype=float).reshape(-1, len(features)), 'simLabels': simLabels}
+
+
+def check_points(model, X, extrapolate=False):
+    """Raises an Exception if points have an input value that is not finite,
+    not positive for a log input or, unless extrapolate, outside the
+    training range of the input."""
+
+    for dim, label in enumerate(model['inputs']):
+        values = X[:, dim]
+        bad = ~np.isfinite(values)
+        if label in model['log']:
+            bad |= ~(values > 0)
+        if bad.any():
+            raise Exception("batch_surrogate: input %s has invalid values %s%s." % (label, list(np.unique(values[bad])),
+                            " (it is modelled in log space, so values must be positive)" if label in model['log'] else ""))
+        lo, hi = model['ranges'][dim]
+        tol = 1e-9 * max(abs(lo), abs(hi), 1.0)
+        outside = (values < lo - tol) | (values > hi + tol)
+        if not extrapolate and outside.any():
+            raise Exception("batch_surrogate: input %s has values %s outside its training range [%g, %g]; "
+                            "use screen {'extrapolate': True} to predict them anyway." % (label, list(np.unique(values[outside])), lo, hi))
+
+
+def normalize(model, X):
+    """Maps points to the [0, 1] training range of each input (log-scaled
+    for the model's log inputs)."""
+
+    X = np.array(X, dtype=float)
+    for dim, label in enumerate(model['inputs']):
+        if label in model['log']:
+            X[:, dim] = np.log(X[:, dim])
+    return (X - model['lo']) / model['span']
+
+
+def train(training, method='gp', log=None, seed=0):
+    """Returns a surrogate model trained on collect_training_data output.
+    method can be:
+        'gp'  : a Gaussian process per feature (Matern kernel with a length
+                scale per input, plus white noise); std is the posterior std
+        'gbt' : gradient-boosted trees per feature fitted to the 16th, 50th
+                and 84th percentiles; std is half the 16-84 spread
+    log lists the inputs modelled in log space (default: the positive inputs
+    whose training values span at least a factor of 10)."""
+
+    X, Y = training['X'], training['Y']
+    if len(X) < 2:
+        raise Exception("batch_surrogate.train: need at least 2 training points, got %d." % (len(X)))
+
+    if log is None:
+        log = [label for dim, label in enumerate(training['inputs'])
+               if np.all(X[:, dim] > 0) and X[:, dim].max() >= 10 * X[:, dim].min()]
+
+    model = {'method': method, 'inputs': list(training['inputs']), 'features': list(training['features']),
+             'log': list(log), 'numTrain': len(X), 'regressors': OrderedDict(), 'scales': OrderedDict(),
+             'ranges': [[X[:, dim].min(), X[:, dim].max()] for dim in range(X.shape[1])]}
+    scaled = np.array(X, dtype=float)
+    for dim, label in enumerate(model['inputs']):
+        if label in log:
+            scaled[:, dim] = np.log(scaled[:, dim])
+    model['lo'] = scaled.min(axis=0)
+    span = scaled.max(axis=0) - model['lo']
+    model['span'] = np.where(span > 0, span, 1.0)
+    Z = normalize(model, X)
+
+    for index, feature in enumerate(model['features']):
+        y = Y[:, index]
+        spread = np.std(y)
+        model['scales'][feature] = spread if spread > 0 else 1.0
+
+        if method == 'gp':
+            from sklearn.gaussian_process import GaussianProcessRegressor
+            from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+            kernel = (ConstantKernel(1.0, (1e-3, 1e3)) * Matern(length_scale=np.full(Z.shape[1], 0.3), length_scale_bounds=(1e-2, 1e2), nu=2.5)
+                      + WhiteKernel(1e-2, (1e-6, 1e0)))
+            regressor = GaussianProcessRegressor(kernel=kernel, normalize_y=True, n_restarts_optimizer=3, random_state=seed)
+            model['regressors'][feature] = regressor.fit(Z, y)
+        elif method == 'gbt':
+            from sklearn.ensemble import GradientBoostingRegressor
+            model['regressors'][feature] = [GradientBoostingRegressor(loss='quantile', alpha=alpha, n_estimators=200, max_depth=3,
+                                                                      learning_rate=0.05, subsample=0.8, random_state=seed).fit(Z, y)
+                                            for alpha in (0.16, 0.5, 0.84)]
+        else:
+            raise Exception("batch_surrogate.train: unknown method '%s' (use 'gp' or 'gbt')." % (method))
+
+    return model
+
+
+def predict(model, points, extrapolate=False):
+    """Returns the predicted mean and std (arrays of points, features) of the
+    features at points (an array of points, inputs in model['inputs'] order).
+    The points are checked first (see check_points)."""
+
+    X = np.array(points, dtype=float).reshape(-1, len(model['inputs']))
+    check_points(model, X, extrapolate)
+    Z = normalize(model, X)
+    mean = np.zeros((len(Z), len(model['features'])))
+    std = np.zeros_like(mean)
+    for index, feature in enumerate(model['features']):
+        regressor = model['regressors'][feature]
+        if model['method'] == 'gp':
+            mean[:, index], std[:, index] = regressor.predict(Z, return_std=True)
+        else:
+            low, middle, high = [quantile.predict(Z) for quantile in regressor]
+            mean[:, index] = middle
+            std[:, index] = np.abs(high - low) / 2.0
+    return mean, std
+
+
+def prescreen(model, points, screen=None):
+    """Decides which points of a proposed sweep need simulating.  Returns a
+    dict of boolean arrays 'simulate', 'uncertain' and 'boundary' and the
+    predicted 'mean' and 'std' (see screenDefaults for the screen options)."""
+
+    screen = dict(screenDefaults, **(screen or {}))
+    mean, std = predict(model, points, screen['extrapolate'])
+
+    uncertain = np.zeros(len(mean), dtype=bool)
+    boundary = np.zeros(len(mean), dtype=bool)
+    for index, feature in enumerate(model['features']):
+        uncertain |= std[:, index] > screen['relStd'] * model['scales'][feature]
+        if feature in screen['boundaries']:
+            boundary |= np.abs(mean[:, index] - screen['boundaries'][feature]) <= screen['boundaryWidth'] * std[:, index]
+
+    return {'simulate': uncertain | boundary, 'uncertain': uncertain, 'boundary': boundary, 'mean': mean, 'std': std}
+
+
+def save_surrogate(model, filename):
+    """Pickles a surrogate model."""
+    with open(filename, 'wb') as fileObj:
+        pickle.dump(model, fileObj, protocol=2)
+
+
+def load_surrogate(filename):
+    """Loads a pickled surrogate model."""
+    with open(filename, 'rb') as fileObj:
+        return pickle.load(fileObj)
+
+
+def run_screened(label, params, cfgFile, netParamsFile, model, batchdatadir="batch_data", grouped=None, cache=False, runCfg=None, screen=None):
+    """Pre-screens a proposed grid batch (as in batch_utils.run_batch) with a
+    surrogate model and runs only the grid points that prescreen selects, as
+    a batch of points (see batch_utils.make_points_batch; readBatchData
+    returns it like a sampled batch).  Model inputs that aren't swept take
+    their value from cfgFile.  The predictions for every grid point are saved
+    to saveFolder/label_surrogate.json.  Returns the prescreen dict with the
+    grid 'points' (label: values)."""
+
+    b = batch_utils.make_batch(label, params, cfgFile, netParamsFile, batchdatadir=batchdatadir, grouped=grouped, runCfg=runCfg)
+    combLabels, combs = batch_utils.grid_combinations(b.params)
+    unknown = [paramLabel for paramLabel in combLabels if paramLabel not in model['inputs']]
+    if unknown:
+        raise Exception("batch_surrogate.run_screened: params %s are not inputs of the surrogate model." % (unknown))
+
+    cfg = batch_utils.load_cfg(cfgFile)
+    base = [cfg_value(cfg.__dict__, inputLabel) for inputLabel in model['inputs']]
+    X = np.array([base] * len(combs), dtype=float).reshape(-1, len(model['inputs']))
+    for row, (iComb, pComb) in enumerate(combs):
+        for paramLabel, paramVal in zip(combLabels, pComb):
+            X[row, model['inputs'].index(paramLabel)] = paramVal
+
+    result = prescreen(model, X, screen)
+    selected = np.flatnonzero(result['simulate'])
+    result['points'] = OrderedDict((paramLabel, [pComb[dim] for iComb, pComb in combs]) for dim, paramLabel in enumerate(combLabels))
+    print("Surrogate screen of %s: simulating %d of %d grid points (%d uncertain, %d near a boundary)" % (label,
+          len(selected), len(combs), result['uncertain'].sum(), result['boundary'].sum()))
+
+    if not os.path.isdir(b.saveFolder):
+        os.makedirs(b.saveFolder)
+    with open(os.path.join(b.saveFolder, label + '_surrogate.json'), 'w') as fileObj:
+        json.dump({'inputs': model['inputs'], 'features': model['features'], 'method': model['method'],
+                   'numTrain': model['numTrain'], 'points': result['points'], 'mean': result['mean'], 'std': result['std'],
+                   'simulate': result['simulate'], 'uncertain': result['uncertain'], 'boundary': result['boundary']},
+                  fileObj, default=batch_utils.json_default)
+
+    if len(selected):
+        points = OrderedDict((paramLabel, [values[i] for i in selected]) for paramLabel, values in result['points'].iteritems())
+        sampling = {'method': 'screened', 'samples': len(selected), 'log': [inputLabel for inputLabel in model['log'] if inputLabel in points],
+                    'grid': [list(combs[i][0]) for i in selected]}
+        batch_utils.launch_batch(batch_utils.make_points_batch(label, points, cfgFile, netParamsFile, sampling,
+                                                               batchdatadir=batchdatadir, runCfg=runCfg), cache=cache)
+    return result
@@ -0,0 +1,156 @@
+"""
+batch_telemetry.py
+Per-phase wall time and peak memory of batch simulations.  Each grid point
+appends one record to saveFolder/<batchLabel>_metrics.jsonl; summarize()
+aggregates them by batch, cell type and phase.
+Usage: python batch_telemetry.py [batchdatadir] [batchLabel ...]
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import glob
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+batchdatadir = "batch_data"
+
+# phase name: {'wall': seconds, 'peakRSS': MB} for the current grid point
+phases = OrderedDict()
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process so far, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024.0)  # bytes
+    return maxrss / 1024.0  # kilobytes
+
+
+@contextmanager
+def phase(name):
+    """Records the wall time and peak RSS at the end of the enclosed code."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases[name] = {'wall': time.time() - start, 'peakRSS': peak_rss()}
+
+
+def reset():
+    """Clears the recorded phases."""
+    phases.clear()
+
+
+def metrics_file(saveFolder):
+    """Returns the metrics file of the batch saved in saveFolder."""
+    saveFolder = os.path.normpath(saveFolder)
+    return os.path.join(saveFolder, os.path.basename(saveFolder) + '_metrics.jsonl')
+
+
+def save(sim):
+    """Appends the phases of the current grid point, with the cell types, size
+    (compartments, mechanism instances, synapses, recorded samples, output
+    bytes) and run settings of the network, to its batch metrics file.  Only
+    the root MPI rank writes."""
+
+    if sim.rank != 0:
+        return
+
+    cellTypes = sorted(set(str(cell.tags.get('cellType')) for cell in sim.net.cells))
+    compartments = mechanisms = synapses = 0
+    for cell in sim.net.cells:
+        for sec in cell.secs.itervalues():
+            nseg = sec['hSec'].nseg if 'hSec' in sec else sec.get('geom', {}).get('nseg', 1)
+            compartments += nseg
+            mechanisms += nseg * len(sec.get('mechs', {}))
+            synapses += len(sec.get('synMechs', []))
+    traceSamples = sum(len(trace) for key in sim.cfg.recordTraces
+                       for trace in getattr(sim, 'allSimData', {}).get(key, {}).itervalues())
+    outputBytes = sum(os.path.getsize(filename) for filename in glob.glob(sim.cfg.filename + '.*')
+                      if '.tmp-' not in filename)
+
+    record = OrderedDict()
+    record['simLabel'] = sim.cfg.simLabel
+    record['batchLabel'] = os.path.basename(os.path.normpath(sim.cfg.saveFolder))
+    record['cellTypes'] = cellTypes
+    record['compartments'] = compartments
+    record['mechanisms'] = mechanisms
+    record['synapses'] = synapses
+    record['traceSamples'] = traceSamples
+    record['outputBytes'] = outputBytes
+    record['duration'] = sim.cfg.duration
+    record['dt'] = sim.cfg.dt
+    record['cvode_active'] = getattr(sim.cfg, 'cvode_active', False)
+    record['nthreads'] = getattr(sim.cfg, 'nthreads', 1)
+    record['nhosts'] = sim.nhosts
+    record['host'] = socket.gethostname()
+    record['time'] = time.time()
+    record['phases'] = phases
+
+    if not os.path.isdir(sim.cfg.saveFolder):
+        os.makedirs(sim.cfg.saveFolder)
+    line = json.dumps(record) + '\n'
+    fd = os.open(metrics_file(sim.cfg.saveFolder), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def load_metrics(batchLabel, batchdatadir=batchdatadir):
+    """Returns the list of metrics records of a batch (the last record for
+    each simLabel)."""
+
+    filename = metrics_file(os.path.join(batchdatadir, batchLabel))
+    records = OrderedDict()
+    if os.path.isfile(filename):
+        with open(filename, 'r') as fileObj:
+            for line in fileObj:
+                if line.strip():
+                    record = json.loads(line, object_pairs_hook=OrderedDict)
+                    records[record['simLabel']] = record
+    return records.values()
+
+
+def summarize(batchLabels=None, batchdatadir=batchdatadir, show=True):
+    """Aggregates metrics by batch, cell types and phase.  Returns an
+    OrderedDict of (batchLabel, cellTypes, phase): {'count', 'mean', 'total',
+    'max', 'peakRSS'} (times in s, peakRSS in MB)."""
+
+    if batchLabels is None:
+        batchLabels = sorted(label for label in os.listdir(batchdatadir)
+                             if os.path.isfile(metrics_file(os.path.join(batchdatadir, label))))
+
+    walls = OrderedDict()
+    rss = {}
+    for batchLabel in batchLabels:
+        for record in load_metrics(batchLabel, batchdatadir):
+            cellTypes = "+".join(record['cellTypes'])
+            for phaseName, phaseData in record['phases'].iteritems():
+                key = (batchLabel, cellTypes, phaseName)
+                walls.setdefault(key, []).append(phaseData['wall'])
+                rss[key] = max(rss.get(key, 0.0), phaseData['peakRSS'])
+
+    summary = OrderedDict()
+    for key, times in walls.iteritems():
+        summary[key] = {'count': len(times), 'mean': sum(times) / len(times), 'total': sum(times),
+                        'max': max(times), 'peakRSS': rss[key]}
+
+    if show:
+        print("%-30s %-12s %-16s %6s %10s %10s %10s %10s" % ("batch", "cellTypes", "phase", "count", "mean(s)", "total(s)", "max(s)", "RSS(MB)"))
+        for (batchLabel, cellTypes, phaseName), stats in summary.iteritems():
+            print("%-30s %-12s %-16s %6d %10.3f %10.2f %10.3f %10.1f" % (batchLabel, cellTypes, phaseName, stats['count'],
+                  stats['mean'], stats['total'], stats['max'], stats['peakRSS']))
+    return summary
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    datadir = args.pop(0) if args else batchdatadir
+    summarize(args or None, batchdatadir=datadir)
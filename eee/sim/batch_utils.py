@@ -15,8 +15,37 @@ import matplotlib.pyplot as plt
 from itertools import product
 from pprint import pprint
 from netpyne import specs
+import hashlib
+import imp
+import shutil
 
 batchdatadir = "batch_data"
+simdir       = os.path.dirname(os.path.realpath(__file__))
+cachedir     = os.path.join(simdir, "batch_cache")
+
+# processes decoding batch outputs in load_batch (None: one per core)
+loadProcesses = 1
+
+# default jump (change in measure between neighbouring values) that triggers
+# refinement in run_adaptive
+adaptiveJumps = {'plat_dur': 50.0, 'plat_amp': 5.0, 'num_spikes': 0.5}
+
+# Sobol direction numbers (Joe & Kuo, new-joe-kuo-6.21201) for dimensions
+# 2-21: (degree s, polynomial coefficients a, initial direction numbers m)
+sobolDirections = [
+    (1, 0, [1]), (2, 1, [1, 3]), (3, 1, [1, 3, 1]), (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]), (4, 4, [1, 3, 5, 13]), (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]), (5, 7, [1, 1, 7, 11, 19]), (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]), (5, 14, [1, 3, 5, 5, 31]), (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]), (6, 16, [1, 3, 1, 13, 27, 49]), (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]), (6, 25, [1, 1, 5, 5, 19, 61]), (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69])]
+
+samplingMethods = ['sobol', 'halton', 'lhs']
+
+# cfg keys that only affect naming, printing or plotting, not simulation output
+cacheIgnoreKeys = ['simLabel', 'saveFolder', 'filename', 'checkErrors', 'verbose',
+                   'printRunTime', 'printPopAvgRates', 'analysis', 'checkpoint']
 
 
 def getspineLocs(numspines, spinedist=[1]):
@@ -43,26 +72,1119 @@ def getspineLocs(numspines, spinedist=[1]):
     return spineLocs
 
 
-def run_batch(label, params, cfgFile, netParamsFile, batchdatadir="batch_data", grouped=None):
-    """Runs a batch of simulations."""
+def synmech_params(cfg):
+    """Returns the synMechParams (NMDA and AMPA) for the given cfg."""
+    synMechs = OrderedDict()
+    synMechs['NMDA'] = {'mod': 'NMDAeee', 'Cdur': cfg.CdurNMDAScale * 1.0, 'Alpha': cfg.NMDAAlphaScale * 4.0, 'Beta': cfg.NMDABetaScale * 0.0015, 'gmax': cfg.NMDAgmax}
+    synMechs['AMPA'] = {'mod': 'AMPA', 'gmax': cfg.ratioAMPANMDA * cfg.NMDAgmax}
+    return synMechs
+
+
+def netstim_syns(cfg, nslabel, branch_length):
+    """Returns the synapse locations, weights and delays for NetStim input
+    nslabel (which must contain 'Syn' or 'ExSyn') on a branch of length
+    branch_length (um)."""
+
+    if "ExSyn" in nslabel:
+        numSyns = cfg.numExSyns
+        amp = cfg.glutAmp * cfg.glutAmpExSynScale
+        synDelay = cfg.exSynDelay
+    elif "Syn" in nslabel:
+        numSyns = cfg.numSyns
+        amp = cfg.glutAmp
+        synDelay = cfg.synDelay
+    else:
+        raise Exception("NetStim must have Syn or ExSyn in name")
+
+    locs = np.linspace(cfg.synLocMiddle-cfg.synLocRadius, cfg.synLocMiddle+cfg.synLocRadius, numSyns)
+    dists = branch_length * np.abs(locs - cfg.synLocMiddle)
+    weights = amp * (1 - dists * cfg.glutAmpDecay/100)
+    weights = [weight if weight > 0.0 else 0.0 for weight in weights]
+    delays = cfg.initDelay + (synDelay * dists)
+    return locs, weights, delays
+
+
+def run_batch(label, params, cfgFile, netParamsFile, batchdatadir="batch_data", grouped=None, cache=False, runCfg=None, method='grid', adaptive=None, sampling=None, dryRun=False):
+    """Runs a batch of simulations.  If cache is True, parameter combinations
+    that have already been simulated (in any batch) with the same resolved cfg,
+    netParams, cell models and mod files are linked from the result cache
+    instead of being re-simulated.  cache='cells' also caches each population
+    separately, so a grid point is assembled without simulating if each of
+    its cells' effective parameters has been simulated before, possibly in
+    different simulations (see batch_dedup).
+
+    runCfg entries override the defaults below.  runCfg['type'] can be:
+        'mpi'  : netpyne bulletin board, run under mpiexec
+        'pool' : one local process per grid point (see run_pool)
+        'fork' : build the model once and fork a process per grid point that
+                 only applies the changed runtime params (see batch_sim.run_forked)
+        'hot'  : build the model once and rerun it in this process for every
+                 grid point; all params must be in batch_sim.hotParams
+        'queue': queue the grid points in saveFolder/queue and work on them
+                 as in 'pool'; workers on other machines sharing the
+                 filesystem can join (see batch_queue)
+    'pool', 'fork', 'hot' and 'queue' are run with plain python/nrniv, without mpiexec.
+    With 'pool' or 'queue', runCfg['splitPops'] (a list of population labels)
+    runs each population of a grid point as its own job (cfg.pops) and merges
+    their outputs, numbering cells by population in that order (see
+    merge_split).  Listing only some populations runs just those.
+    With 'fork' or 'hot', runCfg['warmStart'] runs the pre-stimulus part
+    (up to cfg.synTime) once per distinct set of the other params, and grid
+    points differing only in synaptic input params continue from its saved
+    state (see batch_sim.run_prestim).
+    runCfg['checkpoint'] (True or a dict, see batch_sim.run_sim) sets
+    cfg.checkpoint for every grid point ('pool', 'queue', 'fork', 'hot'), so
+    long runs save checkpoints and a rerun of an interrupted grid point
+    resumes from its last one instead of from 0.
+    runCfg['store'] (True or a dict, see batch_store.storeDefaults) packs
+    the outputs into one binary file per batch after it runs (see
+    batch_store.pack_batch); readBatchData reads it transparently.
+
+    method='adaptive' refines one param around jumps in a measure instead of
+    running the full grid (see run_adaptive).  method='sobol', 'halton' or
+    'lhs' samples the [min, max] range given for each param (see
+    make_sampled_batch).
+
+    Param labels are checked against cfg before anything runs (see
+    check_params).  dryRun=True only expands the batch, builds netParams for
+    every grid point and returns the dry_run report."""
+
+    if dryRun:
+        return dry_run(batch_object({'label': label, 'params': params, 'cfgFile': cfgFile, 'netParamsFile': netParamsFile,
+                                     'grouped': grouped, 'method': method, 'sampling': sampling},
+                                    runCfg=runCfg, batchdatadir=batchdatadir))
+
+    if method == 'adaptive':
+        return run_adaptive(label, params, cfgFile, netParamsFile, batchdatadir=batchdatadir,
+                            grouped=grouped, runCfg=runCfg, adaptive=adaptive)
+
+    if method in samplingMethods:
+        b = make_sampled_batch(label, params, cfgFile, netParamsFile, method, sampling, batchdatadir=batchdatadir, runCfg=runCfg)
+    else:
+        b = make_batch(label, params, cfgFile, netParamsFile, batchdatadir=batchdatadir, grouped=grouped, runCfg=runCfg)
+    launch_batch(b, cache=cache)
+
+
+def launch_batch(b, cache=False):
+    """Runs a Batch object according to its runCfg type (see run_batch)."""
+
+    if b.runCfg.get('splitPops') and b.runCfg['type'] not in ['pool', 'queue']:
+        raise Exception("batch_utils.launch_batch: runCfg 'splitPops' needs runCfg type 'pool' or 'queue'.")
+    if b.runCfg.get('warmStart') and b.runCfg['type'] not in ['fork', 'hot']:
+        raise Exception("batch_utils.launch_batch: runCfg 'warmStart' needs runCfg type 'fork' or 'hot'.")
+    validate_params(b)
+    if cache:
+        simKeys = prepare_cache(b, cells=(cache == 'cells'))
+    if b.runCfg['type'] == 'pool':
+        run_pool(b)
+    elif b.runCfg['type'] == 'fork':
+        import batch_sim
+        batch_sim.run_forked(b)
+    elif b.runCfg['type'] == 'hot':
+        import batch_sim
+        batch_sim.run_hot(b)
+    elif b.runCfg['type'] == 'queue':
+        import batch_queue
+        batch_queue.enqueue(b)
+        batch_queue.run_worker(b.saveFolder, cores=b.runCfg.get('cores'), timeout=b.runCfg.get('timeout'),
+                               script=b.runCfg.get('script', 'batch_init.py'),
+                               nrnCommand=b.runCfg.get('nrnCommand', 'nrniv'), queueCfg=b.runCfg.get('queue'))
+    else:
+        b.run()
+    if cache:
+        update_cache(b, simKeys, cells=(cache == 'cells'))
+    if b.runCfg.get('store'):
+        pack_store(b)
+
+
+def pack_store(b):
+    """Packs the outputs of a netpyne Batch into its binary store with the
+    runCfg['store'] options (see batch_store.pack_batch)."""
+
+    import batch_store
+
+    if not is_master():
+        return
+    options = dict(batch_store.storeDefaults, **(b.runCfg['store'] if isinstance(b.runCfg['store'], dict) else {}))
+    batch_store.pack_batch(b.saveFolder, b.batchLabel, dtype=options['dtype'], keepJson=options['keepJson'])
+
+
+def make_batch(label, params, cfgFile, netParamsFile, batchdatadir="batch_data", grouped=None, runCfg=None):
+    """Returns a netpyne grid Batch object for the params (see run_batch)."""
 
     b = Batch(cfgFile=cfgFile, netParamsFile=netParamsFile)
     for k,v in params.iteritems():
         b.params.append({'label': k, 'values': v})
     if grouped is not None:
         for p in b.params:
-            if p['label'] in grouped: 
+            if p['label'] in grouped:
                 p['group'] = True
     b.batchLabel = label
     b.saveFolder = os.path.join(batchdatadir, b.batchLabel)
     b.method = 'grid'
-    b.runCfg = {'type': 'mpi', 
-                'script': 'batch_init.py', 
+    b.runCfg = {'type': 'mpi',
+                'script': 'batch_init.py',
                 'skip': True}
-    b.run()
+    if runCfg is not None:
+        b.runCfg.update(runCfg)
+    return b
+
+
+def make_sampled_batch(label, ranges, cfgFile, netParamsFile, method, sampling=None, batchdatadir="batch_data", runCfg=None):
+    """Returns a netpyne Batch that runs sampled points of the param ranges
+    (label: [min, max]).  The points are stored as grouped params, so each
+    sample k runs as simLabel label_k_k... under any runCfg type, and
+    b.sampling records how they were made (see readBatchData).
+    sampling options:
+        'samples' : number of points (required)
+        'seed'    : seed for LHS, the Sobol digital shift and the Halton
+                    rotation (default: 0; None gives the unrandomized sequence)
+        'log'     : param labels sampled uniformly in log space"""
+
+    sampling = dict({'seed': 0, 'log': []}, **(sampling or {}))
+    labels = ranges.keys()
+    points = sample_points(method, sampling['samples'], len(labels), seed=sampling['seed'])
+
+    params = OrderedDict()
+    for dim, paramLabel in enumerate(labels):
+        lo, hi = ranges[paramLabel]
+        if paramLabel in sampling['log']:
+            values = np.exp(np.log(lo) + points[:, dim] * (np.log(hi) - np.log(lo)))
+        else:
+            values = lo + points[:, dim] * (hi - lo)
+        params[paramLabel] = [float(value) for value in values]
+
+    return make_points_batch(label, params, cfgFile, netParamsFile,
+                             {'method': method, 'samples': sampling['samples'], 'seed': sampling['seed'],
+                              'log': list(sampling['log']), 'ranges': [[paramLabel, list(ranges[paramLabel])] for paramLabel in labels]},
+                             batchdatadir=batchdatadir, runCfg=runCfg)
+
+
+def make_points_batch(label, points, cfgFile, netParamsFile, sampling, batchdatadir="batch_data", runCfg=None):
+    """Returns a netpyne Batch that runs a list of points (label: values, one
+    value per point) as grouped params, with b.sampling recording how the
+    points were chosen ('method', 'samples' and 'log' are required)."""
+
+    b = make_batch(label, points, cfgFile, netParamsFile, batchdatadir=batchdatadir, grouped=points.keys(), runCfg=runCfg)
+    b.sampling = sampling
+    return b
+
+
+def batch_object(batch, runCfg=None, batchdatadir="batch_data"):
+    """Returns the netpyne Batch for a run_batch keyword dict (as in
+    my_batches.py); adaptive batches give their initial grid."""
+
+    batch = dict(batch)
+    batch.pop('adaptive', None)
+    method = batch.pop('method', 'grid') or 'grid'
+    sampling = batch.pop('sampling', None)
+    batchdatadir = batch.pop('batchdatadir', batchdatadir)
+    if method in samplingMethods:
+        batch.pop('grouped', None)
+        return make_sampled_batch(method=method, sampling=sampling, runCfg=runCfg, batchdatadir=batchdatadir,
+                                  ranges=batch.pop('params'), **batch)
+    return make_batch(runCfg=runCfg, batchdatadir=batchdatadir, **batch)
+
+
+def check_param_label(cfg, paramLabel):
+    """Returns None if a batch param label names an existing cfg attribute
+    (or, for a tuple label such as ('NetStim1', 'weight', 0), an existing
+    entry inside one), otherwise a description of the problem."""
+
+    import difflib
+
+    path = list(paramLabel) if isinstance(paramLabel, (tuple, list)) else [paramLabel]
+    if not path:
+        return "empty param label"
+    if not hasattr(cfg, path[0]):
+        close = difflib.get_close_matches(str(path[0]), cfg.__dict__.keys(), n=3)
+        return "cfg has no attribute %r%s" % (path[0], " (did you mean %s?)" % ", ".join(close) if close else "")
+    container = getattr(cfg, path[0])
+    for depth, key in enumerate(path[1:]):
+        try:
+            container = container[key]
+        except (KeyError, IndexError, TypeError):
+            where = "cfg." + str(path[0]) + "".join("[%r]" % k for k in path[1:depth + 1])
+            if isinstance(container, dict):
+                close = difflib.get_close_matches(str(key), [str(k) for k in container.keys()], n=3)
+                return "%s has no key %r%s" % (where, key, " (did you mean %s?)" % ", ".join(close) if close else "")
+            return "%s can't be indexed by %r" % (where, key)
+    return None
+
+
+def check_params(cfg, params):
+    """Returns a list of problems with batch params (Batch.params): unknown
+    labels, empty value lists and grouped params of different lengths."""
+
+    problems = []
+    for p in params:
+        problem = check_param_label(cfg, p['label'])
+        if problem:
+            problems.append("param %r: %s" % (p['label'], problem))
+        if len(p['values']) == 0:
+            problems.append("param %r: no values" % (p['label'],))
+    groupLengths = set(len(p['values']) for p in params if p.get('group', False))
+    if len(groupLengths) > 1:
+        problems.append("grouped params have different numbers of values: %s" % (
+            ", ".join("%r: %d" % (p['label'], len(p['values'])) for p in params if p.get('group', False))))
+    return problems
+
+
+def validate_params(b):
+    """Raises an Exception listing the problems (see check_params) with the
+    params of a netpyne Batch, before any job is started."""
+
+    cfg = load_cfg(b.cfgFile)
+    problems = check_params(cfg, b.params)
+    if problems:
+        raise Exception("Batch %s has bad params:\n  %s" % (b.batchLabel, "\n  ".join(problems)))
+
+
+def check_netParams(netParams, cfg):
+    """Returns a list of problems with a built netParams: recorded traces and
+    stimulus targets on sections the targeted cells don't have, and unknown
+    stimulus sources and synaptic mechanisms."""
+
+    import batch_dedup
+
+    problems = []
+    popSecs = OrderedDict()
+    for popLabel, pop in netParams.popParams.iteritems():
+        tags = dict(pop, pop=popLabel, popLabel=popLabel)
+        popSecs[popLabel] = set(secName for rule in netParams.cellParams.itervalues()
+                                if batch_dedup.matches(rule.get('conds', {}), tags) for secName in rule['secs'])
+    for traceLabel, trace in getattr(cfg, 'recordTraces', {}).iteritems():
+        if 'sec' in trace and popSecs and not any(trace['sec'] in secs for secs in popSecs.values()):
+            problems.append("recordTraces %r: no cell has section %r" % (traceLabel, trace['sec']))
+    for targetLabel, target in netParams.stimTargetParams.iteritems():
+        if target.get('source') not in netParams.stimSourceParams:
+            problems.append("stimTargetParams %r: unknown source %r" % (targetLabel, target.get('source')))
+        if 'synMech' in target and target['synMech'] not in netParams.synMechParams:
+            problems.append("stimTargetParams %r: unknown synMech %r" % (targetLabel, target['synMech']))
+        for popLabel, pop in netParams.popParams.iteritems():
+            tags = dict(pop, pop=popLabel, popLabel=popLabel)
+            if batch_dedup.matches(target.get('conds', {}), tags) and 'sec' in target and target['sec'] not in popSecs[popLabel]:
+                problems.append("stimTargetParams %r: pop %r has no section %r" % (targetLabel, popLabel, target['sec']))
+    return problems
+
+
+def dry_run(b, show=True):
+    """Checks a netpyne Batch without running it: validates the param labels,
+    then applies every grid point to an in-memory cfg and builds its
+    netParams, collecting errors and check_netParams problems.  No network
+    is created; each cell template is instantiated in NEURON once, by the
+    first importCellParams call, and the other grid points work on copies
+    of its rule (see load_netParams).  Predicts the output size
+    with batch_planner's calibrated model.  Raises an Exception listing all
+    problems if there are any; otherwise returns a report dict."""
+
+    import batch_planner
+
+    validate_params(b)
+    cfg = load_cfg(b.cfgFile)
+    cfg.checkErrors = False
+    splitPops = b.runCfg.get('splitPops')
+    if splitPops:
+        cfg.pops = list(splitPops)
+    batchdatadir = os.path.dirname(b.saveFolder) or '.'
+    if os.path.isdir(batchdatadir):
+        model = batch_planner.calibrate(batchdatadir=batchdatadir, show=False)
+    else:
+        model = {'model': batch_planner.defaultModel, 'records': 0}
+    labels, combs = grid_combinations(b.params)
+
+    problems = []
+    outputMB = 0.0
+    cellRules = {}
+    for iComb, pComb in combs:
+        simLabel = get_simLabel(b.batchLabel, iComb)
+        for paramLabel, paramVal in zip(labels, pComb):
+            set_cfg_param(cfg, paramLabel, paramVal)
+        try:
+            netParams = load_netParams(b.netParamsFile, cfg, cellRules)
+        except Exception as e:
+            problems.append("%s %s: building netParams failed: %s: %s" % (simLabel, list(pComb), type(e).__name__, e))
+            continue
+        problems.extend("%s: %s" % (simLabel, problem) for problem in check_netParams(netParams, cfg))
+        outputMB += batch_planner.predict(model, batch_planner.netParams_features(netParams, cfg))['disk']
+
+    report = OrderedDict([('batchLabel', b.batchLabel), ('combinations', len(combs)),
+                          ('outputMB', outputMB), ('problems', problems)])
+    if show:
+        print("Dry run of %s: %d grid points, %d problems, ~%.1f MB of output%s" % (b.batchLabel, len(combs),
+              len(problems), outputMB, "" if model['records'] else " (uncalibrated)"))
+    if problems:
+        raise Exception("Batch %s failed the dry run:\n  %s" % (b.batchLabel, "\n  ".join(problems)))
+    return report
+
+
+def sample_points(method, numSamples, numDims, seed=0):
+    """Returns a (numSamples, numDims) array of points in [0, 1) from a Sobol,
+    Halton or Latin hypercube ('lhs') design.  The same seed gives the same
+    points."""
+
+    if method == 'sobol':
+        return sobol_points(numSamples, numDims, seed=seed)
+    elif method == 'halton':
+        return halton_points(numSamples, numDims, seed=seed)
+    elif method == 'lhs':
+        return lhs_points(numSamples, numDims, seed=seed)
+    raise Exception("Unknown sampling method: " + str(method))
+
+
+def sobol_points(numSamples, numDims, seed=0, bits=30):
+    """Returns the first numSamples points of the Sobol sequence, with a random
+    digital shift from seed (seed=None: unshifted, first point is 0)."""
+
+    if numDims > len(sobolDirections) + 1:
+        raise Exception("sobol_points supports up to %d dimensions" % (len(sobolDirections) + 1))
+
+    directions = np.zeros((numDims, bits), dtype=np.int64)
+    directions[0] = [1 << (bits - i - 1) for i in range(bits)]
+    for dim in range(1, numDims):
+        degree, coeffs, initial = sobolDirections[dim - 1]
+        for i in range(bits):
+            if i < degree:
+                directions[dim, i] = initial[i] << (bits - i - 1)
+            else:
+                value = directions[dim, i - degree] ^ (directions[dim, i - degree] >> degree)
+                for k in range(1, degree):
+                    if (coeffs >> (degree - 1 - k)) & 1:
+                        value ^= directions[dim, i - k]
+                directions[dim, i] = value
+
+    shift = np.zeros(numDims, dtype=np.int64)
+    if seed is not None:
+        shift = np.random.RandomState(seed).randint(0, 1 << bits, size=numDims).astype(np.int64)
+
+    points = np.zeros((numSamples, numDims))
+    current = np.zeros(numDims, dtype=np.int64)
+    for index in range(numSamples):
+        if index > 0:
+            bit = 0
+            while (index - 1) >> bit & 1:
+                bit += 1
+            current = current ^ directions[:, bit]
+        points[index] = (current ^ shift) / float(1 << bits)
+    return points
+
+
+def halton_points(numSamples, numDims, seed=0):
+    """Returns the first numSamples points of the Halton sequence (skipping 0),
+    with a random rotation modulo 1 from seed (seed=None: unrotated)."""
+
+    primes = []
+    candidate = 2
+    while len(primes) < numDims:
+        if all(candidate % prime for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+
+    points = np.zeros((numSamples, numDims))
+    for dim, base in enumerate(primes):
+        for index in range(numSamples):
+            n, fraction, value = index + 1, 1.0, 0.0
+            while n > 0:
+                fraction /= base
+                value += fraction * (n % base)
+                n //= base
+            points[index, dim] = value
+    if seed is not None:
+        points = (points + np.random.RandomState(seed).uniform(size=numDims)) % 1.0
+    return points
+
+
+def lhs_points(numSamples, numDims, seed=0):
+    """Returns a Latin hypercube sample: each param's range is split into
+    numSamples strata with one point in each."""
+
+    randomState = np.random.RandomState(seed)
+    points = np.zeros((numSamples, numDims))
+    for dim in range(numDims):
+        points[:, dim] = (randomState.permutation(numSamples) + randomState.uniform(size=numSamples)) / numSamples
+    return points
+
+
+def run_batches(batches, cache=False, runCfg=None, dryRun=False):
+    """Runs several batches (a list of run_batch keyword dicts).  With runCfg
+    type 'pool', the grid points of all batches go into one queue, longest
+    predicted jobs first (see job_cost), so no cores sit idle between
+    batches.  Other types, and adaptive batches, run one batch at a time.
+    The params of all batches are checked before any runs; dryRun=True
+    returns the dry_run report of each batch instead of running them."""
+
+    import multiprocessing
+    import batch_planner
+
+    runCfg = dict(runCfg or {})
+    if dryRun:
+        return [dry_run(batch_object(batch, runCfg)) for batch in batches]
+    for batch in batches:
+        validate_params(batch_object(batch, runCfg))
+
+    if runCfg.get('type') != 'pool':
+        for batch in batches:
+            print("Running batch with label: " + batch['label'])
+            run_batch(cache=cache, runCfg=runCfg, **batch)
+        return
+
+    pooled = []
+    for batch in batches:
+        if batch.get('method', 'grid') in ['grid'] + samplingMethods:
+            pooled.append(batch_object(batch, runCfg))
+        else:
+            print("Running batch with label: " + batch['label'])
+            run_batch(cache=cache, runCfg=runCfg, **batch)
+
+    jobs = []
+    simKeys = {}
+    model = None
+    for b in pooled:
+        if cache:
+            simKeys[b.batchLabel] = prepare_cache(b, cells=(cache == 'cells'))
+        batchJobs = write_batch_jobs(b)
+        if batchJobs:
+            model = model or batch_planner.calibrate(batchdatadir=os.path.dirname(b.saveFolder) or '.', show=False)
+            cfg = load_cfg(b.cfgFile)
+            cfg.checkErrors = False
+            netParams = load_netParams(b.netParamsFile, cfg)
+            for job in batchJobs:
+                job['cost'] = job_cost(job, netParams, model)
+        jobs.extend(batchJobs)
+    jobs.sort(key=lambda job: job['cost'], reverse=True)
+
+    cores = runCfg.get('cores') or multiprocessing.cpu_count()
+    print("Running %d jobs from %d batches on %d cores" % (len(jobs), len(pooled), cores))
+    run_jobs(jobs, cores=cores, timeout=runCfg.get('timeout'),
+             script=runCfg.get('script', 'batch_init.py'),
+             nrnCommand=runCfg.get('nrnCommand', 'nrniv'))
+
+    for b in pooled:
+        if cache:
+            update_cache(b, simKeys[b.batchLabel], cells=(cache == 'cells'))
+        if runCfg.get('store'):
+            pack_store(b)
+
+
+def load_netParams(netParamsFile, cfg, cellRules=None):
+    """Runs a netParams.py file with cfg and returns its NetParams object
+    (netParams.py imports cfg from __main__, as under netpyne).  importCellParams
+    instantiates the cell template in NEURON; with a cellRules dict, the
+    imported rules are kept in it and later calls with the same arguments
+    get a copy instead, so each template is instantiated once however many
+    grid points are loaded (netParams.py then applies the cfg to the copy)."""
+
+    import __main__
+    from copy import deepcopy
+
+    importCellParams = specs.NetParams.importCellParams
+
+    def import_cached(netParams, *args, **kwargs):
+        if kwargs.get('importSynMechs'):
+            return importCellParams(netParams, *args, **kwargs)
+        key = json.dumps([args, kwargs], sort_keys=True, default=repr)
+        if key not in cellRules:
+            cellRules[key] = deepcopy(importCellParams(netParams, *args, **kwargs))
+        label = kwargs['label'] if 'label' in kwargs else args[0]
+        netParams.cellParams[label] = deepcopy(cellRules[key])
+        return netParams.cellParams[label]
+
+    mainCfg = getattr(__main__, 'cfg', None)
+    __main__.cfg = cfg
+    if cellRules is not None:
+        specs.NetParams.importCellParams = import_cached
+    try:
+        netParamsModuleName = os.path.basename(netParamsFile).split('.')[0]
+        return imp.load_source(netParamsModuleName, netParamsFile).netParams
+    finally:
+        __main__.cfg = mainCfg
+        specs.NetParams.importCellParams = importCellParams
+
+
+def job_cost(job, netParams, model):
+    """Returns the predicted wall time of a job (its populations of the
+    batch's netParams, run with the job's cfg) from a batch_planner cost
+    model (see batch_planner.calibrate)."""
+
+    import batch_planner
+
+    with open(job['cfgFile'], 'r') as fileObj:
+        cfg = specs.SimConfig(json.load(fileObj)['simConfig'])
+    features = batch_planner.netParams_features(netParams, cfg, job.get('pops'))
+    return batch_planner.predict(model, features)['wall']
+
+
+def run_adaptive(label, params, cfgFile, netParamsFile, batchdatadir="batch_data", grouped=None, runCfg=None, adaptive=None):
+    """Runs a batch that starts with the given (coarse) values and bisects the
+    adaptive param only between neighbouring values where a batch_analysis
+    measure jumps, until neighbours are closer than the resolution.
+    adaptive options:
+        'param'      : param to refine (default: first param)
+        'measure'    : name of a batch_analysis.meas_trace_* function (default: 'plat_dur')
+        'trace'      : simData trace to measure (default: 'V_soma')
+        'jump'       : change in measure that triggers refinement (default: adaptiveJumps)
+        'resolution' : smallest spacing of the refined param (required)
+        'maxRounds'  : max refinement rounds (default: enough to reach resolution)
+    Each round reruns the batch as a grid with the result cache on, so only new
+    values are simulated, and the final batch folder is an ordinary grid batch.
+    With other params in the batch, the refined values are shared by all their
+    combinations.  Can't be used with runCfg type 'mpi' (default: 'pool')."""
+
+    import batch_analysis
+
+    adaptive = dict(adaptive or {})
+    runCfg = dict({'type': 'pool'}, **(runCfg or {}))
+    if runCfg['type'] == 'mpi':
+        raise Exception("run_adaptive: runCfg type 'mpi' not supported; use 'pool', 'fork' or 'hot'.")
+
+    param = adaptive.get('param', params.keys()[0])
+    if grouped is not None and param in grouped:
+        raise Exception("run_adaptive: adaptive param " + param + " can't be grouped.")
+    measure = adaptive.get('measure', 'plat_dur')
+    measFunc = getattr(batch_analysis, 'meas_trace_' + measure)
+    trace = adaptive.get('trace', 'V_soma')
+    jump = adaptive.get('jump', adaptiveJumps.get(measure, 0.0))
+    resolution = adaptive['resolution']
+
+    values = sorted(set(params[param]))
+    maxGap = max(np.diff(values)) if len(values) > 1 else 0.0
+    maxRounds = adaptive.get('maxRounds', int(np.ceil(np.log2(max(maxGap / resolution, 1.0)))) + 1)
+    params = OrderedDict(params)
+
+    for roundNum in range(maxRounds):
+        params[param] = values
+        print("Adaptive round %d: %d values of %s" % (roundNum, len(values), param))
+        run_batch(label, params, cfgFile, netParamsFile, batchdatadir=batchdatadir, grouped=grouped,
+                  cache=True, runCfg=runCfg)
 
+        batchParams, data = readBatchData(batchdatadir, label, saveAll=False, vars=['simData'])
+        labels = [p['label'] for p in batchParams]
+        paramIndex = labels.index(param)
+
+        # measures[other param values][param value] = list of measures (one per cell)
+        measures = {}
+        for datum in data.itervalues():
+            paramValues = list(datum['paramValues'])
+            value = paramValues.pop(paramIndex)
+            cellMeas = []
+            for cellLabel, vtrace in sorted(datum['simData'][trace].iteritems()):
+                meas = measFunc(np.array(vtrace))
+                cellMeas.append(meas[0] if isinstance(meas, tuple) else meas)
+            measures.setdefault(repr(paramValues), {})[value] = cellMeas
+
+        newValues = set()
+        for lo, hi in zip(values[:-1], values[1:]):
+            if hi - lo <= resolution:
+                continue
+            for valueMeas in measures.itervalues():
+                if lo in valueMeas and hi in valueMeas:
+                    if np.any(np.abs(np.array(valueMeas[hi]) - np.array(valueMeas[lo])) > jump):
+                        newValues.add(round((lo + hi) / 2.0, 10))
+                        break
+
+        if not newValues or roundNum == maxRounds - 1:
+            break
+        values = sorted(set(values) | newValues)
+
+    numGrid = int(round((values[-1] - values[0]) / resolution)) + 1 if len(values) > 1 else 1
+    print("Adaptive batch %s: %d values of %s (uniform grid at this resolution: %d)" % (label, len(values), param, numGrid))
+    return values
+
+
+def write_batch_jobs(b):
+    """Writes the batch json, netParams copy and a cfg json for every grid point
+    that needs to run (the same files netpyne's Batch.run writes).  Returns a
+    list of job dicts.  With runCfg['splitPops'], each grid point gets one job
+    per population (simLabel_pop, with cfg.pops = [pop]) and a 'split' entry
+    for merge_split.  runCfg['checkpoint'] is copied to cfg.checkpoint.
+    Grid points in the batch store (see batch_store) count as done, if their
+    cache key is current (see stored_done)."""
+
+    if not os.path.isdir(b.saveFolder):
+        os.makedirs(b.saveFolder)
+    b.save(os.path.join(b.saveFolder, b.batchLabel + '_batch.json'))
+    netParamsSavePath = os.path.join(b.saveFolder, b.batchLabel + '_netParams.py')
+    shutil.copyfile(b.netParamsFile, netParamsSavePath)
+
+    cfg = load_cfg(b.cfgFile)
+    cfg.checkErrors = False
+    labels, combs = grid_combinations(b.params)
+    splitPops = b.runCfg.get('splitPops')
+    skip = b.runCfg.get('skip', False)
+    stored = stored_done(b) if skip else set()
+    if b.runCfg.get('checkpoint'):
+        cfg.checkpoint = b.runCfg['checkpoint']
+
+    jobs = []
+    for iComb, pComb in combs:
+        simLabel = get_simLabel(b.batchLabel, iComb)
+        jobName = os.path.join(b.saveFolder, simLabel)
+        if skip and (os.path.isfile(jobName + '.json') or simLabel in stored):
+            print('Skipping job %s since output file already exists...' % (jobName))
+            continue
+        for paramLabel, paramVal in zip(labels, pComb):
+            set_cfg_param(cfg, paramLabel, paramVal)
+        cfg.saveFolder = b.saveFolder
+
+        if not splitPops:
+            cfg.simLabel = simLabel
+            cfgSavePath = jobName + '_cfg.json'
+            cfg.save(cfgSavePath)
+            jobs.append({'simLabel': simLabel, 'jobName': jobName, 'cfgFile': cfgSavePath,
+                         'netParamsFile': netParamsSavePath, 'paramValues': pComb})
+            continue
+
+        split = {'simLabel': simLabel, 'jobName': jobName, 'parts': [[pop, simLabel + '_' + pop] for pop in splitPops]}
+        numJobs = len(jobs)
+        for pop, partLabel in split['parts']:
+            partName = os.path.join(b.saveFolder, partLabel)
+            if skip and os.path.isfile(partName + '.json'):
+                continue  # waiting for the other populations
+            cfg.simLabel = partLabel
+            cfg.pops = [pop]
+            cfgSavePath = partName + '_cfg.json'
+            cfg.save(cfgSavePath)
+            jobs.append({'simLabel': partLabel, 'jobName': partName, 'cfgFile': cfgSavePath,
+                         'netParamsFile': netParamsSavePath, 'paramValues': pComb, 'pops': [pop], 'split': split})
+        if len(jobs) == numJobs:
+            merge_split(split)
+    return jobs
+
+
+def merge_split(split):
+    """Merges the outputs of the per-population jobs of a grid point (see
+    write_batch_jobs) into the output of a simulation of all its populations:
+    cells (traces, spikes, net cells and pops) are renumbered by population in
+    split['parts'] order.  The part outputs are removed.  Returns True if the
+    merged output was written, False if a part is missing."""
+
+    saveFolder = os.path.dirname(split['jobName'])
+    parts = []
+    try:
+        for pop, partLabel in split['parts']:
+            with open(os.path.join(saveFolder, partLabel + '.json'), 'r') as fileObj:
+                parts.append(json.load(fileObj, object_pairs_hook=OrderedDict))
+    except (IOError, ValueError):
+        return False  # not finished, or already merged by another worker
+
+    simData = OrderedDict([('spkt', []), ('spkid', [])])
+    netCells = []
+    netPops = OrderedDict()
+    popParams = OrderedDict()
+    runWallTime = 0.0
+    offset = 0
+    for (pop, partLabel), part in zip(split['parts'], parts):
+        pad_truncated(part)
+        partData = part['simData']
+        partData.pop('earlyStop', None)
+        numCells = 0
+        for key, value in partData.iteritems():
+            if key == 'spkt':
+                simData['spkt'].extend(value)
+            elif key == 'spkid':
+                simData['spkid'].extend([offset + int(gid) for gid in value])
+            elif key == 'runWallTime':
+                runWallTime += value
+            elif isinstance(value, dict):
+                merged = simData.setdefault(key, OrderedDict())
+                for itemLabel, item in value.iteritems():
+                    if itemLabel.startswith('cell_'):
+                        gid = int(itemLabel[len('cell_'):])
+                        numCells = max(numCells, gid + 1)
+                        itemLabel = 'cell_' + str(offset + gid)
+                    merged[itemLabel] = item
+            elif key not in simData:
+                simData[key] = value
+        net = part.get('net', {})
+        for cell in net.get('cells', []):
+            netCells.append(dict(cell, gid=offset + cell['gid']))
+        for popLabel, popData in net.get('pops', {}).iteritems():
+            netPops[popLabel] = dict(popData, cellGids=[offset + gid for gid in popData.get('cellGids', [])])
+            numCells = max(numCells, len(popData.get('cellGids', [])))
+        popParams.update(net.get('params', {}).get('popParams', {}))
+        offset += numCells
+    order = sorted(range(len(simData['spkt'])), key=lambda i: simData['spkt'][i])
+    simData['spkt'] = [simData['spkt'][i] for i in order]
+    simData['spkid'] = [simData['spkid'][i] for i in order]
+    if runWallTime:
+        simData['runWallTime'] = runWallTime
+
+    output = OrderedDict()
+    for key, value in parts[0].iteritems():
+        if key == 'simData':
+            output[key] = simData
+        elif key == 'simConfig':
+            output[key] = dict(value, simLabel=split['simLabel'], filename=split['jobName'],
+                               pops=[pop for pop, partLabel in split['parts']])
+        elif key == 'net':
+            output[key] = OrderedDict()
+            if 'params' in value:
+                output[key]['params'] = dict(value['params'], popParams=popParams)
+            if 'cells' in value:
+                output[key]['cells'] = netCells
+            if 'pops' in value:
+                output[key]['pops'] = netPops
+        else:
+            output[key] = value
+
+    outFile = split['jobName'] + '.json'
+    with open(outFile + '.tmp-' + str(os.getpid()), 'w') as fileObj:
+        json.dump(output, fileObj)
+    os.rename(outFile + '.tmp-' + str(os.getpid()), outFile)
+    for pop, partLabel in split['parts']:
+        try:
+            os.remove(os.path.join(saveFolder, partLabel + '.json'))
+        except OSError:
+            pass
+    print("Merged %s from %s" % (split['simLabel'], ", ".join(partLabel for pop, partLabel in split['parts'])))
+    return True
+
+
+def job_done(job):
+    """Returns True if a job's output (or, for a per-population job, the
+    merged output of its grid point) exists."""
+    if 'split' in job and os.path.isfile(job['split']['jobName'] + '.json'):
+        return True
+    return os.path.isfile(job['jobName'] + '.json')
+
+
+def run_pool(b):
+    """Runs the grid points of a netpyne Batch as independent local processes.
+    b.runCfg options:
+        'cores'      : max simultaneous simulations (default: all cores)
+        'timeout'    : seconds before a simulation is killed (default: None)
+        'script'     : simulation script (default: batch_init.py)
+        'nrnCommand' : command used to launch the script (default: nrniv)"""
+
+    import multiprocessing
+
+    jobs = write_batch_jobs(b)
+    cores = b.runCfg.get('cores') or multiprocessing.cpu_count()
+    print("Running %d jobs in batch %s on %d cores" % (len(jobs), b.batchLabel, cores))
+    return run_jobs(jobs, cores=cores, timeout=b.runCfg.get('timeout'),
+                    script=b.runCfg.get('script', 'batch_init.py'),
+                    nrnCommand=b.runCfg.get('nrnCommand', 'nrniv'))
+
+
+def job_command(job, script='batch_init.py', nrnCommand='nrniv'):
+    """Returns the command line that runs one simulation job."""
+    return [nrnCommand, '-python', script, 'simConfig=' + job['cfgFile'], 'netParams=' + job['netParamsFile']]
+
+
+def run_jobs(jobs, cores=1, timeout=None, script='batch_init.py', nrnCommand='nrniv', poll=0.5, callback=None):
+    """Runs jobs (from write_batch_jobs) as child processes, at most cores at a
+    time.  Each job's output goes to jobName.run/.err.  Jobs running longer
+    than timeout seconds are killed.  On interrupt or SIGTERM all running
+    simulations are killed before returning.  If given, callback(job, status)
+    is called as each job finishes and may return a list of new jobs to
+    queue.  Returns a dict of simLabel: 'done', 'failed', 'timeout' or
+    'killed'."""
+
+    import subprocess
+    import signal
+    import time
+
+    def terminate(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            time.sleep(poll)
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+
+    def on_sigterm(signum, frame):
+        raise SystemExit("Received SIGTERM")
+
+    pending = list(jobs)
+    running = {}
+    status = OrderedDict()
+    oldHandler = signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        while pending or running:
+            while pending and len(running) < cores:
+                job = pending.pop(0)
+                stdout = open(job['jobName'] + '.run', 'w')
+                stderr = open(job['jobName'] + '.err', 'w')
+                proc = subprocess.Popen(job_command(job, script, nrnCommand), stdout=stdout, stderr=stderr,
+                                        preexec_fn=os.setsid)
+                stdout.close()
+                stderr.close()
+                running[job['simLabel']] = (proc, time.time(), job)
+                print("Started job: " + job['simLabel'])
+
+            time.sleep(poll)
+
+            for simLabel, (proc, start, job) in running.items():
+                if proc.poll() is not None:
+                    status[simLabel] = 'done' if proc.returncode == 0 else 'failed'
+                elif timeout is not None and time.time() - start > timeout:
+                    terminate(proc)
+                    status[simLabel] = 'timeout'
+                else:
+                    continue
+                del running[simLabel]
+                print("Finished job: %s (%s, %.1f s)" % (simLabel, status[simLabel], time.time() - start))
+                if status[simLabel] == 'done' and 'split' in job:
+                    merge_split(job['split'])
+                if callback is not None:
+                    pending.extend(callback(job, status[simLabel]) or [])
+    finally:
+        for simLabel, (proc, start, job) in running.items():
+            print("Killing job: " + simLabel)
+            terminate(proc)
+            status[simLabel] = 'killed'
+        signal.signal(signal.SIGTERM, oldHandler)
+
+    failed = [simLabel for simLabel, stat in status.iteritems() if stat != 'done']
+    if failed:
+        print("%d of %d jobs did not complete: %s" % (len(failed), len(status), ", ".join(failed)))
+    return status
+
+
+def grid_combinations(params):
+    """Returns the param labels and a list of (index combination, value
+    combination) tuples for a grid batch, in the order used by netpyne
+    (grouped params first)."""
+
+    groupParams = [p for p in params if p.get('group', False)]
+    gridParams = [p for p in params if not p.get('group', False)]
+    labels = [p['label'] for p in groupParams + gridParams]
+
+    if groupParams:
+        groupCombs = zip(zip(*[range(len(p['values'])) for p in groupParams]),
+                         zip(*[p['values'] for p in groupParams]))
+    else:
+        groupCombs = [((), ())]
+    gridCombs = zip(product(*[range(len(p['values'])) for p in gridParams]),
+                    product(*[p['values'] for p in gridParams]))
+
+    combs = []
+    for iCombG, pCombG in groupCombs:
+        for iCombNG, pCombNG in gridCombs:
+            combs.append((tuple(iCombG) + tuple(iCombNG), tuple(pCombG) + tuple(pCombNG)))
+    return labels, combs
+
+
+def get_simLabel(batchLabel, iComb):
+    """Returns the netpyne simLabel for a param index combination."""
+    return batchLabel + ''.join(['_' + str(i) for i in iComb])
+
+
+def load_cfg(cfgFile):
+    """Imports a cfg.py file and returns its SimConfig object."""
+    cfgModuleName = os.path.basename(cfgFile).split('.')[0]
+    cfgModule = imp.load_source(cfgModuleName, cfgFile)
+    return cfgModule.cfg
+
+
+def set_cfg_param(cfg, paramLabel, paramVal):
+    """Sets a (possibly nested, e.g. ('NetStim1', 'weight', 0)) param in cfg."""
+    if isinstance(paramLabel, (tuple, list)):
+        container = cfg
+        for ip in range(len(paramLabel)-1):
+            if isinstance(container, specs.SimConfig):
+                container = getattr(container, paramLabel[ip])
+            else:
+                container = container[paramLabel[ip]]
+        container[paramLabel[-1]] = paramVal
+    else:
+        setattr(cfg, paramLabel, paramVal)
+
+
+def json_default(obj):
+    """Converts numpy types for json.dump."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+def cfg_digest(cfg, ignore=cacheIgnoreKeys):
+    """Returns a canonical json string of the cfg values that affect output."""
+    cfgDict = dict((k, v) for k, v in cfg.__dict__.iteritems() if k not in ignore)
+    return json.dumps(cfgDict, sort_keys=True, default=json_default)
+
+
+def file_digest(filename):
+    """Returns the sha1 hexdigest of a file's contents."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fileObj:
+        for chunk in iter(lambda: fileObj.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def model_digest(netParamsFile, simdir=simdir):
+    """Returns a digest of everything besides cfg that determines a simulation:
+    the netParams file, the cell model sources and the mod file set."""
+
+    cellsdir = os.path.join(simdir, "cells")
+    moddir = os.path.join(simdir, "mod")
+
+    files = [netParamsFile]
+    files.extend(sorted([os.path.join(cellsdir, f) for f in os.listdir(cellsdir) if f.endswith(('.py', '.hoc'))]))
+    files.extend(sorted([os.path.join(moddir, f) for f in os.listdir(moddir) if f.endswith(('.mod', '.inc'))]))
+    for archdir in ["x86_64", "i386"]:
+        modfunc = os.path.join(moddir, archdir, "mod_func.c")
+        if os.path.isfile(modfunc):
+            files.append(modfunc)
+
+    sha = hashlib.sha1()
+    for filename in files:
+        sha.update(os.path.basename(filename) + file_digest(filename))
+    return sha.hexdigest()
+
+
+def cache_path(key, cachedir=cachedir):
+    """Returns the location of a cached simulation output."""
+    return os.path.join(cachedir, key[:2], key + '.json')
+
+
+def batch_sim_keys(b):
+    """Returns an OrderedDict of simLabel: cache key for every grid point of a
+    netpyne Batch object."""
+
+    cfg = load_cfg(b.cfgFile)
+    if b.runCfg.get('splitPops'):
+        cfg.pops = list(b.runCfg['splitPops'])  # as in the merged outputs
+    modelKey = model_digest(b.netParamsFile)
+    labels, combs = grid_combinations(b.params)
+
+    simKeys = OrderedDict()
+    for iComb, pComb in combs:
+        for paramLabel, paramVal in zip(labels, pComb):
+            set_cfg_param(cfg, paramLabel, paramVal)
+        sha = hashlib.sha1(modelKey)
+        sha.update(cfg_digest(cfg))
+        simKeys[get_simLabel(b.batchLabel, iComb)] = sha.hexdigest()
+    return simKeys
+
+
+def is_master():
+    """Returns True unless running as a non-root MPI rank."""
+    from neuron import h
+    return int(h.ParallelContext().id()) == 0
+
+
+def link_file(source, target):
+    """Hard links (or, across filesystems, copies) source to target, replacing
+    target atomically."""
+    tmpName = target + '.tmp'
+    if os.path.lexists(tmpName):
+        os.remove(tmpName)
+    try:
+        os.link(source, tmpName)
+    except OSError:
+        shutil.copyfile(source, tmpName)
+    os.rename(tmpName, target)
+
+
+def stored_done(b):
+    """Returns the set of simLabels of a batch's store that count as done:
+    all of them, or, if the batch has run with the result cache, those whose
+    recorded cache key (see update_cache) is still current."""
+
+    import batch_store
+
+    stored = batch_store.stored_simLabels(b.saveFolder, b.batchLabel)
+    keysFile = os.path.join(b.saveFolder, b.batchLabel + '_cachekeys.json')
+    if not stored or not os.path.isfile(keysFile):
+        return stored
+    oldKeys = load_json(keysFile)
+    simKeys = batch_sim_keys(b)
+    return set(simLabel for simLabel in stored if oldKeys.get(simLabel) == simKeys.get(simLabel))
+
+
+def prepare_cache(b, cachedir=cachedir, cells=False):
+    """Links cached outputs into the batch saveFolder and removes outputs (json
+    files and stored simulations) that don't match their current cache key,
+    so netpyne's 'skip' only skips valid results.  With cells, also
+    assembles outputs from cached populations (see batch_dedup.link_cells).
+    Returns the simLabel: key dict for update_cache."""
+
+    import batch_store
+
+    simKeys = batch_sim_keys(b)
+    if not is_master():
+        return simKeys
+    stored = batch_store.stored_simLabels(b.saveFolder, b.batchLabel)
+
+    if not os.path.isdir(b.saveFolder):
+        os.makedirs(b.saveFolder)
+    keysFile = os.path.join(b.saveFolder, b.batchLabel + '_cachekeys.json')
+    oldKeys = load_json(keysFile) if os.path.isfile(keysFile) else {}
+
+    stale = [simLabel for simLabel in stored if oldKeys.get(simLabel) != simKeys.get(simLabel)]
+    if stale:
+        batch_store.drop_simLabels(b.saveFolder, b.batchLabel, stale)
+        stored = stored.difference(stale)
+
+    hits = 0
+    for simLabel, key in simKeys.iteritems():
+        outFile = os.path.join(b.saveFolder, simLabel + '.json')
+        if simLabel in stored:
+            continue
+        if os.path.isfile(cache_path(key, cachedir)):
+            link_file(cache_path(key, cachedir), outFile)
+            hits += 1
+        elif os.path.isfile(outFile) and oldKeys.get(simLabel) != key:
+            print("Removing stale output: " + outFile)
+            os.remove(outFile)
+
+    print("Result cache: %d of %d simulations found in %s" % (hits, len(simKeys), cachedir))
+
+    if cells:
+        import batch_dedup
+        cellKeys, cellHits = batch_dedup.link_cells(b, cachedir)
+        with open(os.path.join(b.saveFolder, b.batchLabel + '_cellkeys.json'), 'w') as fileObj:
+            json.dump(cellKeys, fileObj, indent=2)
+        print("Cell cache: %d more simulations assembled from cached cells" % (cellHits))
+    return simKeys
+
+
+def update_cache(b, simKeys, cachedir=cachedir, cells=False):
+    """Stores new batch outputs in the result cache and records their keys.
+    With cells, also splits them into the per-cell cache."""
+
+    if not is_master():
+        return
+
+    for simLabel, key in simKeys.iteritems():
+        outFile = os.path.join(b.saveFolder, simLabel + '.json')
+        cached = cache_path(key, cachedir)
+        if os.path.isfile(outFile) and not os.path.isfile(cached):
+            if not os.path.isdir(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached))
+            link_file(outFile, cached)
+
+    keysFile = os.path.join(b.saveFolder, b.batchLabel + '_cachekeys.json')
+    with open(keysFile, 'w') as fileObj:
+        json.dump(simKeys, fileObj, indent=2)
+
+    cellKeysFile = os.path.join(b.saveFolder, b.batchLabel + '_cellkeys.json')
+    if cells and os.path.isfile(cellKeysFile):
+        import batch_dedup
+        batch_dedup.store_cells(b, load_json(cellKeysFile), cachedir)
+
+
+def readBatchData(dataFolder, batchLabel, loadAll=False, saveAll=True, vars=None, maxCombs=None, listCombs=None, processes=1):
+    """Returns the params and data (iCombStr: output) of a batch.  Grid
+    points without a json output are read from the batch's binary store, if
+    it has one (see batch_store); their traces are then arrays.  vars lists
+    the fields to read, as top-level keys or dotted paths (e.g.
+    'simData.V_soma.cell_1'); any other field of an output is read when it
+    is first used (see batch_fields).  json outputs are decoded (whole if
+    there are no vars) in this process if processes is 1, else in that many
+    worker processes (None: one per core); stored outputs are read whole
+    with saveAll and no vars.  Outputs that can't be decoded are reported
+    apart from missing ones and left out of data."""
+    import batch_store
+    import batch_fields
 
-def readBatchData(dataFolder, batchLabel, loadAll=False, saveAll=True, vars=None, maxCombs=None, listCombs=None):
     # load from previously saved file with all data
     if loadAll:
         print '\nLoading single file with all data...'
@@ -87,39 +1209,69 @@ def readBatchData(dataFolder, batchLabel, loadAll=False, saveAll=True, vars=None
     # read params labels and ranges
     params = b['params']
 
+    store = batch_store.load_store(b['saveFolder'], b['batchLabel'])
+    fields = [batch_fields.field_path(var) for var in vars] if vars else None
+
     # read vars from all files - store in dict 
     if b['method'] == 'grid':
-        labelList, valuesList = zip(*[(p['label'], p['values']) for p in params])
-        valueCombinations = product(*(valuesList))
-        indexCombinations = product(*[range(len(x)) for x in valuesList])
+        labelList = [p['label'] for p in params]
+        combLabels, combs = grid_combinations(params)
+        paramOrder = [combLabels.index(label) for label in labelList]
         data = {}
         print 'Reading data...'
         missing = 0
-        for i,(iComb, pComb) in enumerate(zip(indexCombinations, valueCombinations)):
+        errors = OrderedDict()
+        jobs = OrderedDict()  # iCombStr: (simLabel, outFile, pComb) of the json outputs
+        for i,(iComb, pComb) in enumerate(combs):
+            pComb = tuple(pComb[index] for index in paramOrder)  # in params order
             if (not maxCombs or i<= maxCombs) and (not listCombs or list(pComb) in listCombs):
                 #print i, iComb
                 # read output file
                 iCombStr = ''.join([''.join('_'+str(i)) for i in iComb])
                 simLabel = b['batchLabel']+iCombStr
                 outFile = b['saveFolder']+'/'+simLabel+'.json'
+                if store is not None and simLabel in store['index'] and not os.path.isfile(outFile):
+                    fetch = batch_fields.store_fetcher(store, simLabel)
+                else:
+                    jobs[iCombStr] = (simLabel, outFile, pComb)
+                    continue
                 try:
-                    with open(outFile, 'r') as fileObj:
-                        output = json.load(fileObj, object_pairs_hook=specs.OrderedDict)
-
-                    # save output file in data dict
-                    data[iCombStr] = {}  
-                    data[iCombStr]['paramValues'] = pComb  # store param values
-                    if not vars: vars = output.keys()
-                    for key in vars:
-                        data[iCombStr][key] = output[key]
-
-                except:
-                    missing = missing + 1
-                    output = {}
+                    if saveAll and not fields:
+                        output = fetch()
+                    else:
+                        output = batch_fields.lazy_output(fetch, fields)
+                except Exception as error:
+                    errors[simLabel] = batch_fields.decode_error(error)
+                    continue
+
+                # save output file in data dict
+                data[iCombStr] = output
+                data[iCombStr]['paramValues'] = pComb  # store param values
             else:
                 missing = missing + 1
 
+        decodeJobs = [(iCombStr, outFile, fields) for iCombStr, (simLabel, outFile, pComb) in jobs.iteritems()]
+        for iCombStr, status, values in batch_fields.decode_outputs(decodeJobs, processes):
+            simLabel, outFile, pComb = jobs[iCombStr]
+            if status == 'missing':
+                missing = missing + 1
+                continue
+            if status == 'error':
+                errors[simLabel] = values
+                continue
+            if fields:
+                values = batch_fields.lazy_output(batch_fields.json_fetcher(outFile), fields, values)
+            data[iCombStr] = values
+            data[iCombStr]['paramValues'] = pComb  # store param values
+
         print '%d files missing' % (missing)
+        if errors:
+            print '%d files could not be read:' % (len(errors))
+            for simLabel in sorted(errors):
+                print '  %s: %s' % (simLabel, errors[simLabel])
+
+        if 'sampling' in b:
+            params, data = sampled_params(b, data)
 
         # save
         if saveAll:
@@ -127,11 +1279,57 @@ def readBatchData(dataFolder, batchLabel, loadAll=False, saveAll=True, vars=None
             filename = '%s/%s/%s_allData.json' % (dataFolder, batchLabel, batchLabel)
             dataSave = {'params': params, 'data': data}
             with open(filename, 'w') as fileObj:
-                json.dump(dataSave, fileObj)
+                json.dump(dataSave, fileObj, default=json_default)
         
         return params, data
 
 
+def sampled_params(b, data):
+    """Converts the params and data of a sampled batch (see make_sampled_batch)
+    to a single 'sample' param with values 0..N-1, so the batch_analysis
+    measures give one value per sample.  The sampled param values are kept in
+    the param's 'samples' (label: values) and in each datum's 'sampleValues'."""
+
+    samples = OrderedDict((p['label'], p['values']) for p in b['params'])
+    numSamples = len(b['params'][0]['values'])
+    sampleParam = {'label': 'sample', 'values': range(numSamples), 'sampling': b['sampling'], 'samples': samples}
+
+    sampleData = {}
+    for iCombStr, datum in data.iteritems():
+        index = int(iCombStr.split('_')[1])
+        datum['sampleValues'] = datum['paramValues']
+        datum['paramValues'] = [index]
+        sampleData['_' + str(index)] = datum
+    return [sampleParam], sampleData
+
+
+def pad_truncated(output):
+    """Pads the traces of a simulation that stopped early (simData['earlyStop'],
+    see batch_sim.run_sim) to the full duration.  The monitored trace is held
+    at each cell's recorded pre-stimulus baseline (see
+    batch_sim.early_stop_monitor), any other trace at its final value.  The
+    earlyStop entry is kept to mark the padding, with 'padded' set so the
+    traces aren't padded twice."""
+
+    simData = output.get('simData', {})
+    earlyStop = simData.get('earlyStop')
+    if not earlyStop or earlyStop.get('padded'):
+        return output
+    recordStep = output['simConfig']['recordStep'] if 'simConfig' in output else 0.1
+    padSamples = int(round((earlyStop['duration'] - earlyStop['tstop']) / recordStep))
+    baselines = earlyStop.get('baselines', {})
+    for trace in earlyStop['traces']:
+        for cellLabel, vtrace in simData.get(trace, {}).iteritems():
+            if vtrace:
+                value = baselines[cellLabel] if trace == earlyStop.get('trace') and cellLabel in baselines else vtrace[-1]
+                vtrace.extend([value] * padSamples)
+    if 't' in simData and simData['t']:
+        tstart = simData['t'][-1]
+        simData['t'].extend([tstart + recordStep * (i + 1) for i in range(padSamples)])
+    earlyStop['padded'] = True
+    return output
+
+
 def compare(source_file, target_file, source_key=None, target_key=None):
     from deepdiff import DeepDiff 
     with open(source_file, 'r') as fileObj:
@@ -189,7 +1387,7 @@ def list_batches():
 
 def load_batch(batchLabel):
     """Returns the parameters and data from a batch, given its batchLabel."""
-    params, data = readBatchData(batchdatadir, batchLabel, loadAll=0, saveAll=0, vars=None, maxCombs=None) 
+    params, data = readBatchData(batchdatadir, batchLabel, loadAll=0, saveAll=0, vars=None, maxCombs=None, processes=loadProcesses)
     return params, data
 
 
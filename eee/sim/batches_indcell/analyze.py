@@ -24,6 +24,8 @@ if not os.path.exists(outputdir):
 
 makepdf   = False
 
+batch_analysis.batch_utils.loadProcesses = None  # decode batch outputs on all cores
+
 bap_branch = "basal_34"  #Bdend1
 
 plt.ion()
@@ -0,0 +1,112 @@
+"""
+benchmark_cvode.py
+Compares CVODE (cfg.cvode_active) with the candidate tolerances in
+cvodeTolerances to the fixed step reference for the batches in
+my_batches.py: speedup and the errors in plateau amplitude, plateau
+duration and spike times.  The model runs fixed step unless a batch sets
+cvode_active; these tolerances aren't validated until this has been run.
+Usage: python benchmark_cvode.py [batchLabel ...]
+contact: joe.w.graham@gmail.com
+"""
+
+from collections import OrderedDict
+import numpy as np
+import os
+import sys
+
+try:
+	import batch_utils
+except:
+	curpath = os.getcwd()
+	while os.path.split(curpath)[1] != "sim":
+		oldpath = curpath
+		curpath = os.path.split(curpath)[0]
+		if oldpath == curpath:
+			raise Exception("Couldn't find sim directory. Try running from within eee/sim file tree.")
+	sys.path.append(curpath)
+	import batch_utils
+
+import batch_analysis
+from my_batches import batches, batchoutputdir
+from cfg import cfg
+
+# candidate CVODE tolerances (batch params): absolute tolerance in mV, scaled
+# per state to its magnitude
+cvodeTolerances = OrderedDict([
+	('cvode_atol', [1e-3]),
+	('cvode_atolscale', [{'NMDAeee.Ron': 1e-2, 'NMDAeee.Roff': 1e-2, 'ca_cad': 1e-4, 'p_kBK': 1e-2}])])
+
+
+def measure(vtrace):
+	"""Returns the plateau amplitude, plateau duration and spike times of a trace."""
+	vtrace = np.array(vtrace)
+	platamp = batch_analysis.meas_trace_plat_amp(vtrace, recstep=cfg.recordStep)[0]
+	platdur = batch_analysis.meas_trace_plat_dur(vtrace, recstep=cfg.recordStep)[0]
+	spiketimes = batch_analysis.meas_trace_spike_times(vtrace, recstep=cfg.recordStep)[0]
+	return platamp, platdur, spiketimes
+
+
+def compare(label, trace="V_soma"):
+	"""Returns a list of (paramValues, cellLabel, speedup, platamp error,
+	platdur error, spike time error) for a batch run with and without CVODE.
+	The spike time error is nan if the spike counts differ."""
+
+	params, data = batch_utils.readBatchData(batchoutputdir, label, saveAll=False, vars=['simData'])
+	cvodeIndex = [p['label'] for p in params].index('cvode_active')
+
+	runs = {}
+	for datum in data.itervalues():
+		paramValues = list(datum['paramValues'])
+		cvode = paramValues.pop(cvodeIndex)
+		runs.setdefault(repr(paramValues), {})[cvode] = datum['simData']
+
+	results = []
+	for paramValues, pair in sorted(runs.iteritems()):
+		if False not in pair or True not in pair:
+			continue
+		fixed, cvode = pair[False], pair[True]
+		speedup = fixed['runWallTime'] / cvode['runWallTime']
+		for cellLabel in fixed[trace]:
+			amp0, dur0, spikes0 = measure(fixed[trace][cellLabel])
+			amp1, dur1, spikes1 = measure(cvode[trace][cellLabel])
+			if len(spikes0) != len(spikes1):
+				spikeerr = np.nan
+			elif spikes0:
+				spikeerr = np.max(np.abs(np.array(spikes1) - np.array(spikes0)))
+			else:
+				spikeerr = 0.0
+			results.append((paramValues, cellLabel, speedup, amp1 - amp0, dur1 - dur0, spikeerr))
+	return results
+
+
+if __name__ == '__main__':
+
+	labels = sys.argv[1:] or batches.keys()
+	runCfg = {'type': 'pool'}
+
+	allResults = []
+	for label in labels:
+		batch = dict(batches[label])
+		batch["label"] = label + "_cvode"
+		batch["params"] = OrderedDict(batch["params"])
+		batch["params"]["cvode_active"] = [False, True]
+		batch["params"].update(cvodeTolerances)
+		print("Running batch with label: " + batch["label"])
+		batch_utils.run_batch(cache=True, runCfg=runCfg, **batch)
+
+		results = compare(batch["label"])
+		allResults.extend(results)
+		print
+		print("%-40s %-8s %8s %10s %10s %10s" % (label, "cell", "speedup", "dAmp(mV)", "dDur(ms)", "dSpk(ms)"))
+		for paramValues, cellLabel, speedup, amperr, durerr, spikeerr in results:
+			print("%-40s %-8s %8.2f %10.3f %10.3f %10.3f" % (paramValues, cellLabel, speedup, amperr, durerr, spikeerr))
+
+	if allResults:
+		speedups, amperrs, durerrs, spikeerrs = zip(*[result[2:] for result in allResults])
+		spikeerrs = np.array(spikeerrs)
+		print
+		print("Median speedup          : %.2f" % np.median(speedups))
+		print("Max plateau amp error   : %.3f mV" % np.max(np.abs(amperrs)))
+		print("Max plateau dur error   : %.3f ms" % np.max(np.abs(durerrs)))
+		print("Max spike time error    : %.3f ms" % np.nanmax(np.append(spikeerrs, 0.0)))
+		print("Spike count mismatches  : %d of %d" % (np.sum(np.isnan(spikeerrs)), len(spikeerrs)))
@@ -0,0 +1,118 @@
+"""
+benchmark_threads.py
+Checks multithreaded runs (cfg.nthreads, see batch_sim.setup_threads)
+against a single thread on this model: for each recorded trace, the max
+voltage difference and the errors in plateau amplitude, plateau duration
+and spike times, and the speedup.  Each run is a forked process.  NEURON
+stops a multithreaded run if a mechanism in the model isn't THREADSAFE;
+cad, kl, AMPA, ca, kap, kv and na aren't (they assign GLOBALs).
+Needs the mod files compiled in this directory (nrnivmodl ../../mod).
+Usage: python benchmark_threads.py [nthreads ...]   (default: 2 4)
+contact: joe.w.graham@gmail.com
+"""
+
+import json
+import numpy as np
+import os
+import sys
+
+try:
+	import batch_utils
+except:
+	curpath = os.getcwd()
+	while os.path.split(curpath)[1] != "sim":
+		oldpath = curpath
+		curpath = os.path.split(curpath)[0]
+		if oldpath == curpath:
+			raise Exception("Couldn't find sim directory. Try running from within eee/sim file tree.")
+	sys.path.append(curpath)
+	import batch_utils
+
+import batch_analysis
+import batch_sim
+from my_batches import batchoutputdir
+from cfg import cfg
+
+benchdir = os.path.join(batchoutputdir, "benchmark_threads")
+
+
+def output_file(nthreads):
+	return os.path.join(benchdir, "nthreads_%d.json" % (nthreads))
+
+
+def run(nthreads):
+	"""Runs the model on nthreads threads and saves its traces and wall time."""
+	from netpyne import sim
+	cfg.nthreads = nthreads
+	cfg.checkErrors = False
+	batch_sim.build_model(cfg, "netParams.py")
+	batch_sim.run_sim()
+	traces = dict((trace, dict((cellLabel, list(vtrace)) for cellLabel, vtrace in sim.simData[trace].items()))
+				  for trace in cfg.recordTraces)
+	with open(output_file(nthreads), 'w') as fileObj:
+		json.dump({'runWallTime': sim.simData['runWallTime'], 't': list(sim.simData['t']), 'traces': traces}, fileObj)
+
+
+def measure(vtrace):
+	"""Returns the plateau amplitude, plateau duration and spike times of a trace."""
+	vtrace = np.array(vtrace)
+	platamp = batch_analysis.meas_trace_plat_amp(vtrace, recstep=cfg.recordStep)[0]
+	platdur = batch_analysis.meas_trace_plat_dur(vtrace, recstep=cfg.recordStep)[0]
+	spiketimes = batch_analysis.meas_trace_spike_times(vtrace, recstep=cfg.recordStep)[0]
+	return platamp, platdur, spiketimes
+
+
+def compare(reference, output):
+	"""Returns a list of (trace, cellLabel, max voltage difference, platamp
+	error, platdur error, spike time error) of an output against the single
+	thread reference.  The spike time error is nan if the spike counts differ."""
+
+	results = []
+	for trace in sorted(reference['traces']):
+		for cellLabel in sorted(reference['traces'][trace]):
+			v0 = np.array(reference['traces'][trace][cellLabel])
+			v1 = np.array(output['traces'][trace][cellLabel])
+			if len(v0) != len(v1):
+				results.append((trace, cellLabel, np.nan, np.nan, np.nan, np.nan))
+				continue
+			amp0, dur0, spikes0 = measure(v0)
+			amp1, dur1, spikes1 = measure(v1)
+			if len(spikes0) != len(spikes1):
+				spikeerr = np.nan
+			elif spikes0:
+				spikeerr = np.max(np.abs(np.array(spikes1) - np.array(spikes0)))
+			else:
+				spikeerr = 0.0
+			results.append((trace, cellLabel, np.max(np.abs(v1 - v0)), amp1 - amp0, dur1 - dur0, spikeerr))
+	return results
+
+
+if __name__ == '__main__':
+
+	threadCounts = [int(arg) for arg in sys.argv[1:]] or [2, 4]
+	if not os.path.isdir(benchdir):
+		os.makedirs(benchdir)
+
+	outputs = {}
+	for nthreads in [1] + threadCounts:
+		print("Running on %d threads" % (nthreads))
+		status = batch_sim.wait_children({batch_sim.fork_call(run, nthreads): nthreads}).values()[0]
+		if status != 0:
+			print("Run on %d threads failed (see the error above)" % (nthreads))
+			continue
+		with open(output_file(nthreads), 'r') as fileObj:
+			outputs[nthreads] = json.load(fileObj)
+
+	if 1 not in outputs:
+		sys.exit(1)
+	reference = outputs[1]
+	for nthreads in threadCounts:
+		if nthreads not in outputs:
+			continue
+		output = outputs[nthreads]
+		print
+		print("%d threads: speedup %.2f, t %s" % (nthreads, reference['runWallTime'] / output['runWallTime'],
+			"matches" if output['t'] == reference['t'] else "differs"))
+		print("%-12s %-8s %10s %10s %10s %10s" % ("trace", "cell", "dV(mV)", "dAmp(mV)", "dDur(ms)", "dSpk(ms)"))
+		for trace, cellLabel, verr, amperr, durerr, spikeerr in compare(reference, output):
+			print("%-12s %-8s %10.4f %10.3f %10.3f %10.3f" % (trace, cellLabel, verr, amperr, durerr, spikeerr))
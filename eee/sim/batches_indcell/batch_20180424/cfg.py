@@ -27,9 +27,16 @@ cfg.dt = 0.05
 cfg.seeds = {'conn': 4321, 'stim': 1234, 'loc': 4321} 
 cfg.hParams = {'celsius': 32}  
 cfg.verbose = 0
-cfg.cvode_active = False
+cfg.cvode_active = False  # fixed step; CVODE (with cvode_atol, cvode_atolscale) is opt-in, see benchmark_cvode.py
+cfg.nthreads = 1  # >1 splits each cell over threads (multisplit, fixed step only; needs every mechanism THREADSAFE, see benchmark_threads.py)
 cfg.printRunTime = 0.1
 cfg.printPopAvgRates = True
+# stop once V_soma is back at baseline after the synaptic input (see batch_sim.run_sim)
+# e.g. {'trace': 'V_soma', 'tol': 2.5, 'window': 50.0}; True uses the defaults
+cfg.earlyStop = False
+# save the state every 'every' s of wall time; a rerun resumes from the last checkpoint
+# e.g. {'every': 600.0}; True uses the defaults (see batch_sim.run_sim)
+cfg.checkpoint = False
 
 
 ###############################################################################
@@ -25,6 +25,20 @@ batchoutputdir = "batch_data"
 if not os.path.exists(batchoutputdir):
 	os.mkdir(batchoutputdir)
 
+# 'mpi' : run with ./runmybatches (mpiexec)
+# 'pool': run with python my_batches.py, uses all local cores
+# 'fork': as 'pool', but builds the model once and reuses it for runtime params
+# 'hot' : one process, one model build; only for params in batch_sim.hotParams
+# 'queue': as 'pool', and other machines sharing batch_data can join with
+#          python ../../batch_queue.py batch_data/<label> [cores]
+# With 'pool' or 'queue', add 'splitPops': ['eeeD', 'eeeS'] to run each pop as its own
+# job (outputs are merged), or 'splitPops': ['eeeS'] to run only eeeS
+# With 'fork' or 'hot', add 'warmStart': True to simulate the first synTime ms once and
+# continue every glutAmp/NMDA-style grid point from that saved state
+# 'store': True packs each batch's outputs into batch_data/<label>/<label>_store.npz
+# python ../../batch_planner.py predicts run time, memory, disk and workers beforehand
+runCfg = {'type': 'mpi'}
+
 
 
 ###############################################################################
@@ -75,6 +89,34 @@ batches[batch["label"]] = batch
 # batch["params"] = params
 # batches[batch["label"]] = batch
 
+# # Finding plateau onset in glutAmp adaptively (needs runCfg type 'pool', 'fork' or 'hot')
+# batch = {}
+# batch["label"] = "glutAmp_adaptive"
+# batch["cfgFile"] = "cfg.py"
+# batch["netParamsFile"] = "netParams.py"
+# params = OrderedDict()
+# params["glutAmp"] = list(np.linspace(0., 5.0, 6).round(2))
+# batch["params"] = params
+# batch["method"] = "adaptive"
+# batch["adaptive"] = {"param": "glutAmp", "measure": "plat_dur", "resolution": 0.05}
+# batches[batch["label"]] = batch
+
+# # Sampling conductance scales with a Sobol sequence ('sobol', 'halton' or 'lhs')
+# batch = {}
+# batch["label"] = "scales_sobol"
+# batch["cfgFile"] = "cfg.py"
+# batch["netParamsFile"] = "netParams.py"
+# params = OrderedDict()
+# params["dendKScale"] = [0.25, 4.0]
+# params["dendCaScale"] = [0.25, 4.0]
+# params["allNaScale"] = [0.25, 4.0]
+# params["NMDABetaScale"] = [3.5, 56.0]
+# params["RmScale"] = [0.5, 2.0]
+# batch["params"] = params
+# batch["method"] = "sobol"
+# batch["sampling"] = {"samples": 256, "seed": 0, "log": ["dendKScale", "dendCaScale", "allNaScale", "NMDABetaScale"]}
+# batches[batch["label"]] = batch
+
 # #cfg.NMDABetaScale  = 14.0
 # batch = {}
 # batch["label"] = "NMDABetaScale"
@@ -177,10 +219,11 @@ if __name__ == '__main__':
 	import time
 	start = time.time()
 
-	# Run all batches
-	for label, batch in batches.items():
-		print("Running batch with label: " + label)
-		batch_utils.run_batch(**batch)
+	# Run all batches ('pool' runs them concurrently from one job queue)
+	# cache='cells' reuses each cell's earlier results, e.g. eeeD when only an eeeS param changes
+	# (it builds netParams for every grid point and shares batch_cache between batches)
+	# dryRun=True checks every grid point's params and netParams and estimates the output size instead
+	batch_utils.run_batches(batches.values(), cache=True, runCfg=runCfg)
 
 	stop = time.time()
 	print
@@ -192,7 +235,7 @@ if __name__ == '__main__':
 	print("Current process:")
 	print(psutil.Process())
 	
-	if 'python' not in psutil.Process().name():
+	if runCfg['type'] == 'mpi' and 'python' not in psutil.Process().name():
 		print("Parent process:")
 		print(psutil.Process().parent())
 		print("Attempting to terminate grandparent process:")
@@ -203,14 +203,19 @@ for cell_label, cell_params in netParams.cellParams.iteritems():
 netParams.popParams['eeeD']= {'cellModel':'PFC_full', 'cellType':'eeeD', 'numCells':1}
 netParams.popParams['eeeS']= {'cellModel':'PFC_simp', 'cellType':'eeeS', 'numCells':1}
 
+# only create cfg.pops, if given (batch runCfg 'splitPops' runs each pop as its own job)
+if getattr(cfg, 'pops', None):
+    for popLabel in netParams.popParams.keys():
+        if popLabel not in cfg.pops:
+            del netParams.popParams[popLabel]
+
 
 ###############################################################################
 # Synaptic mechanism parameters
 ###############################################################################
 
-netParams.synMechParams['NMDA'] = {'mod': 'NMDAeee', 'Cdur': cfg.CdurNMDAScale * 1.0, 'Alpha': cfg.NMDAAlphaScale * 4.0, 'Beta': cfg.NMDABetaScale * 0.0015, 'gmax': cfg.NMDAgmax}
-
-netParams.synMechParams['AMPA'] = {'mod': 'AMPA', 'gmax': cfg.ratioAMPANMDA * cfg.NMDAgmax}
+for synMechLabel, synMech in batch_utils.synmech_params(cfg).iteritems():
+    netParams.synMechParams[synMechLabel] = synMech
 
 #h.gmax_NMDAeee = cfg.NMDAgmax 
 #h.gmax_AMPA = cfg.ratioAMPANMDA * cfg.NMDAgmax
@@ -225,44 +230,12 @@ if cfg.addNetStim:
 
         for cur_pop in ns['pop']:
 
+            if cur_pop not in netParams.popParams:
+                continue
+
             branch_length = netParams.cellParams[cur_pop]['secs'][ns['sec']]['geom']['L']
                 
-            if "ExSyn" in nslabel:
-                cur_locs = np.linspace(cfg.synLocMiddle-cfg.synLocRadius, cfg.synLocMiddle+cfg.synLocRadius, cfg.numExSyns)
-                cur_dists = branch_length * np.abs(cur_locs - cfg.synLocMiddle)
-                cur_weights = (cfg.glutAmp * cfg.glutAmpExSynScale) * (1 - cur_dists * cfg.glutAmpDecay/100)
-                cur_weights = [weight if weight > 0.0 else 0.0 for weight in cur_weights]
-                cur_delays = cfg.initDelay + (cfg.exSynDelay * cur_dists)
-                # print
-                # print("ExSyn")
-                # print("locs")
-                # print(cur_locs)
-                # print("dists")
-                # print(cur_dists)
-                # print("delays:")
-                # print(cur_delays)
-                # print("weights:")
-                # print(cur_weights)
-            
-            elif "Syn" in nslabel:
-                cur_locs = np.linspace(cfg.synLocMiddle-cfg.synLocRadius, cfg.synLocMiddle+cfg.synLocRadius, cfg.numSyns)
-                cur_dists = branch_length * np.abs(cur_locs - cfg.synLocMiddle)
-                cur_weights = cfg.glutAmp * (1 - cur_dists * cfg.glutAmpDecay/100)
-                cur_weights = [weight if weight > 0.0 else 0.0 for weight in cur_weights]
-                cur_delays = cfg.initDelay + (cfg.synDelay * cur_dists)
-                # print
-                # print("Syn")
-                # print("locs")
-                # print(cur_locs)
-                # print("dists")
-                # print(cur_dists)
-                # print("delays:")
-                # print(cur_delays)
-                # print("weights:")
-                # print(cur_weights)
-            
-            else:
-                raise Exception("NetStim must have Syn or ExSyn in name")
+            cur_locs, cur_weights, cur_delays = batch_utils.netstim_syns(cfg, nslabel, branch_length)
 
             # add stim source
             netParams.stimSourceParams[nslabel] = {'type': 'NetStim', 'start': ns['start'], 'interval': ns['interval'], 'noise': ns['noise'], 'number': ns['number']}
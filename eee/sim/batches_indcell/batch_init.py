@@ -11,39 +11,68 @@ Contributors: salvadordura@gmail.com
 """
 
 from netpyne import sim
+import os
+import sys
+
+try:
+	import batch_sim
+except ImportError:
+	curpath = os.getcwd()
+	while os.path.split(curpath)[1] != "sim":
+		oldpath = curpath
+		curpath = os.path.split(curpath)[0]
+		if oldpath == curpath:
+			raise Exception("Couldn't find sim directory. Try running from within eee/sim file tree.")
+	sys.path.append(curpath)
+	import batch_sim
+import batch_telemetry
+from batch_telemetry import phase
 
 # read cfg and netParams from command line arguments
 # if there are no command line args, looks for cfg.py and netParams.py in curdir
 # Reads command line arguments using syntax: python file.py [simConfig=filepath] [netParams=filepath]
-cfg, netParams = sim.readCmdLineArgs()
+with phase('loadParams'):
+	cfg, netParams = sim.readCmdLineArgs()
 
 # create network object and set cfg and net params	
-sim.initialize(simConfig = cfg, netParams = netParams)
+with phase('initialize'):
+	sim.initialize(simConfig = cfg, netParams = netParams)
 
 # instantiate network populations 
-sim.net.createPops()
+with phase('createPops'):
+	sim.net.createPops()
 
 # instantiate network cells based on defined populations
-sim.net.createCells()
+with phase('createCells'):
+	sim.net.createCells()
 
 # create connections between cells based on params
-sim.net.connectCells()
+with phase('connectCells'):
+	sim.net.connectCells()
 
 # add network stimulation
-sim.net.addStims()
+with phase('addStims'):
+	sim.net.addStims()
 
 # setup variables to record for each cell (spikes, V traces, etc)								
-sim.setupRecording()
+with phase('setupRecording'):
+	sim.setupRecording()
 
-# run parallel Neuron simulation 
-sim.runSim()
+# run parallel Neuron simulation (stops early if cfg.earlyStop is set)
+with phase('runSim'):
+	batch_sim.run_sim()
 
 # gather spiking data and cell info from each node
-sim.gatherData()
+with phase('gatherData'):
+	sim.gatherData()
 
-# save params, cell info and sim output to file (pickle,mat,txt,etc)
-sim.saveData()
+# save params, cell info and sim output to file (pickle,mat,txt,etc), renamed into place when complete
+with phase('saveData'):
+	batch_sim.save_data()
 
 # plot spike raster
-sim.analysis.plotData()
+with phase('plotData'):
+	sim.analysis.plotData()
 
+# append the wall time and peak memory of each phase to the batch metrics file
+batch_telemetry.save(sim)
@@ -13,6 +13,7 @@ INDEPENDENT {t FROM 0 TO 1 WITH 1 (ms)}
 
 NEURON {
 	SUFFIX it
+	THREADSAFE
 	USEION ca READ eca WRITE ica
 	RANGE m, h, gca, gbar, vshift, v12m, v12h, vh1, vh2, ah, am, vm1, vm2
 	RANGE minf, hinf, mtau, htau, inactF, actF
@@ -3,6 +3,7 @@
 
 NEURON	{
 	SUFFIX Ih
+	THREADSAFE
 	NONSPECIFIC_CURRENT ihcn
 	RANGE gIhbar, gIh, ihcn
 }
@@ -70,6 +70,7 @@ ENDCOMMENT
 
 NEURON {
 	POINT_PROCESS NMDAeee
+	THREADSAFE
 	RANGE g, Alpha, Beta, e, ica, Cdur, gmax
 	USEION ca READ cai,cao WRITE ica :USEION ca WRITE ica
 	NONSPECIFIC_CURRENT  iNMDA
@@ -3,6 +3,7 @@
 
 NEURON {
        SUFFIX SK_E2
+       THREADSAFE
        USEION k READ ek WRITE ik
        USEION ca READ cai
        RANGE gSK_E2bar, gSK_E2, ik
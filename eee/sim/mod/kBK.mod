@@ -6,6 +6,7 @@ TITLE large-conductance calcium-activated potassium channel (BK)
 	
 NEURON {
 	SUFFIX kBK
+	THREADSAFE
 	USEION k READ ek WRITE ik
 	USEION ca READ cai
 	RANGE gpeak, gkact, caPh, caPk, caPmax, caPmin
@@ -45,6 +45,7 @@ PARAMETER {
 
 NEURON {
 	SUFFIX kad
+	THREADSAFE
 	USEION k READ ek WRITE ik
         RANGE gkabar,gka,ik
         RANGE ninf,linf,taul,taun
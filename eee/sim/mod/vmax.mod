@@ -1,5 +1,6 @@
 NEURON {
    SUFFIX vmax
+   THREADSAFE
    RANGE vm, tpeak
 }
 
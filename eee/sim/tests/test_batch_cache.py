@@ -0,0 +1,96 @@
+"""
+test_batch_cache.py
+Tests of the result cache (batch_utils.prepare_cache, update_cache) with a
+binary store (batch_store).  Needs netpyne and NEURON.
+Run from eee/sim: python -m pytest tests
+"""
+
+from collections import OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import batch_utils
+    import batch_store
+except ImportError:
+    batch_utils = None
+
+cfgSource = """from netpyne import specs
+cfg = specs.SimConfig()
+cfg.duration = 10.0
+cfg.recordStep = 1.0
+cfg.gain = 0.0
+"""
+
+netParamsSource = """from netpyne import specs
+netParams = specs.NetParams()
+"""
+
+
+def fake_output(simLabel, gain):
+    """Returns the output a job of the test batch would save."""
+    return OrderedDict([('simConfig', {'simLabel': simLabel, 'duration': 10.0, 'recordStep': 1.0, 'gain': gain}),
+                        ('simData', OrderedDict([('t', [float(t) for t in range(10)]),
+                                                 ('V_soma', {'cell_0': [gain] * 10}),
+                                                 ('spkt', []), ('spkid', [])]))])
+
+
+@unittest.skipIf(batch_utils is None, 'needs netpyne and NEURON')
+class StoredCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        self.cfgFile = os.path.join(self.tmpdir, 'cfg.py')
+        self.netParamsFile = os.path.join(self.tmpdir, 'netParams.py')
+        with open(self.cfgFile, 'w') as fileObj:
+            fileObj.write(cfgSource)
+        with open(self.netParamsFile, 'w') as fileObj:
+            fileObj.write(netParamsSource)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_stored(self, values):
+        """Runs the test batch with the given gain values as launch_batch does
+        with the cache and a store, writing fake outputs for the jobs.
+        Returns the simLabels of the jobs run."""
+
+        b = batch_utils.make_batch('B', OrderedDict([('gain', values)]), self.cfgFile, self.netParamsFile,
+                                   batchdatadir=self.tmpdir, runCfg={'type': 'pool', 'store': True})
+        simKeys = batch_utils.prepare_cache(b, cachedir=self.cachedir)
+        jobs = batch_utils.write_batch_jobs(b)
+        for job in jobs:
+            with open(job['jobName'] + '.json', 'w') as fileObj:
+                json.dump(fake_output(job['simLabel'], job['paramValues'][0]), fileObj)
+        batch_utils.update_cache(b, simKeys, cachedir=self.cachedir)
+        batch_store.pack_batch(b.saveFolder, b.batchLabel)
+        return [job['simLabel'] for job in jobs]
+
+    def test_changed_values_rerun(self):
+        self.assertEqual(self.run_stored([0.0, 1.0]), ['B_0', 'B_1'])
+        # B_1 is now 0.5; B_2 (1.0) comes from the cache
+        self.assertEqual(self.run_stored([0.0, 0.5, 1.0]), ['B_1'])
+        self.assertEqual(self.run_stored([0.0, 0.5, 1.0]), [])
+
+        params, data = batch_utils.readBatchData(self.tmpdir, 'B')
+        for datum in data.itervalues():
+            self.assertEqual(datum['simData']['V_soma']['cell_0'][0], datum['paramValues'][0])
+
+    def test_stale_dropped_from_store(self):
+        self.run_stored([0.0, 1.0])
+        b = batch_utils.make_batch('B', OrderedDict([('gain', [0.0, 2.0])]), self.cfgFile, self.netParamsFile,
+                                   batchdatadir=self.tmpdir, runCfg={'type': 'pool', 'store': True})
+        self.assertEqual(batch_utils.stored_done(b), set(['B_0']))
+        batch_utils.prepare_cache(b, cachedir=self.cachedir)
+        self.assertEqual(batch_store.stored_simLabels(b.saveFolder, 'B'), set(['B_0']))
+
+
+if __name__ == '__main__':
+    unittest.main()
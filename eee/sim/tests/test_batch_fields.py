@@ -0,0 +1,106 @@
+"""
+test_batch_fields.py
+Tests of reading batch outputs (batch_utils.readBatchData, batch_fields).
+Needs netpyne.
+Run from eee/sim: python -m pytest tests
+"""
+
+from collections import OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import batch_utils
+    import batch_fields
+except ImportError:
+    batch_utils = None
+
+
+def write_batch(dataFolder, batchLabel, values):
+    """Writes the batch json of a batch of one param and a json output for
+    each of its values.  Returns the saveFolder."""
+
+    saveFolder = os.path.join(dataFolder, batchLabel)
+    os.makedirs(saveFolder)
+    batch = {'batchLabel': batchLabel, 'saveFolder': saveFolder, 'method': 'grid',
+             'params': [{'label': 'gain', 'values': values}]}
+    with open(os.path.join(saveFolder, batchLabel + '_batch.json'), 'w') as fileObj:
+        json.dump({'batch': batch}, fileObj)
+    for i, value in enumerate(values):
+        output = OrderedDict([('simConfig', {'recordStep': 1.0, 'gain': value}),
+                              ('simData', OrderedDict([('t', [0.0, 1.0]), ('V_soma', {'cell_0': [value, value]})]))])
+        with open(os.path.join(saveFolder, '%s_%d.json' % (batchLabel, i)), 'w') as fileObj:
+            json.dump(output, fileObj)
+    return saveFolder
+
+
+@unittest.skipIf(batch_utils is None, 'needs netpyne')
+class ReadBatchDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saveFolder = write_batch(self.tmpdir, 'B', [0.0, 1.0, 2.0])
+        with open(os.path.join(self.saveFolder, 'B_1.json'), 'w') as fileObj:
+            fileObj.write('{"simConfig": {"recordStep": 1.0}, "simData": {"t": [0.0, ')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_corrupt_output(self):
+        for processes in [1, 2]:
+            for vars in [None, ['simData.V_soma']]:
+                params, data = batch_utils.readBatchData(self.tmpdir, 'B', saveAll=False, vars=vars, processes=processes)
+                self.assertEqual(sorted(data), ['_0', '_2'])
+                self.assertEqual(list(data['_2']['simData']['V_soma']['cell_0']), [2.0, 2.0])
+                self.assertEqual(data['_2']['simConfig']['gain'], 2.0)
+
+
+@unittest.skipIf(batch_utils is None, 'needs netpyne')
+class LazyFieldTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saveFolder = write_batch(self.tmpdir, 'B', [0.0])
+        self.outFile = os.path.join(self.saveFolder, 'B_0.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parsed_once(self):
+        reads = []
+        readFields = batch_fields.read_fields
+
+        def read_fields(filename, paths=None):
+            reads.append(paths)
+            return readFields(filename, paths)
+
+        batch_fields.read_fields = read_fields
+        try:
+            output = batch_fields.lazy_output(batch_fields.json_fetcher(self.outFile), [('simConfig', 'gain')])
+            self.assertEqual(list(output['simData']['V_soma']['cell_0']), [0.0, 0.0])
+            self.assertEqual(output['simConfig']['recordStep'], 1.0)
+        finally:
+            batch_fields.read_fields = readFields
+        try:
+            import ijson
+        except ImportError:
+            self.assertEqual(len(reads), 1)
+
+    def test_corrupt_field(self):
+        fetch = batch_fields.json_fetcher(self.outFile)
+        output = batch_fields.lazy_output(fetch, [('simConfig', 'gain')], {'simConfig': {'gain': 0.0}})
+        with open(self.outFile, 'w') as fileObj:
+            fileObj.write('{"simConfig": {"gain": 0.0}, "simData": {"t": [0.0, ')
+        self.assertIsNone(output.get('simData'))
+        self.assertRaises(KeyError, lambda: output['simData'])
+        self.assertEqual(output['simConfig']['gain'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
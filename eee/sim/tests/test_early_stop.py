@@ -0,0 +1,110 @@
+"""
+test_early_stop.py
+Tests of early stopping (batch_sim.early_stop_monitor) and the padding of
+early-stopped traces (batch_utils.pad_truncated) against the plateau
+measures of batch_analysis.  Needs netpyne and NEURON.
+Run from eee/sim: python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+simdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, simdir)
+sys.path.insert(0, os.path.join(simdir, 'batches_indcell', 'batch_20180424'))  # cfg for batch_analysis
+
+try:
+    from netpyne import sim, specs
+    import batch_analysis
+    import batch_sim
+    import batch_utils
+except ImportError:
+    batch_sim = None
+
+recordStep = 0.1
+synTime = 200.0
+
+
+def plateau_trace(duration, platamp, platend, tau, baseline=-75.0):
+    """Returns a V_soma trace at baseline until synTime, baseline + platamp
+    until platend, then decaying back to baseline with time constant tau."""
+    t = np.arange(int(round(duration / recordStep))) * recordStep
+    v = np.full(len(t), baseline)
+    v[t >= synTime] += platamp
+    decay = t >= platend
+    v[decay] = baseline + platamp * np.exp(-(t[decay] - platend) / tau)
+    return t, v
+
+
+class Net(object):
+    cells = []
+
+
+@unittest.skipIf(batch_sim is None, 'needs netpyne and NEURON')
+class EarlyStopTest(unittest.TestCase):
+
+    def setUp(self):
+        from neuron import h
+        self.saved = dict((name, getattr(sim, name, None)) for name in ['cfg', 'net', 'pc', 'simData'])
+        sim.net = Net()
+        sim.pc = h.ParallelContext()
+
+    def tearDown(self):
+        for name, value in self.saved.iteritems():
+            setattr(sim, name, value)
+
+    def run_stopped(self, v, duration, earlyStop=None):
+        """Feeds v to an early_stop_monitor as a run of duration would, and
+        returns the output saved when it stops (None if it doesn't)."""
+
+        sim.cfg = specs.SimConfig()
+        sim.cfg.recordStep = recordStep
+        sim.cfg.synTime = synTime
+        sim.cfg.duration = duration
+        sim.cfg.recordTraces = {'V_soma': {}}
+        earlyStop = dict(batch_sim.earlyStopDefaults, **(earlyStop or {}))
+        sim.simData = {'V_soma': {'cell_0': []}}
+        check = batch_sim.early_stop_monitor(earlyStop)
+        for t in np.arange(earlyStop['interval'], duration, earlyStop['interval']):
+            sim.simData['V_soma']['cell_0'] = list(v[:int(round(t / recordStep))])
+            check(t)
+            if sim.cfg.duration < duration:
+                break
+        else:
+            return None
+        tstop = sim.cfg.duration
+        sim.cfg.duration = duration
+        vtrace = sim.simData['V_soma']['cell_0']
+        simData = {'t': list(np.arange(len(vtrace)) * recordStep), 'V_soma': {'cell_0': vtrace},
+                   'earlyStop': batch_sim.early_stop_record(earlyStop, tstop, duration)}
+        return batch_utils.pad_truncated({'simConfig': {'recordStep': recordStep}, 'simData': simData})
+
+    def assert_same_plateau(self, v, duration):
+        output = self.run_stopped(v, duration)
+        self.assertIsNotNone(output)
+        padded = np.array(output['simData']['V_soma']['cell_0'])
+        self.assertEqual(len(padded), len(v))
+        full = batch_analysis.meas_trace_plat_dur(v)[0]
+        self.assertGreater(full, 0.0)
+        self.assertAlmostEqual(batch_analysis.meas_trace_plat_dur(padded)[0], full, delta=1.0)
+        self.assertAlmostEqual(batch_analysis.meas_trace_plat_amp(padded)[0],
+                               batch_analysis.meas_trace_plat_amp(v)[0], delta=0.5)
+
+    def test_plateau(self):
+        t, v = plateau_trace(2000.0, 30.0, 400.0, 50.0)
+        self.assert_same_plateau(v, 2000.0)
+
+    def test_small_plateau(self):
+        # under 2 * platthresh: a 10 mV tol would stop above its half amplitude
+        t, v = plateau_trace(3000.0, 15.0, 400.0, 500.0)
+        self.assert_same_plateau(v, 3000.0)
+
+    def test_no_stop_before_return(self):
+        t, v = plateau_trace(1500.0, 15.0, 400.0, 1000.0)
+        self.assertIsNone(self.run_stopped(v, 1500.0))
+
+
+if __name__ == '__main__':
+    unittest.main()